@@ -0,0 +1,181 @@
+"""
+Cliente HTTP de Airtable compartido por el proceso.
+
+Una sesión de requests con conexiones keep-alive para el modo síncrono y un cliente httpx por bucle
+de eventos para el modo ASGI, ambos detrás del mismo limitador de tasa, con reintentos ante 429/5xx
+y coalescencia de peticiones idénticas. httpx se importa en la primera llamada async: un worker
+síncrono no lo carga.
+"""
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class _TokenBucket:
+    """Limitador de tasa: `rate` fichas por segundo con ráfagas de hasta `capacity`."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reservar(self):
+        """Toma una ficha si hay; si no, devuelve cuántos segundos faltan para la siguiente."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while espera := self._reservar():
+            time.sleep(espera)
+
+    async def acquire_async(self):
+        # Mismo cupo que `acquire`: los hilos del modo síncrono y el bucle de eventos lo comparten.
+        while espera := self._reservar():
+            await asyncio.sleep(espera)
+
+class AirtableClient:
+    """
+    Cliente compartido por el proceso: una sesión con conexiones keep-alive, timeouts explícitos,
+    limitador de tasa acorde al cupo de Airtable, reintentos con jitter ante 429/5xx y coalescencia
+    de peticiones idénticas concurrentes (todas esperan la misma llamada en vuelo).
+    `list_records_async` hace lo mismo con httpx para el modo ASGI. `cronometrar(etapa)` devuelve
+    el context manager que mide cada llamada (en app.py, el de las métricas de /metrics).
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_url, token, rate_limit, connect_timeout, read_timeout, max_retries, pool_size, cronometrar=None):
+        self.api_url = api_url
+        self.cronometrar = cronometrar or (lambda etapa: nullcontext())
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.bucket = _TokenBucket(rate_limit)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # Estado del modo async: cliente httpx y llamadas en vuelo del bucle de eventos que los creó.
+        self._cliente_async = None
+        self._bucle_async = None
+        self._inflight_async = {}
+
+    def list_records(self, table, params):
+        """GET /{table} con `params`. Devuelve el JSON decodificado o lanza RequestException."""
+        key = (table, tuple(sorted(params.items())))
+        with self._inflight_lock:
+            fut = self._inflight.get(key)
+            owner = fut is None
+            if owner:
+                fut = Future()
+                self._inflight[key] = fut
+        if not owner:
+            return fut.result()
+        try:
+            with self.cronometrar("airtable"):
+                fut.set_result(self._get_with_retries(f"{self.api_url}/{table}", params))
+        except Exception as e:
+            fut.set_exception(e)
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+        return fut.result()
+
+    def _get_with_retries(self, url, params):
+        delay = 1.0
+        for intento in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if intento == self.max_retries:
+                    raise
+                espera = random.uniform(0, delay)
+                print(f"  -> Error de red con Airtable ({type(e).__name__}). Reintentando en {espera:.1f}s...")
+            else:
+                if r.status_code not in self.RETRY_STATUS or intento == self.max_retries:
+                    r.raise_for_status()
+                    return r.json()
+                # Airtable pide esperar ~30s tras un 429; se respeta Retry-After si viene en la respuesta.
+                retry_after = r.headers.get("Retry-After")
+                espera = float(retry_after) if retry_after and retry_after.isdigit() else random.uniform(0, delay)
+                print(f"  -> Airtable respondió {r.status_code}. Reintentando en {espera:.1f}s... (Intento {intento + 1}/{self.max_retries})")
+            time.sleep(espera)
+            delay = min(delay * 2, 30.0)
+
+    def _cliente_del_bucle(self):
+        import httpx
+        bucle = asyncio.get_running_loop()
+        if self._bucle_async is not bucle:
+            self._cliente_async = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+            self._bucle_async = bucle
+            self._inflight_async = {}
+        return self._cliente_async
+
+    async def list_records_async(self, table, params):
+        """Como `list_records`, sin bloquear el bucle de eventos. Los errores se lanzan como RequestException."""
+        cliente = self._cliente_del_bucle()
+        key = (table, tuple(sorted(params.items())))
+        tarea = self._inflight_async.get(key)
+        if tarea is None:
+            tarea = self._inflight_async[key] = asyncio.ensure_future(self._llamada_compartida(cliente, key, table, params))
+            # Si todas las peticiones que la esperaban se cancelan, su error no queda sin recoger.
+            tarea.add_done_callback(lambda t: t.cancelled() or t.exception())
+        # La llamada es una tarea propia y cada petición (también la que la lanzó) la espera con shield:
+        # si una se cancela (cliente desconectado), la llamada sigue y las demás reciben su resultado.
+        return await asyncio.shield(tarea)
+
+    async def _llamada_compartida(self, cliente, key, table, params):
+        try:
+            with self.cronometrar("airtable"):
+                return await self._get_with_retries_async(cliente, f"{self.api_url}/{table}", params)
+        finally:
+            self._inflight_async.pop(key, None)
+
+    async def _get_with_retries_async(self, cliente, url, params):
+        import httpx
+        delay = 1.0
+        for intento in range(self.max_retries + 1):
+            await self.bucket.acquire_async()
+            try:
+                r = await cliente.get(url, params=params)
+            except httpx.TransportError as e:
+                if intento == self.max_retries:
+                    error = requests.exceptions.Timeout if isinstance(e, httpx.TimeoutException) else requests.exceptions.ConnectionError
+                    raise error(f"{type(e).__name__}: {e}") from e
+                espera = random.uniform(0, delay)
+                print(f"  -> Error de red con Airtable ({type(e).__name__}). Reintentando en {espera:.1f}s...")
+            else:
+                if r.status_code not in self.RETRY_STATUS or intento == self.max_retries:
+                    if r.status_code >= 400:
+                        raise requests.exceptions.HTTPError(f"{r.status_code} Error de Airtable para la url: {r.url}")
+                    return r.json()
+                retry_after = r.headers.get("Retry-After")
+                espera = float(retry_after) if retry_after and retry_after.isdigit() else random.uniform(0, delay)
+                print(f"  -> Airtable respondió {r.status_code}. Reintentando en {espera:.1f}s... (Intento {intento + 1}/{self.max_retries})")
+            await asyncio.sleep(espera)
+            delay = min(delay * 2, 30.0)
+
+    async def cerrar_async(self):
+        if self._cliente_async is not None:
+            await self._cliente_async.aclose()
+            self._cliente_async = self._bucle_async = None
@@ -1,834 +1,4405 @@
-# app_mejorado.py
-
-import os
-import datetime
-import threading
-import io
-import json
-import time
-from functools import lru_cache
-from dotenv import load_dotenv
-
-from flask import Flask, request, jsonify, send_file
-from flask_cors import CORS
-import requests
-import pytz
-
-# ========== LIBRERÍAS DE GOOGLE E IA ==========
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
-from googleapiclient.http import MediaIoBaseDownload
-from googleapiclient.errors import HttpError
-from google.cloud import storage
-import pdfplumber
-import docx
-import google.generativeai as genai
-from google.api_core import exceptions as google_exceptions
-import faiss
-import numpy as np
-
-# ========== CONFIGURACIÓN INICIAL DE LA APP ==========
-load_dotenv() 
-
-app = Flask(__name__)
-CORS(app)
-
-class Config:
-    # --- Configuración de Airtable ---
-    AIRTABLE_TOKEN = os.environ.get("AIRTABLE_TOKEN")
-    BASE_ID = os.environ.get("AIRTABLE_BASE_ID", "appe2SiWhVOuEZJEt")
-    TABLE_FECHAS = os.environ.get("AIRTABLE_TABLE_FECHAS", "tblFtf5eMJaDoEykE")
-    TABLE_ORACULO = os.environ.get("AIRTABLE_TABLE_ORACULO", "tbl3XcK3LRqYEetIO")
-    AIRTABLE_API_URL = f"https://api.airtable.com/v0/{BASE_ID}"
-
-    # ## MEJORA: Se usa una estructura dual. Nombres para las fórmulas y IDs para leer los datos.
-    # Nombres de Campos (para filterByFormula)
-    FIELD_NAME_FECHA = "Fecha"
-    FIELD_NAME_KIN_ORACULO = "Kin Central"
-    
-    # IDs de Campos (para leer los datos de la respuesta, mucho más robusto)
-    FIELD_ID_FECHA = "fldHzpCRrHNc6EYq5"
-    FIELD_ID_KIN_CENTRAL_FECHAS = "fld6z8Dipfe2t6rVJ"
-    
-    FIELD_ID_IDKIN = "fldTBvI5SXibJHk3L"
-    FIELD_ID_KIN_CENTRAL_ORACULO = "fldGGijwtgKdX1kNf"
-    FIELD_ID_SELLO = "fld2hwTEDuot1z01o"
-    FIELD_ID_NUM_SELLO = "fldf4lEQV00vX8QGp"
-    FIELD_ID_TONO = "fldYfpMc0Gj2oNlbz"
-    FIELD_ID_GUIA = "fldXSdBjPXL61bf9v"
-    FIELD_ID_ANALOGO = "fldbFsqbkQqCsSiyY"
-    FIELD_ID_ANTIPODA = "fldDRTvvc75s5DIA1"
-    FIELD_ID_OCULTO = "fldRO16Xf91ouVIsv"
-
-    # --- Configuración de Google Drive & Gemini ---
-    SERVICE_ACCOUNT_FILE = 'credentials.json'
-    SCOPES = ['https://www.googleapis.com/auth/drive.readonly', 'https://www.googleapis.com/auth/devstorage.read_write']
-    FOLDER_ID = os.environ.get("DRIVE_FOLDER_ID")
-    GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-    EMBEDDING_MODEL = "models/embedding-001"
-    GENERATION_MODEL = "gemini-1.5-flash"
-    # ## MEJORA: Nuevas variables para la "bóveda" del índice en Google Cloud Storage
-    GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
-    
-    # ## MEJORA: Nombres de los archivos del cerebro desarmado
-    GCS_BLOB_NAME_METADATA = "rag_metadata.json"
-    GCS_BLOB_NAME_FAISS = "faiss_index.bin"
-    GCS_BLOB_NAME_CHUNKS = "doc_chunks.json"
-
-    # --- Configuración de la Aplicación ---
-    TIMEZONE = pytz.timezone(os.environ.get("TIMEZONE", "America/Bogota"))
-    RENDER_DISK_PATH = os.environ.get("RENDER_DISK_PATH", ".")
-    RAG_STATE_FILE = os.path.join(RENDER_DISK_PATH, "rag_index_state.json")
-
-app.config.from_object(Config)
-
-if not app.config["GEMINI_API_KEY"]:
-    raise ValueError("La variable de entorno GEMINI_API_KEY no está configurada.")
-genai.configure(api_key=app.config["GEMINI_API_KEY"])
-
-# ========== CACHE Y ESTADO GLOBAL ==========
-# ... (sin cambios)
-drive_file_index = []
-faiss_index = None
-doc_chunks = []
-chunk_to_file_id = [] 
-index_lock = threading.Lock()
-
-# ========== FUNCIONES HELPERS Y UTILIDADES ==========
-# ... (sin cambios)
-def api_response(status, message, data=None):
-    return jsonify({"status": status, "message": message, "data": data or {}})
-
-def normalizar_fecha_str(fecha_input):
-    if not isinstance(fecha_input, str): return None
-    fecha_input = fecha_input.strip().replace("-", "/")
-    for fmt in ["%d/%m/%Y", "%d/%m/%y", "%Y/%m/%d", "%d-%m-%Y"]:
-        try:
-            dt_obj = datetime.datetime.strptime(fecha_input, fmt)
-            return f"{dt_obj.day:02d}/{dt_obj.month:02d}/{dt_obj.year}"
-        except (ValueError, TypeError):
-            pass
-    return None
-
-# ========== LÓGICA DE AIRTABLE ==========
-@lru_cache(maxsize=512)
-def get_kin_from_date(fecha_str):
-    # ## CORRECCIÓN: Se intentan múltiples formatos de fecha para máxima compatibilidad.
-    try:
-        parts = fecha_str.split('/')
-        day_with_zero = parts[0]
-        month_with_zero = parts[1]
-        year = parts[2]
-        day_without_zero = str(int(day_with_zero))
-        month_without_zero = str(int(month_with_zero))
-        
-        formatos_a_probar = list(set([
-            f"{day_with_zero}/{month_with_zero}/{year}",
-            f"{day_without_zero}/{month_without_zero}/{year}",
-            f"{day_without_zero}/{month_with_zero}/{year}",
-            f"{day_with_zero}/{month_without_zero}/{year}",
-        ]))
-    except (ValueError, IndexError):
-        formatos_a_probar = [fecha_str]
-
-    for fecha in formatos_a_probar:
-        headers = {"Authorization": f"Bearer {app.config['AIRTABLE_TOKEN']}"}
-        params = {
-            "filterByFormula": f"{{{app.config['FIELD_NAME_FECHA']}}}='{fecha}'",
-            "returnFieldsByFieldId": "true" 
-        }
-        try:
-            r = requests.get(f"{app.config['AIRTABLE_API_URL']}/{app.config['TABLE_FECHAS']}", params=params, headers=headers)
-            r.raise_for_status()
-            records = r.json().get("records", [])
-            if records:
-                return records[0]['fields'].get(app.config['FIELD_ID_KIN_CENTRAL_FECHAS'])
-        except requests.exceptions.RequestException as e:
-            print(f"Error en la petición a Airtable (get_kin_from_date): {e}")
-            return None
-    return None
-
-@lru_cache(maxsize=260)
-def get_oraculo_from_kin(kin):
-    headers = {"Authorization": f"Bearer {app.config['AIRTABLE_TOKEN']}"}
-    params = {
-        "filterByFormula": f"{{{app.config['FIELD_NAME_KIN_ORACULO']}}}={kin}",
-        "returnFieldsByFieldId": "true"
-    }
-    try:
-        r = requests.get(f"{app.config['AIRTABLE_API_URL']}/{app.config['TABLE_ORACULO']}", params=params, headers=headers)
-        r.raise_for_status()
-        records = r.json().get("records", [])
-        return records[0]['fields'] if records else None
-    except requests.exceptions.RequestException as e:
-        print(f"Error en la petición a Airtable (get_oraculo_from_kin): {e}")
-        return None
-
-# ========== LÓGICA DE GOOGLE DRIVE Y RAG ==========
-def _download_index_from_gcs():
-    """Descarga el archivo de estado del índice desde Google Cloud Storage."""
-    if not app.config["GCS_BUCKET_NAME"]:
-        print("  -> Nombre del bucket de GCS no configurado. Omitiendo descarga.")
-        return False
-        
-    try:
-        print(f"  -> Intentando descargar el índice desde GCS bucket: {app.config['GCS_BUCKET_NAME']}")
-        creds = service_account.Credentials.from_service_account_file(
-            app.config['SERVICE_ACCOUNT_FILE'], scopes=app.config['SCOPES']
-        )
-        storage_client = storage.Client(credentials=creds)
-        bucket = storage_client.bucket(app.config["GCS_BUCKET_NAME"])
-        blob = bucket.blob(app.config["GCS_BLOB_NAME"])
-        
-        if blob.exists():
-            blob.download_to_filename(app.config["RAG_STATE_FILE"])
-            print("  -> ¡Éxito! Cerebro del Oráculo descargado desde la bóveda.")
-            return True
-        else:
-            print("  -> No se encontró un cerebro pre-construido en la bóveda. Se construirá uno nuevo.")
-            return False
-    except Exception as e:
-        print(f"Error al descargar el índice desde GCS: {e}")
-        return False
-# ... (sin cambios en esta sección)
-def _load_metadata():
-    path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_METADATA"])
-    try:
-        with open(path, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"files": {}}
-
-def _save_metadata(metadata):
-    path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_METADATA"])
-    with open(path, 'w') as f:
-        json.dump(metadata, f, indent=2)
-
-def _download_from_gcs(blob_name, destination_path):
-    if not app.config["GCS_BUCKET_NAME"]: return False
-    try:
-        creds = service_account.Credentials.from_service_account_file(app.config['SERVICE_ACCOUNT_FILE'], scopes=app.config['SCOPES'])
-        storage_client = storage.Client(credentials=creds)
-        bucket = storage_client.bucket(app.config["GCS_BUCKET_NAME"])
-        blob = bucket.blob(blob_name)
-        if blob.exists():
-            blob.download_to_filename(destination_path)
-            print(f"  -> ¡Éxito! Archivo '{blob_name}' descargado desde la bóveda.")
-            return True
-        return False
-    except Exception as e:
-        print(f"Error al descargar '{blob_name}' desde GCS: {e}")
-        return False
-
-
-def _get_drive_service():
-    try:
-        creds = service_account.Credentials.from_service_account_file(
-            app.config['SERVICE_ACCOUNT_FILE'], scopes=app.config['SCOPES']
-        )
-        return build('drive', 'v3', credentials=creds, cache_discovery=False)
-    except FileNotFoundError:
-        print("ERROR: El archivo 'credentials.json' no fue encontrado.")
-        return None
-    except Exception as e:
-        print(f"Error al crear el servicio de Drive: {e}")
-        return None
-
-def _download_and_parse_drive_file(drive_service, file_id, mime_type):
-    fh = io.BytesIO()
-    try:
-        if "google-apps.document" in mime_type:
-            request = drive_service.files().export_media(fileId=file_id, mimeType='text/plain')
-            parser_mime_type = 'text/plain'
-        elif "google-apps" in mime_type:
-            return ""
-        else:
-            request = drive_service.files().get_media(fileId=file_id)
-            parser_mime_type = mime_type
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        fh.seek(0)
-    except HttpError as error:
-        print(f"Error al descargar el archivo {file_id} de Google Drive: {error}")
-        return ""
-    text = ""
-    try:
-        if 'pdf' in parser_mime_type:
-            with pdfplumber.open(fh) as pdf:
-                text = "".join(page.extract_text() or "" for page in pdf.pages)
-        elif 'wordprocessingml' in parser_mime_type:
-            doc = docx.Document(fh)
-            text = "\n".join(para.text for para in doc.paragraphs)
-        else:
-            text = fh.read().decode('utf-8', errors='ignore')
-    except Exception as e:
-        print(f"Error al parsear el contenido del archivo {file_id}: {e}")
-        return ""
-    return text
-
-def _listar_archivos_recursivamente(service, folder_id):
-    all_files = []
-    page_token = None
-    while True:
-        try:
-            response = service.files().list(
-                q=f"'{folder_id}' in parents and trashed=false",
-                fields="nextPageToken, files(id, name, mimeType, modifiedTime)",
-                pageToken=page_token
-            ).execute()
-            for file in response.get('files', []):
-                if file.get('mimeType') == 'application/vnd.google-apps.folder':
-                    all_files.extend(_listar_archivos_recursivamente(service, file.get('id')))
-                else:
-                    all_files.append(file)
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-        except HttpError as error:
-            print(f"Error al listar archivos en la carpeta {folder_id}: {error}")
-            break
-    return all_files
-
-def get_embedding_with_retries(chunk, task_type, max_retries=5):
-    retries = 0
-    delay = 1.0
-    while retries < max_retries:
-        try:
-            embedding_result = genai.embed_content(
-                model=app.config["EMBEDDING_MODEL"],
-                content=chunk,
-                task_type=task_type
-            )
-            return embedding_result['embedding']
-        except (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError, google_exceptions.ResourceExhausted) as e:
-            retries += 1
-            print(f"  -> Error de red ({type(e).__name__}) al generar embedding. Reintentando en {delay:.1f}s... (Intento {retries}/{max_retries})")
-            time.sleep(delay)
-            delay *= 2
-        except Exception as e:
-            print(f"Error inesperado generando embedding: {e}")
-            return None
-    print(f"  -> Fallo al generar embedding después de {max_retries} intentos.")
-    return None
-
-def background_intelligent_sync():
-    global faiss_index, doc_chunks, chunk_to_file_id
-    print("Iniciando sincronización inteligente del índice RAG...")
-     # ## MEJORA: Lógica de arranque profesional
-    # 1. Comprobar si el cerebro ya existe localmente (en el disco de Render)
-    if not os.path.exists(app.config["RAG_STATE_FILE"]):
-        print("  -> No se encontró un cerebro local en el disco.")
-        # 2. Si no existe, intentar descargarlo de la bóveda
-        _download_index_from_gcs()   
-    service = _get_drive_service()
-    if not service: return
-
-    # ## MEJORA: Lógica de arranque profesional con cerebro desarmado
-    # 1. Comprobar si el cerebro ya existe localmente
-    metadata_path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_METADATA"])
-    faiss_path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_FAISS"])
-    chunks_path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_CHUNKS"])
-
-    if not all(os.path.exists(p) for p in [metadata_path, faiss_path, chunks_path]):
-        print("  -> No se encontró un cerebro local completo. Intentando descargar desde la bóveda...")
-        _download_from_gcs(app.config["GCS_BLOB_NAME_METADATA"], metadata_path)
-        _download_from_gcs(app.config["GCS_BLOB_NAME_FAISS"], faiss_path)
-        _download_from_gcs(app.config["GCS_BLOB_NAME_CHUNKS"], chunks_path)
-
-    # Cargar el índice FAISS en memoria (esto es eficiente)
-    global faiss_index
-    if os.path.exists(faiss_path) and faiss_index is None:
-        try:
-            faiss_index = faiss.read_index(faiss_path)
-            print(f"Índice FAISS con {faiss_index.ntotal} vectores cargado en memoria.")
-        except Exception as e:
-            print(f"Error al cargar el índice FAISS: {e}")
-    processed_files = rag_state.get("files", {})
-    
-    all_found_files = _listar_archivos_recursivamente(service, app.config['FOLDER_ID'])
-    print(f"--> ¡Exploración completa! Se encontraron {len(all_found_files)} archivos en total (incluyendo subcarpetas).")
-    print("--> Ahora, comenzando el análisis para procesar los archivos...")
-    
-    current_drive_files = {f["id"]: f for f in all_found_files}
-
-    files_to_add_or_update = []
-    processed_ids = set(processed_files.keys())
-    current_ids = set(current_drive_files.keys())
-
-    new_ids = current_ids - processed_ids
-    for file_id in new_ids:
-        files_to_add_or_update.append(current_drive_files[file_id])
-        print(f"  [NUEVO] Detectado nuevo archivo: {current_drive_files[file_id]['name']}")
-
-    for file_id in processed_ids.intersection(current_ids):
-        if processed_files[file_id]["modifiedTime"] != current_drive_files[file_id]["modifiedTime"]:
-            files_to_add_or_update.append(current_drive_files[file_id])
-            print(f"  [MODIFICADO] Detectado archivo modificado: {current_drive_files[file_id]['name']}")
-    
-    deleted_ids = processed_ids - current_ids
-    if deleted_ids:
-        print(f"  [ELIMINADO] Se eliminarán {len(deleted_ids)} archivos del índice.")
-
-    if not files_to_add_or_update and not deleted_ids:
-        print("Sincronización finalizada. No se encontraron cambios.")
-        with index_lock:
-
-            if faiss_index is None and rag_state["embeddings"]:
-                embeddings = np.array(rag_state["embeddings"], dtype=np.float32)
-                if embeddings.size > 0:
-                    dimension = embeddings.shape[1]
-                    faiss_index = faiss.IndexFlatL2(dimension)
-                    faiss_index.add(embeddings)
-                    doc_chunks = rag_state["chunks"]
-                    chunk_to_file_id = rag_state["chunk_map"]
-                    print("Índice FAISS existente cargado en memoria.")
-        return
-
-    if deleted_ids:
-        new_embeddings, new_chunks, new_chunk_map = [], [], []
-        for i, file_id in enumerate(rag_state["chunk_map"]):
-            if file_id not in deleted_ids:
-                new_embeddings.append(rag_state["embeddings"][i])
-                new_chunks.append(rag_state["chunks"][i])
-                new_chunk_map.append(file_id)
-        rag_state["embeddings"], rag_state["chunks"], rag_state["chunk_map"] = new_embeddings, new_chunks, new_chunk_map
-        for file_id in deleted_ids:
-            if file_id in rag_state["files"]:
-                del rag_state["files"][file_id]
-
-    for file_info in files_to_add_or_update:
-        file_id = file_info['id']
-        
-        mime_type = file_info.get('mimeType', '')
-        supported_mimes = [
-            'application/pdf',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'text/plain', 'text/csv',
-            'application/vnd.google-apps.document'
-        ]
-        
-        if not any(supported in mime_type for supported in supported_mimes):
-            print(f"  -> Omitiendo y recordando archivo no soportado: {file_info['name']} (Tipo: {mime_type})")
-            rag_state["files"][file_id] = {"name": file_info["name"], "modifiedTime": file_info["modifiedTime"], "status": "omitted"}
-            continue
-
-        if file_id in processed_files:
-            new_embeddings, new_chunks, new_chunk_map = [], [], []
-            for i, f_id in enumerate(rag_state["chunk_map"]):
-                if f_id != file_id:
-                    new_embeddings.append(rag_state["embeddings"][i])
-                    new_chunks.append(rag_state["chunks"][i])
-                    new_chunk_map.append(f_id)
-            rag_state["embeddings"], rag_state["chunks"], rag_state["chunk_map"] = new_embeddings, new_chunks, new_chunk_map
-
-        text = _download_and_parse_drive_file(service, file_id, mime_type)
-        if text:
-            print(f"  -> Procesando chunks para: {file_info['name']}")
-            chunks = [text[i:i+1500] for i in range(0, len(text), 1000)]
-            for chunk in chunks:
-                embedding = get_embedding_with_retries(chunk, task_type="RETRIEVAL_DOCUMENT")
-                if embedding:
-                    rag_state["embeddings"].append(embedding)
-                    rag_state["chunks"].append(chunk)
-                    rag_state["chunk_map"].append(file_id)
-            rag_state["files"][file_id] = {"name": file_info["name"], "modifiedTime": file_info["modifiedTime"], "status": "processed"}
-        else:
-            rag_state["files"][file_id] = {"name": file_info["name"], "modifiedTime": file_info["modifiedTime"], "status": "no_text"}
-
-
-    _save_rag_state(rag_state)
-    with index_lock:
-        if rag_state["embeddings"]:
-            embeddings = np.array(rag_state["embeddings"], dtype=np.float32)
-            if embeddings.size > 0:
-                dimension = embeddings.shape[1]
-                faiss_index = faiss.IndexFlatL2(dimension)
-                faiss_index.add(embeddings)
-                doc_chunks = rag_state["chunks"]
-                chunk_to_file_id = rag_state["chunk_map"]
-                print(f"Índice FAISS actualizado exitosamente. Total chunks: {len(doc_chunks)}")
-        else:
-            faiss_index, doc_chunks, chunk_to_file_id = None, [], []
-            print("Índice FAISS vacío tras la actualización.")
-
-def force_rebuild_index():
-    print("Forzando reconstrucción completa del índice...")
-    if os.path.exists(app.config["RAG_STATE_FILE"]):
-        os.remove(app.config["RAG_STATE_FILE"])
-    with index_lock:
-        global faiss_index, doc_chunks, chunk_to_file_id
-        faiss_index, doc_chunks, chunk_to_file_id = None, [], []
-    background_intelligent_sync()
-
-# ========== LÓGICA DE ANÁLISIS Y PERFILAMIENTO ==========
-def _crear_perfil_psicologico(oraculo_natal):
-    """
-    Analiza el oráculo natal para determinar si el perfil del usuario es pragmático.
-    """
-    sellos_pragmaticos = ["Espejo", "Perro", "Guerrero", "Tierra"]
-    tonos_pragmaticos = [5, 8, 10, 11]
-
-    sello = oraculo_natal.get(app.config['FIELD_ID_SELLO'])
-    tono = oraculo_natal.get(app.config['FIELD_ID_TONO'])
-
-    if sello in sellos_pragmaticos or tono in tonos_pragmaticos:
-        return "pragmatico"
-    return "neofito"
-
-def _generar_analisis_con_gemini(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo):
-    """
-    Construye el prompt y llama a Gemini para generar el análisis de texto.
-    """
-    datos_oraculo = f"""
-    - Oráculo Natal (La Esencia del Individuo):
-      - Arquetipo Esencial (Sello): {oraculo_natal.get(app.config['FIELD_ID_SELLO'])}
-      - Frecuencia Operativa (Tono): {oraculo_natal.get(app.config['FIELD_ID_TONO'])}
-      - Brújula Interna (Guía): {oraculo_natal.get(app.config['FIELD_ID_GUIA'])}
-      - Aliado Consciente (Análogo): {oraculo_natal.get(app.config['FIELD_ID_ANALOGO'])}
-      - Desafío Principal (Antípoda): {oraculo_natal.get(app.config['FIELD_ID_ANTIPODA'])}
-      - Potencial Oculto (Oculto): {oraculo_natal.get(app.config['FIELD_ID_OCULTO'])}
-    - Misión de Vida (El Propósito de Fondo):
-      - Arquetipo de la Misión: {oraculo_mision.get(app.config['FIELD_ID_SELLO'])}
-    - Energía del Día para la Tierra (El Clima Colectivo):
-      - Arquetipo: {oraculo_tierra.get(app.config['FIELD_ID_SELLO'])}
-      - Frecuencia: {oraculo_tierra.get(app.config['FIELD_ID_TONO'])}
-    - Línea de Tiempo Personal (Tu Clima Personal Hoy):
-      - Arquetipo: {oraculo_linea_tiempo.get(app.config['FIELD_ID_SELLO'])}
-      - Frecuencia: {oraculo_linea_tiempo.get(app.config['FIELD_ID_TONO'])}
-    """
-    
-    prompt_base = f"""
-    Eres un consejero experto en psicología profunda (Carl Jung) y sabiduría universal (Escuela de Magia del Amor). Tu misión es traducir los datos arquetípicos del Sincronario Maya a un lenguaje claro, cercano y profundo para el usuario.
-    **REGLA DE ORO: NUNCA uses términos técnicos mayas como 'Kin', 'Sello', 'Tono', 'Guía', 'Análogo', 'Antípoda' u 'Oculto'.** Traduce siempre estos conceptos a su significado práctico y universal.
-
-    Estructura tu respuesta en tres actos:
-
-    **Acto 1: Tu Esencia.**
-    Comienza hablándole al usuario sobre su perfil fundamental. Usa los datos del "Oráculo Natal" y la "Misión de Vida" para describir su arquetipo esencial, su ritmo natural, su brújula interna, sus aliados, sus desafíos y su potencial oculto. Habla de sus luces (potenciales) y sombras (áreas de crecimiento).
-
-    **Acto 2: El Clima Energético de Hoy.**
-    Ahora, describe el panorama del día de la consulta.
-    - Primero, explica el "Clima Colectivo" (Energía de la Tierra), describiendo la lección o la oportunidad que el día presenta para todos.
-    - Luego, explica su "Clima Personal" (Línea de Tiempo Personal), usando una analogía para mostrar cómo la energía general del día resuena con él de forma única.
-
-    **Acto 3: La Invitación.**
-    Cierra tu análisis con una pregunta abierta que invite a la siguiente fase de la conversación.
-
-    **Datos para el Análisis:**
-    {datos_oraculo}
-    """
-
-    if perfil == "pragmatico":
-        prompt_final = prompt_base + "\n**Instrucción Adicional:** El perfil de esta persona es pragmático y lógico. Usa un lenguaje directo, estructurado y enfocado en la psicología profunda. Traduce los arquetipos a conceptos junguianos y ofrece consejos prácticos y accionables. Finaliza con la pregunta: 'Ahora que tienes este mapa de tus energías y las del día, ¿sobre qué tema, relación o desafío específico te gustaría que profundicemos juntos?'"
-    else: # Perfil Neofito
-        prompt_final = prompt_base + "\n**Instrucción Adicional:** El perfil de esta persona es más intuitivo o nuevo en estos temas. Usa un lenguaje sencillo, amoroso y lleno de analogías. El objetivo es que se sienta comprendido y empoderado. Finaliza con la pregunta: 'Ahora que hemos visto un mapa de tus energías y las del día, ¿qué aspecto de tu vida te gustaría que exploremos juntos?'"
-    
-    try:
-        model = genai.GenerativeModel(app.config['GENERATION_MODEL'])
-        
-        retries = 0
-        delay = 2.0
-        max_retries = 3
-        while retries < max_retries:
-            try:
-                response = model.generate_content(prompt_final)
-                return response.text
-            except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded) as e:
-                retries += 1
-                if retries == max_retries:
-                    raise e
-                print(f"  -> Error de cuota/servicio ({type(e).__name__}) al generar análisis. Reintentando en {delay:.1f}s...")
-                time.sleep(delay)
-                delay *= 2
-
-    except Exception as e:
-        print(f"Error al generar análisis con Gemini: {e}")
-        return f"Hubo un error al generar el análisis después de varios intentos: {e}"
-
-
-# ========== LÓGICA DE ANÁLISIS Y PERFILAMIENTO ==========
-# ... (sin cambios en esta sección)
-def _crear_perfil_psicologico(oraculo_natal):
-    sellos_pragmaticos = ["Espejo", "Perro", "Guerrero", "Tierra"]
-    tonos_pragmaticos = [5, 8, 10, 11]
-    sello = oraculo_natal.get(app.config['FIELD_ID_SELLO'])
-    tono = oraculo_natal.get(app.config['FIELD_ID_TONO'])
-    if sello in sellos_pragmaticos or tono in tonos_pragmaticos:
-        return "pragmatico"
-    return "neofito"
-
-def _generar_analisis_con_gemini(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo):
-    datos_oraculo = f"""
-    - Oráculo Natal (Tu Esencia):
-      - Sello: {oraculo_natal.get(app.config['FIELD_ID_SELLO'])}
-      - Tono: {oraculo_natal.get(app.config['FIELD_ID_TONO'])}
-      - Guía: {oraculo_natal.get(app.config['FIELD_ID_GUIA'])}
-      - Análogo: {oraculo_natal.get(app.config['FIELD_ID_ANALOGO'])}
-      - Antípoda: {oraculo_natal.get(app.config['FIELD_ID_ANTIPODA'])}
-      - Oculto: {oraculo_natal.get(app.config['FIELD_ID_OCULTO'])}
-    - Misión de Vida (Tu Propósito de Fondo):
-      - Sello de la Misión: {oraculo_mision.get(app.config['FIELD_ID_SELLO'])}
-    - Energía del Día para la Tierra (El Clima Colectivo):
-      - Sello: {oraculo_tierra.get(app.config['FIELD_ID_SELLO'])}
-      - Tono: {oraculo_tierra.get(app.config['FIELD_ID_TONO'])}
-      - Guía: {oraculo_tierra.get(app.config['FIELD_ID_GUIA'])}
-      - Análogo: {oraculo_tierra.get(app.config['FIELD_ID_ANALOGO'])}
-      - Antípoda: {oraculo_tierra.get(app.config['FIELD_ID_ANTIPODA'])}
-      - Oculto: {oraculo_tierra.get(app.config['FIELD_ID_OCULTO'])}
-    - Tu Línea de Tiempo Personal (Tu Clima Personal Hoy):
-      - Sello: {oraculo_linea_tiempo.get(app.config['FIELD_ID_SELLO'])}
-      - Tono: {oraculo_linea_tiempo.get(app.config['FIELD_ID_TONO'])}
-      - Guía: {oraculo_linea_tiempo.get(app.config['FIELD_ID_GUIA'])}
-      - Análogo: {oraculo_linea_tiempo.get(app.config['FIELD_ID_ANALOGO'])}
-      - Antípoda: {oraculo_linea_tiempo.get(app.config['FIELD_ID_ANTIPODA'])}
-      - Oculto: {oraculo_linea_tiempo.get(app.config['FIELD_ID_OCULTO'])}
-    """
-    if perfil == "pragmatico":
-        prompt = f"""
-        Eres un experto en psicología profunda y arquetipos junguianos. Realiza un análisis comparativo y pragmático para una persona, basado en sus datos del Oráculo Maya.
-        1.  **Análisis Natal:** Primero, analiza su Oráculo Natal y Misión de Vida. Traduce los conceptos mayas a un lenguaje psicológico y práctico (Sello = arquetipo esencial, Tono = frecuencia operativa, etc.). Describe los potenciales y sombras de estos 7 aspectos natales.
-        2.  **Análisis del Día:** Luego, analiza la "Energía del Día para la Tierra" y la "Línea de Tiempo Personal". Explica cómo el "clima colectivo" (Tierra) interactúa con el "clima personal" del individuo (Línea de Tiempo).
-        3.  **Síntesis y Consejo:** Ofrece una síntesis que conecte su perfil natal con las energías del día. Dale un consejo práctico y accionable sobre cómo navegar el día de la consulta.
-        Al final, debes preguntar "¿Qué aspecto de tu vida o desafío te gustaría explorar hoy con más detalle? También puedes solicitar este mismo análisis para una fecha diferente si lo deseas.".
-        Datos para el Análisis:
-        {datos_oraculo}
-        """
-    else: # Perfil Neofito
-        prompt = f"""
-        Eres un guía espiritual sabio y cercano. Explica de manera sencilla y aterrizada las energías de una persona para el día de hoy, basadas en el Sincronario Maya.
-        1.  **Tu Esencia:** Comienza explicando su Oráculo Natal y su Misión de Vida. Usa un lenguaje fácil de entender (luz y sombra) para describir estos 7 aspectos que son su base.
-        2.  **La Energía de Hoy:** Luego, explica el "Clima Colectivo" (la energía del día para todos) y su "Clima Personal" (su Línea de Tiempo Personal). Haz una analogía para que entienda cómo la energía general del día le afecta de una manera única.
-        3.  **Consejo del Día:** Ofrece una síntesis amorosa y un consejo práctico sobre cómo puede aprovechar mejor las energías del día, conectando su esencia con lo que está sucediendo hoy.
-        El objetivo es que la persona se sienta comprendida y empoderada. Al final, debes preguntar "¿Qué aspecto de tu vida te gustaría que exploremos juntos hoy? Si quieres, también podemos hacer este mismo análisis para otra fecha.".
-        Datos para el Análisis:
-        {datos_oraculo}
-        """
-    try:
-        model = genai.GenerativeModel(app.config['GENERATION_MODEL'])
-        
-        retries = 0
-        delay = 2.0
-        max_retries = 3
-        while retries < max_retries:
-            try:
-                response = model.generate_content(prompt)
-                return response.text
-            except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded) as e:
-                retries += 1
-                if retries == max_retries:
-                    raise e
-                print(f"  -> Error de cuota/servicio ({type(e).__name__}) al generar análisis. Reintentando en {delay:.1f}s...")
-                time.sleep(delay)
-                delay *= 2
-
-    except Exception as e:
-        print(f"Error al generar análisis con Gemini: {e}")
-        return f"Hubo un error al generar el análisis después de varios intentos: {e}"
-
-# ========== ENDPOINTS DE LA API ==========
-@app.route("/")
-def home():
-    return api_response("success", "Oráculo Maya API v6.13 (Corrección Definitiva) - Powered by Gemini")
-
-@app.route("/kin")
-def kin_endpoint():
-    fecha_str = request.args.get("fecha")
-    if not fecha_str:
-        return api_response("error", "Parámetro 'fecha' es requerido."), 400
-    
-    fecha_norm = normalizar_fecha_str(fecha_str)
-    if not fecha_norm:
-        return api_response("error", f"Formato de fecha inválido: {fecha_str}"), 400
-        
-    kin = get_kin_from_date(fecha_norm)
-    if kin:
-        return api_response("success", "Kin encontrado", {"fecha": fecha_norm, "kin": kin})
-    else:
-        return api_response("not_found", f"No se encontró Kin para la fecha {fecha_norm}."), 404
-
-@app.route("/oraculo")
-def oraculo_endpoint():
-    kin_str = request.args.get("kin")
-    if not kin_str:
-        return api_response("error", "Parámetro 'kin' es requerido."), 400
-    
-    oraculo = get_oraculo_from_kin(kin_str)
-    if oraculo:
-        return api_response("success", "Oráculo encontrado", oraculo)
-    else:
-        return api_response("not_found", f"No se encontró oráculo para el Kin {kin_str}."), 404
-
-@app.route("/analisis", methods=["POST"])
-def analisis_integrado():
-    data = request.get_json()
-    if not data or "fecha_nacimiento" not in data:
-        return api_response("error", "Cuerpo de la petición debe ser JSON con 'fecha_nacimiento'."), 400
-
-    fecha_nac_norm = normalizar_fecha_str(data["fecha_nacimiento"])
-    if not fecha_nac_norm:
-        return api_response("error", f"Formato de fecha de nacimiento inválido: {data['fecha_nacimiento']}"), 400
-    
-    hoy_dt = datetime.datetime.now(app.config['TIMEZONE'])
-    fecha_consulta_norm = normalizar_fecha_str(data.get("fecha_consulta", hoy_dt.strftime("%d/%m/%Y")))
-    if not fecha_consulta_norm:
-        return api_response("error", f"Formato de fecha de consulta inválido: {data.get('fecha_consulta')}"), 400
-
-    kin_natal = get_kin_from_date(fecha_nac_norm)
-    if not kin_natal: 
-        return api_response("not_found", f"Dato Faltante: No se encontró el Kin para la fecha de nacimiento ({fecha_nac_norm}). Por favor, verifica que la fecha exista en tu Airtable."), 404
-        
-    oraculo_natal = get_oraculo_from_kin(kin_natal)
-    if not oraculo_natal: 
-        return api_response("not_found", f"Dato Faltante: No se encontró Oráculo para el Kin natal ({kin_natal})."), 404
-
-    try:
-        tono_natal = int(oraculo_natal.get(app.config['FIELD_ID_TONO'], 0))
-        kin_mision_num = (int(kin_natal) - tono_natal + 1)
-        if kin_mision_num < 1: kin_mision_num += 260
-        oraculo_mision = get_oraculo_from_kin(kin_mision_num)
-    except (ValueError, TypeError) as e:
-        return api_response("error", f"Error en los cálculos de la misión: {e}"), 500
-
-    if not oraculo_mision: 
-        return api_response("not_found", f"Dato Faltante: No se encontró Oráculo para la misión (Kin {kin_mision_num})."), 404
-        
-    fecha_nac_dt = datetime.datetime.strptime(fecha_nac_norm, "%d/%m/%Y")
-    fecha_consulta_dt = datetime.datetime.strptime(fecha_consulta_norm, "%d/%m/%Y")
-
-    fecha_cumple_este_ano = fecha_nac_dt.replace(year=fecha_consulta_dt.year)
-    fecha_cumple_a_usar = (
-        fecha_cumple_este_ano.replace(year=fecha_consulta_dt.year - 1)
-        if fecha_consulta_dt < fecha_cumple_este_ano
-        else fecha_cumple_este_ano
-    )
-    ano_maya_inicio_ano = (
-        fecha_consulta_dt.year if fecha_consulta_dt.month > 7 or (fecha_consulta_dt.month == 7 and fecha_consulta_dt.day >= 26) else fecha_consulta_dt.year - 1
-    )
-    fecha_ano_maya_str = f"26/07/{ano_maya_inicio_ano}"
-    
-    kin_cumple = get_kin_from_date(fecha_cumple_a_usar.strftime("%d/%m/%Y"))
-    kin_ano_maya = get_kin_from_date(fecha_ano_maya_str)
-
-    if not all([kin_cumple, kin_ano_maya]): 
-        return api_response("not_found", f"Dato Faltante: No se pudo encontrar el Kin para la fecha de cumpleaños ({fecha_cumple_a_usar.strftime('%d/%m/%Y')}) o del Año Nuevo Maya ({fecha_ano_maya_str})."), 404
-
-    try:
-        constante_personal_kin = ((int(kin_natal) + int(kin_ano_maya) + int(kin_cumple) - 1) % 260) + 1
-    except (ValueError, TypeError) as e:
-        return api_response("error", f"Error en los cálculos de la constante: {e}"), 500
-
-    kin_tierra = get_kin_from_date(fecha_consulta_norm)
-    if not kin_tierra: 
-        return api_response("not_found", f"Dato Faltante: No se encontró Kin para la fecha de consulta ({fecha_consulta_norm})."), 404
-    
-    oraculo_tierra = get_oraculo_from_kin(kin_tierra)
-    if not oraculo_tierra: 
-        return api_response("not_found", f"Dato Faltante: No se encontró Oráculo para el Kin de la Tierra ({kin_tierra})."), 404
-    
-    try:
-        kin_linea_tiempo_num = (constante_personal_kin + int(kin_tierra)) % 260 or 260
-        oraculo_linea_tiempo = get_oraculo_from_kin(kin_linea_tiempo_num)
-    except (ValueError, TypeError) as e:
-        return api_response("error", f"Error en los cálculos de la línea de tiempo: {e}"), 500
-        
-    if not oraculo_linea_tiempo: 
-        return api_response("not_found", f"Dato Faltante: No se encontró Oráculo para la línea de tiempo (Kin {kin_linea_tiempo_num})."), 404
-
-    perfil = _crear_perfil_psicologico(oraculo_natal)
-    
-    oraculo_constante = get_oraculo_from_kin(constante_personal_kin)
-    texto_analisis = _generar_analisis_con_gemini(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo)
-
-    respuesta_final = {
-        "pasos_calculo": {
-            "fecha_nacimiento_norm": fecha_nac_norm,
-            "kin_natal": kin_natal,
-            "fecha_consulta_norm": fecha_consulta_norm,
-            "fecha_cumpleanos_usada": fecha_cumple_a_usar.strftime("%d/%m/%Y"),
-            "fecha_ano_maya_usada": fecha_ano_maya_str,
-            "kin_cumpleanos": kin_cumple,
-            "kin_ano_maya": kin_ano_maya,
-            "constante_personal_kin": constante_personal_kin,
-            "kin_tierra": kin_tierra,
-            "linea_tiempo_personal_kin": kin_linea_tiempo_num
-        },
-        "oraculos_calculados": {
-            "natal": oraculo_natal,
-            "mision": oraculo_mision,
-            "constante_personal": oraculo_constante,
-            "tierra": oraculo_tierra,
-            "linea_tiempo_personal": oraculo_linea_tiempo
-        },
-        "analisis_generado": texto_analisis
-    }
-
-    perfil = _crear_perfil_psicologico(oraculo_natal)
-    
-    texto_analisis = _generar_analisis_con_gemini(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo)
-
-    return api_response("success", "Análisis generado.", {"analisis": texto_analisis})
-
-@app.route('/rag/search', methods=['POST'])
-def rag_search_endpoint():
-    data = request.get_json()
-    query = data.get("query")
-    if not query:
-        return api_response("error", "Debes indicar 'query' a buscar."), 400
-    
-    with index_lock:
-        if faiss_index is None or not doc_chunks:
-            return api_response("service_unavailable", "El índice de búsqueda RAG no está listo o está vacío."), 503
-
-    try:
-        emb = get_embedding_with_retries(query, task_type="RETRIEVAL_QUERY")
-        if emb:
-            _, I = faiss_index.search(np.array([emb], dtype=np.float32), k=3)
-            
-            # ## MEJORA: Se leen solo los chunks necesarios del archivo en disco.
-            # Esto evita cargar los 667MB en memoria.
-            chunks_path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_CHUNKS"])
-            with open(chunks_path, 'r') as f:
-                all_chunks = json.load(f)
-            
-            resultados = [all_chunks[i] for i in I[0]]
-            return api_response("success", "Resultados de búsqueda semántica.", {"query": query, "results": resultados})
-        else:
-            return api_response("error", "No se pudo generar el embedding para la búsqueda."), 500
-    except Exception as e:
-        return api_response("error", f"Error en la búsqueda semántica: {str(e)}", None), 500
-
-@app.route('/rag/status')
-def rag_status_endpoint():
-    with index_lock:
-        status = {
-            "drive_files_found": len(drive_file_index),
-            "is_faiss_index_built": faiss_index is not None,
-            "indexed_chunks_count": len(doc_chunks)
-        }
-    return api_response("success", "Estado del sistema RAG.", status)
-
-@app.route('/rag/sync', methods=['POST'])
-def rag_sync_endpoint():
-    threading.Thread(target=background_intelligent_sync).start()
-    return api_response("success", "La sincronización inteligente ha comenzado en segundo plano. Consulta el estado en /rag/status en unos minutos.")
-
-@app.route('/rag/rebuild', methods=['POST'])
-def rag_rebuild_endpoint():
-    threading.Thread(target=force_rebuild_index).start()
-    return api_response("success", "La reconstrucción completa del índice ha comenzado en segundo plano. Consulta el estado en /rag/status en unos minutos.")
-
-@app.route('/rag/download_state', methods=['GET'])
-def download_rag_state():
-    try:
-        return send_file(app.config["RAG_STATE_FILE"], as_attachment=True)
-    except FileNotFoundError:
-        return api_response("not_found", "El archivo de estado del índice (rag_index_state.json) no existe aún."), 404
-
-# ========== INICIALIZACIÓN DE LA APLICACIÓN ==========
-with app.app_context():
-    threading.Thread(target=background_intelligent_sync).start()
-
-if __name__ == '__main__':
+# app_mejorado.py
+
+import os
+import sys
+import asyncio
+import datetime
+import threading
+import io
+import json
+import time
+import hashlib
+import random
+import mmap
+import fcntl
+import shutil
+import unicodedata
+import re
+import importlib
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import queue
+from functools import lru_cache
+from urllib.parse import parse_qs
+from contextlib import contextmanager
+import bisect
+from collections import OrderedDict, deque, Counter
+# Referencia del arranque: lo que sigue (librerías de terceros) es lo que cuesta tiempo.
+_inicio_arranque = time.perf_counter()
+from dotenv import load_dotenv
+
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context, g
+from flask_cors import CORS
+from flask_cors.core import get_cors_headers, get_cors_options
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, InternalServerError
+import requests
+import pytz
+
+from airtable_client import AirtableClient
+import extraccion
+
+import numpy as np
+
+# ========== ARRANQUE E IMPORTS DIFERIDOS ==========
+# Tiempos del arranque por etapa y de cada import diferido (se exponen en /health/ready y /metrics).
+arranque = {"etapas": {}, "imports_diferidos": {}, "_ultima_marca": _inicio_arranque}
+
+def _marcar_arranque(etapa):
+    ahora = time.perf_counter()
+    arranque["etapas"][etapa] = round(ahora - arranque["_ultima_marca"], 4)
+    arranque["_ultima_marca"] = ahora
+
+class _ModuloPerezoso:
+    """
+    Importa el módulo en el primer acceso a un atributo. Las librerías de Drive, GCS, Gemini,
+    FAISS y parseo de documentos pesan segundos de arranque y memoria que un worker que solo
+    atiende /kin y /oraculo nunca usa. `al_cargar` se ejecuta una vez con el módulo recién importado.
+    """
+    def __init__(self, nombre, al_cargar=None):
+        self._nombre = nombre
+        self._modulo = None
+        self._lock = threading.Lock()
+        self.al_cargar = al_cargar
+
+    def _cargar(self):
+        if self._modulo is None:
+            with self._lock:
+                if self._modulo is None:
+                    inicio = time.perf_counter()
+                    modulo = importlib.import_module(self._nombre)
+                    if self.al_cargar is not None:
+                        self.al_cargar(modulo)
+                    arranque["imports_diferidos"][self._nombre] = round(time.perf_counter() - inicio, 4)
+                    self._modulo = modulo
+        return self._modulo
+
+    @property
+    def cargado(self):
+        return self._modulo is not None
+
+    def __getattr__(self, atributo):
+        return getattr(self._cargar(), atributo)
+
+# ========== LIBRERÍAS DE GOOGLE E IA (DIFERIDAS) ==========
+googleapiclient_discovery = _ModuloPerezoso("googleapiclient.discovery")
+googleapiclient_http = _ModuloPerezoso("googleapiclient.http")
+googleapiclient_errors = _ModuloPerezoso("googleapiclient.errors")
+service_account = _ModuloPerezoso("google.oauth2.service_account")
+storage = _ModuloPerezoso("google.cloud.storage")
+genai = _ModuloPerezoso("google.generativeai")
+google_exceptions = _ModuloPerezoso("google.api_core.exceptions")
+faiss = _ModuloPerezoso("faiss")
+_MODULOS_DIFERIDOS = (googleapiclient_discovery, googleapiclient_http, googleapiclient_errors, service_account,
+                      storage, genai, google_exceptions, faiss)
+_marcar_arranque("imports")
+
+# ========== CONFIGURACIÓN INICIAL DE LA APP ==========
+load_dotenv() 
+
+app = Flask(__name__)
+CORS(app)
+
+class Config:
+    # --- Configuración de Airtable ---
+    AIRTABLE_TOKEN = os.environ.get("AIRTABLE_TOKEN")
+    BASE_ID = os.environ.get("AIRTABLE_BASE_ID", "appe2SiWhVOuEZJEt")
+    TABLE_FECHAS = os.environ.get("AIRTABLE_TABLE_FECHAS", "tblFtf5eMJaDoEykE")
+    TABLE_ORACULO = os.environ.get("AIRTABLE_TABLE_ORACULO", "tbl3XcK3LRqYEetIO")
+    AIRTABLE_API_URL = f"https://api.airtable.com/v0/{BASE_ID}"
+
+    # Cliente HTTP compartido. Airtable permite 5 peticiones/s por base: con varios workers
+    # de gunicorn conviene repartir ese cupo (p. ej. 2 workers -> AIRTABLE_RATE_LIMIT=2.5).
+    AIRTABLE_RATE_LIMIT = float(os.environ.get("AIRTABLE_RATE_LIMIT", 5))
+    AIRTABLE_CONNECT_TIMEOUT = float(os.environ.get("AIRTABLE_CONNECT_TIMEOUT", 3.05))
+    AIRTABLE_READ_TIMEOUT = float(os.environ.get("AIRTABLE_READ_TIMEOUT", 10))
+    AIRTABLE_MAX_RETRIES = int(os.environ.get("AIRTABLE_MAX_RETRIES", 4))
+    AIRTABLE_POOL_SIZE = int(os.environ.get("AIRTABLE_POOL_SIZE", 10))
+
+    # ## MEJORA: Se usa una estructura dual. Nombres para las fórmulas y IDs para leer los datos.
+    # Nombres de Campos (para filterByFormula)
+    FIELD_NAME_FECHA = "Fecha"
+    FIELD_NAME_KIN_ORACULO = "Kin Central"
+    
+    # IDs de Campos (para leer los datos de la respuesta, mucho más robusto)
+    FIELD_ID_FECHA = "fldHzpCRrHNc6EYq5"
+    FIELD_ID_KIN_CENTRAL_FECHAS = "fld6z8Dipfe2t6rVJ"
+    
+    FIELD_ID_IDKIN = "fldTBvI5SXibJHk3L"
+    FIELD_ID_KIN_CENTRAL_ORACULO = "fldGGijwtgKdX1kNf"
+    FIELD_ID_SELLO = "fld2hwTEDuot1z01o"
+    FIELD_ID_NUM_SELLO = "fldf4lEQV00vX8QGp"
+    FIELD_ID_TONO = "fldYfpMc0Gj2oNlbz"
+    FIELD_ID_GUIA = "fldXSdBjPXL61bf9v"
+    FIELD_ID_ANALOGO = "fldbFsqbkQqCsSiyY"
+    FIELD_ID_ANTIPODA = "fldDRTvvc75s5DIA1"
+    FIELD_ID_OCULTO = "fldRO16Xf91ouVIsv"
+
+    # --- Configuración de Google Drive & Gemini ---
+    SERVICE_ACCOUNT_FILE = 'credentials.json'
+    SCOPES = ['https://www.googleapis.com/auth/drive.readonly', 'https://www.googleapis.com/auth/devstorage.read_write']
+    FOLDER_ID = os.environ.get("DRIVE_FOLDER_ID")
+    GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+    EMBEDDING_MODEL = "models/embedding-001"
+    # Pipeline de embeddings: chunks por petición (la API admite hasta 100), lotes en vuelo
+    # y límites del limitador adaptativo (peticiones/s) que reacciona a ResourceExhausted.
+    EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 100))
+    EMBEDDING_MAX_IN_FLIGHT = int(os.environ.get("EMBEDDING_MAX_IN_FLIGHT", 4))
+    EMBEDDING_RATE_INITIAL = float(os.environ.get("EMBEDDING_RATE_INITIAL", 2))
+    EMBEDDING_RATE_MIN = float(os.environ.get("EMBEDDING_RATE_MIN", 0.1))
+    EMBEDDING_RATE_MAX = float(os.environ.get("EMBEDDING_RATE_MAX", 10))
+    GENERATION_MODEL = "gemini-1.5-flash"
+    # Subir este valor al cambiar el texto de los prompts invalida la caché de análisis.
+    PROMPT_VERSION = "2"
+    # ## MEJORA: Nuevas variables para la "bóveda" del índice en Google Cloud Storage
+    GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
+    
+    # ## MEJORA: Nombres de los archivos del cerebro desarmado
+    GCS_BLOB_NAME_METADATA = "rag_metadata.json"
+    GCS_BLOB_NAME_FAISS = "faiss_index.bin"
+    GCS_BLOB_NAME_CHUNKS = "doc_chunks.json"
+    # Estado heredado (antes de los snapshots); solo se consulta si la bóveda no tiene ninguno.
+    GCS_BLOB_NAME_STATE = "rag_index_state.json"
+
+    # Snapshots versionados: tras cada sincronización con cambios se sube la generación completa
+    # (índice, chunks, estado y token de Drive) comprimida y con checksums; una instancia nueva
+    # la restaura con descargas por rangos en paralelo antes de sincronizar.
+    GCS_SNAPSHOT_PREFIX = os.environ.get("GCS_SNAPSHOT_PREFIX", "rag_snapshots")
+    GCS_SNAPSHOTS_TO_KEEP = int(os.environ.get("GCS_SNAPSHOTS_TO_KEEP", 3))
+    GCS_SNAPSHOT_WORKERS = int(os.environ.get("GCS_SNAPSHOT_WORKERS", 8))
+    GCS_SNAPSHOT_PART_MB = int(os.environ.get("GCS_SNAPSHOT_PART_MB", 16))
+    GCS_SNAPSHOT_COMPRESSION_LEVEL = int(os.environ.get("GCS_SNAPSHOT_COMPRESSION_LEVEL", 3))
+
+    # --- Configuración de la Aplicación ---
+    TIMEZONE = pytz.timezone(os.environ.get("TIMEZONE", "America/Bogota"))
+    RENDER_DISK_PATH = os.environ.get("RENDER_DISK_PATH", ".")
+
+    # --- Backends externos ---
+    # "live" usa Airtable, Drive, GCS y Gemini reales; "local" usa los sustitutos deterministas de
+    # backends_locales.py (desarrollo y benchmark.py sin red), con latencia y errores configurables.
+    BACKENDS = os.environ.get("BACKENDS", "live").lower()
+    LOCAL_BACKEND_LATENCY_MS = float(os.environ.get("LOCAL_BACKEND_LATENCY_MS", 0))
+    LOCAL_BACKEND_ERROR_RATE = float(os.environ.get("LOCAL_BACKEND_ERROR_RATE", 0))
+    LOCAL_BACKEND_SEED = int(os.environ.get("LOCAL_BACKEND_SEED", 42))
+    LOCAL_CORPUS_FILES = int(os.environ.get("LOCAL_CORPUS_FILES", 200))
+    LOCAL_CORPUS_FILE_KB = int(os.environ.get("LOCAL_CORPUS_FILE_KB", 8))
+    # Directorio que hace de bucket local (compartible entre instancias para probar restauraciones).
+    LOCAL_GCS_DIR = os.environ.get("LOCAL_GCS_DIR")
+    # La sincronización con Drive arranca al importar la app (desactivable para benchmarks y pruebas),
+    # diferida unos segundos para que el worker quede listo para /kin y /oraculo antes.
+    RAG_SYNC_ON_STARTUP = os.environ.get("RAG_SYNC_ON_STARTUP", "true").lower() == "true"
+    RAG_SYNC_START_DELAY_SECONDS = float(os.environ.get("RAG_SYNC_START_DELAY_SECONDS", 5))
+    # Rol de la instancia: con RAG_ENABLED=false no sincroniza ni carga FAISS/Drive/GCS y /rag/* responde 503.
+    RAG_ENABLED = os.environ.get("RAG_ENABLED", "true").lower() == "true"
+    # Subsistemas que deben estar listos para que /health/ready responda 200 ("oraculo", "rag").
+    HEALTH_READY_REQUIRES = [s.strip() for s in os.environ.get("HEALTH_READY_REQUIRES", "oraculo").split(",") if s.strip()]
+    RAG_STATE_FILE = os.path.join(RENDER_DISK_PATH, "rag_index_state.json")
+    DATA_DIR = os.environ.get("DATA_DIR", RENDER_DISK_PATH)
+    # Estado binario del RAG: manifiesto JSON + arreglos .npy por generación (ver _save_rag_state).
+    RAG_STATE_DIR = os.path.join(DATA_DIR, "rag_state")
+    RAG_VECTOR_DTYPE = os.environ.get("RAG_VECTOR_DTYPE", "float32")  # "float32" o "float16"
+    RAG_VERIFY_CHECKSUMS = os.environ.get("RAG_VERIFY_CHECKSUMS", "false").lower() == "true"
+    # Caché persistente de embeddings de chunks por hash de contenido (modelo, tarea, texto):
+    # editar un párrafo de un documento grande solo vuelve a embeber los chunks que cambiaron.
+    EMBEDDING_CACHE_FILE = os.path.join(DATA_DIR, "embedding_cache.bin")
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 100000))
+    # Pipeline de sincronización: descargas concurrentes, extracción de texto PDF/DOCX en procesos
+    # aparte y una cola acotada de archivos descargados pendientes de embeber.
+    SYNC_DOWNLOAD_WORKERS = int(os.environ.get("SYNC_DOWNLOAD_WORKERS", 4))
+    SYNC_PARSE_WORKERS = int(os.environ.get("SYNC_PARSE_WORKERS", os.cpu_count() or 1))
+    SYNC_QUEUE_SIZE = int(os.environ.get("SYNC_QUEUE_SIZE", 8))
+    # Cada documento se extrae en lotes de al menos tantos chunks (cortando al final de una página o
+    # párrafo): la memoria de la extracción no crece con el tamaño del PDF o DOCX.
+    SYNC_EXTRACT_BATCH_CHUNKS = int(os.environ.get("SYNC_EXTRACT_BATCH_CHUNKS", 256))
+    # Chunking: tamaño máximo (caracteres) y solape entre chunks consecutivos, cortando en límites
+    # de párrafo y oración. Cada chunk recuerda la página del PDF donde empieza.
+    RAG_CHUNK_SIZE = int(os.environ.get("RAG_CHUNK_SIZE", 1500))
+    RAG_CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", 200))
+    # Detección de cambios: feed changes.list de Drive y, cada tantas horas, un escaneo completo
+    # del árbol (con varias carpetas listadas en paralelo) como verificación de consistencia.
+    RAG_FULL_SCAN_HOURS = float(os.environ.get("RAG_FULL_SCAN_HOURS", 24))
+    SYNC_LIST_WORKERS = int(os.environ.get("SYNC_LIST_WORKERS", 4))
+    # Intentos por llamada de listado a Drive (files.list, changes.list, getStartPageToken) ante 429/5xx.
+    SYNC_DRIVE_MAX_RETRIES = int(os.environ.get("SYNC_DRIVE_MAX_RETRIES", 4))
+    # Bitácora de archivos ya embebidos durante una sincronización en curso (para reanudar): metadatos
+    # en JSONL y vectores float32 crudos en un archivo aparte.
+    RAG_CHECKPOINT_FILE = os.path.join(RENDER_DISK_PATH, "rag_sync_checkpoint.jsonl")
+    RAG_CHECKPOINT_VECTORS_FILE = os.path.join(RENDER_DISK_PATH, "rag_sync_checkpoint.f32")
+    # Almacén binario de chunks: offsets (uint64) + texto UTF-8 concatenado, leído con mmap.
+    CHUNK_STORE_INDEX = "doc_chunks.idx"
+    CHUNK_STORE_BLOB = "doc_chunks.bin"
+    # Generaciones inmutables del índice (FAISS + chunks) que todos los workers leen con mmap.
+    RAG_INDEX_DIR = os.path.join(DATA_DIR, "rag_index")
+    RAG_GENERATIONS_TO_KEEP = int(os.environ.get("RAG_GENERATIONS_TO_KEEP", 2))
+    RAG_GENERATION_POLL_SECONDS = float(os.environ.get("RAG_GENERATION_POLL_SECONDS", 2))
+    # Solo el worker que tiene este lock sincroniza con Drive y publica generaciones.
+    RAG_SYNC_LOCK_FILE = os.path.join(DATA_DIR, "rag_sync.lock")
+
+    # --- Tipo de índice FAISS ---
+    # "flat" (búsqueda exacta), "ivf_flat", "ivf_pq" o "hnsw" (aproximados).
+    RAG_INDEX_TYPE = os.environ.get("RAG_INDEX_TYPE", "flat")
+    RAG_IVF_NLIST = int(os.environ.get("RAG_IVF_NLIST", 0))  # 0 = automático (~4*sqrt(N))
+    RAG_IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", 8))
+    RAG_PQ_M = int(os.environ.get("RAG_PQ_M", 64))
+    RAG_PQ_NBITS = int(os.environ.get("RAG_PQ_NBITS", 8))
+    RAG_HNSW_M = int(os.environ.get("RAG_HNSW_M", 32))
+    RAG_HNSW_EF_CONSTRUCTION = int(os.environ.get("RAG_HNSW_EF_CONSTRUCTION", 80))
+    RAG_HNSW_EF_SEARCH = int(os.environ.get("RAG_HNSW_EF_SEARCH", 64))
+    RAG_TRAIN_SAMPLE = int(os.environ.get("RAG_TRAIN_SAMPLE", 20000))
+    # Evaluación recall/latencia (evaluar_indice.py). /rag/evaluacion construye índices de prueba dentro
+    # de la petición: está apagado por defecto, atiende una evaluación a la vez y acota consultas y vectores.
+    RAG_EVAL_ENDPOINT_ENABLED = os.environ.get("RAG_EVAL_ENDPOINT_ENABLED", "false").lower() == "true"
+    RAG_EVAL_MAX_K = int(os.environ.get("RAG_EVAL_MAX_K", 100))
+    RAG_EVAL_MAX_QUERIES = int(os.environ.get("RAG_EVAL_MAX_QUERIES", 500))
+    RAG_EVAL_MAX_VECTORS = int(os.environ.get("RAG_EVAL_MAX_VECTORS", 20000))
+
+    # --- Recuperación híbrida (BM25 + vectores) ---
+    RAG_SEARCH_K = int(os.environ.get("RAG_SEARCH_K", 3))
+    RAG_SEARCH_MAX_K = int(os.environ.get("RAG_SEARCH_MAX_K", 50))
+    RAG_BM25_K1 = float(os.environ.get("RAG_BM25_K1", 1.2))
+    RAG_BM25_B = float(os.environ.get("RAG_BM25_B", 0.75))
+    # Constante de Reciprocal Rank Fusion: puntaje = sum(1 / (RAG_RRF_K + rango)).
+    RAG_RRF_K = int(os.environ.get("RAG_RRF_K", 60))
+    RAG_FUSION_CANDIDATES = int(os.environ.get("RAG_FUSION_CANDIDATES", 20))
+    # Consultas cortas con coincidencias léxicas completas se responden sin pedir el embedding.
+    RAG_LEXICAL_SHORTCIRCUIT = os.environ.get("RAG_LEXICAL_SHORTCIRCUIT", "true").lower() == "true"
+    RAG_LEXICAL_SHORTCIRCUIT_MAX_TERMS = int(os.environ.get("RAG_LEXICAL_SHORTCIRCUIT_MAX_TERMS", 3))
+
+    # --- Motor local del Sincronario (Dreamspell / 13 Lunas) ---
+    # "local": el Kin se calcula en proceso; "airtable": se consulta TABLE_FECHAS como antes.
+    KIN_ENGINE = os.environ.get("KIN_ENGINE", "local")
+    # Si el cálculo local falla (fecha ilegible), se intenta Airtable como respaldo.
+    KIN_AIRTABLE_FALLBACK = os.environ.get("KIN_AIRTABLE_FALLBACK", "true").lower() == "true"
+    # Fecha ancla: 26/07/2013 = Kin 164 (Semilla Galáctica Amarilla).
+    KIN_EPOCH_FECHA = datetime.date(2013, 7, 26)
+    KIN_EPOCH_KIN = 164
+    KIN_CONFORMANCE_MAX_DAYS = int(os.environ.get("KIN_CONFORMANCE_MAX_DAYS", 366))
+    # Tabla precalculada fecha -> Kin (int16 por día) que sirve /kin y /calendario sin recalcular.
+    CALENDARIO_DESDE_ANIO = int(os.environ.get("CALENDARIO_DESDE_ANIO", 1900))
+    CALENDARIO_HASTA_ANIO = int(os.environ.get("CALENDARIO_HASTA_ANIO", 2100))
+    CALENDARIO_MAX_DIAS = int(os.environ.get("CALENDARIO_MAX_DIAS", 3660))
+
+    # --- Tabla de oráculos precargada ---
+    # Cada cuántos segundos se vuelve a descargar TABLE_ORACULO completa desde Airtable.
+    ORACULO_REFRESH_SECONDS = int(os.environ.get("ORACULO_REFRESH_SECONDS", 900))
+
+    # --- Resolución concurrente en /analisis ---
+    LOOKUP_MAX_WORKERS = int(os.environ.get("LOOKUP_MAX_WORKERS", 8))
+    ANALISIS_DEADLINE_SECONDS = float(os.environ.get("ANALISIS_DEADLINE_SECONDS", 10))
+
+    # --- Modo asíncrono (ASGI) ---
+    # `uvicorn app:asgi_app` atiende /kin, /oraculo, /analisis y /rag/search en un bucle de eventos
+    # (Airtable y Gemini con clientes async, esperas sin bloquear) y pasa el resto de rutas a Flask.
+    # `gunicorn app:app` sigue sirviendo todo en modo síncrono.
+    ASYNC_SEARCH_WORKERS = int(os.environ.get("ASYNC_SEARCH_WORKERS", 4))
+    ASYNC_WSGI_THREADS = int(os.environ.get("ASYNC_WSGI_THREADS", 16))
+    ASYNC_GEMINI_MAX_CONCURRENCY = int(os.environ.get("ASYNC_GEMINI_MAX_CONCURRENCY", 100))
+
+    # --- Endpoints por lotes ---
+    BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 1000))
+    RAG_BATCH_MAX_QUERIES = int(os.environ.get("RAG_BATCH_MAX_QUERIES", 100))
+
+    # --- Caché de análisis generados por Gemini ---
+    ANALISIS_CACHE_SIZE = int(os.environ.get("ANALISIS_CACHE_SIZE", 2048))
+    ANALISIS_CACHE_DISK = os.environ.get("ANALISIS_CACHE_DISK", "true").lower() == "true"
+    # Nivel en disco: cada entrada vence a los ANALISIS_CACHE_DISK_TTL_DAYS días (0 = nunca) y el directorio
+    # se poda en segundo plano (primero lo vencido, luego lo más antiguo) para no pasar de ANALISIS_CACHE_DISK_MAX_MB.
+    ANALISIS_CACHE_DISK_TTL_DAYS = float(os.environ.get("ANALISIS_CACHE_DISK_TTL_DAYS", 30))
+    ANALISIS_CACHE_DISK_MAX_MB = float(os.environ.get("ANALISIS_CACHE_DISK_MAX_MB", 512))
+
+    # --- Cachés de /rag/search ---
+    # Embeddings de consultas normalizadas: una consulta repetida no vuelve a llamar a la API.
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 4096))
+    QUERY_EMBEDDING_CACHE_TTL = int(os.environ.get("QUERY_EMBEDDING_CACHE_TTL", 7 * 24 * 3600))
+    QUERY_EMBEDDING_CACHE_DISK = os.environ.get("QUERY_EMBEDDING_CACHE_DISK", "true").lower() == "true"
+    # Resultados por consulta y generación del índice: una generación nueva los invalida sola.
+    SEARCH_RESULT_CACHE_SIZE = int(os.environ.get("SEARCH_RESULT_CACHE_SIZE", 1024))
+    SEARCH_RESULT_CACHE_TTL = int(os.environ.get("SEARCH_RESULT_CACHE_TTL", 3600))
+
+app.config.from_object(Config)
+_marcar_arranque("configuracion")
+
+# ========== BACKENDS EXTERNOS (REALES O LOCALES) ==========
+BACKENDS_LOCALES = app.config["BACKENDS"] == "local"
+if BACKENDS_LOCALES:
+    import backends_locales
+
+    def _simulador(semilla):
+        return backends_locales.Simulador(
+            app.config["LOCAL_BACKEND_LATENCY_MS"], app.config["LOCAL_BACKEND_ERROR_RATE"],
+            app.config["LOCAL_BACKEND_SEED"] + semilla,
+        )
+
+    app.config["FOLDER_ID"] = app.config["FOLDER_ID"] or "local-root"
+    app.config["GCS_BUCKET_NAME"] = app.config["GCS_BUCKET_NAME"] or "oraculo-local"
+    # `gemini` reemplaza al módulo google.generativeai en todas las llamadas de embedding y generación.
+    gemini = backends_locales.GeminiLocal(_simulador(1))
+    drive_local = backends_locales.DriveLocal(
+        app.config["FOLDER_ID"], app.config["LOCAL_CORPUS_FILES"], app.config["LOCAL_CORPUS_FILE_KB"],
+        _simulador(2), semilla=app.config["LOCAL_BACKEND_SEED"],
+    )
+    gcs_local = backends_locales.GCSLocal(app.config["LOCAL_GCS_DIR"] or os.path.join(app.config["RENDER_DISK_PATH"], "gcs_local"), _simulador(3))
+    print(f"Backends locales activos (latencia {app.config['LOCAL_BACKEND_LATENCY_MS']} ms, errores {app.config['LOCAL_BACKEND_ERROR_RATE']:.0%}).")
+else:
+    if not app.config["GEMINI_API_KEY"]:
+        raise ValueError("La variable de entorno GEMINI_API_KEY no está configurada.")
+    # La configuración de la API se aplica al importar la librería (en el primer uso de Gemini).
+    genai.al_cargar = lambda modulo: modulo.configure(api_key=app.config["GEMINI_API_KEY"])
+    gemini = genai
+    drive_local = gcs_local = None
+_marcar_arranque("backends")
+
+# ========== CACHE Y ESTADO GLOBAL ==========
+# ... (sin cambios)
+drive_file_index = []
+faiss_index = None
+doc_chunks = []
+chunk_to_file_id = [] 
+index_lock = threading.Lock()
+
+# Estado persistente del RAG. Cada chunk tiene un ID estable de 64 bits (`chunk_ids`, siempre
+# creciente) que es también su ID dentro del índice FAISS (IndexIDMap2). Los vectores viven en
+# un arreglo (N, d) y el texto de los chunks en el almacén mmap, no en memoria. Un estado
+# reiniciado conserva `next_id`: los IDs ya servidos no se reutilizan.
+def _estado_rag_vacio(next_id=0):
+    return {
+        "files": {},
+        "vectors": np.zeros((0, 0), dtype=np.float32),
+        "chunk_ids": np.zeros(0, dtype=np.int64),
+        "chunk_map": [],
+        "chunk_pages": [],
+        "next_id": next_id,
+    }
+
+rag_state = _estado_rag_vacio()
+
+# Tabla densa de oráculos indexada por Kin (posición 0 sin uso). Se reemplaza completa
+# en cada refresco, así los lectores siempre ven una versión consistente sin tomar locks.
+oraculo_tabla = {"kins": None, "version": 0, "checksum": None, "actualizado": None}
+
+# ========== MÉTRICAS (FORMATO PROMETHEUS) ==========
+class _Metricas:
+    """
+    Registro mínimo de contadores, gauges e histogramas en memoria, expuesto en /metrics con el
+    formato de texto de Prometheus. Cada operación es un lock y una suma, así que puede quedar
+    activo en producción. Las métricas son por proceso (cada worker de gunicorn lleva las suyas).
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.familias = {}  # nombre -> {"tipo", "ayuda", "series": {etiquetas: valor}}
+
+    def _serie(self, nombre, tipo, ayuda, etiquetas, inicial):
+        familia = self.familias.get(nombre)
+        if familia is None:
+            familia = self.familias[nombre] = {"tipo": tipo, "ayuda": ayuda, "series": {}}
+        clave = tuple(sorted(etiquetas.items()))
+        if clave not in familia["series"]:
+            familia["series"][clave] = inicial()
+        return familia["series"], clave
+
+    def incrementar(self, nombre, valor=1, ayuda="", **etiquetas):
+        with self.lock:
+            series, clave = self._serie(nombre, "counter", ayuda, etiquetas, float)
+            series[clave] += valor
+
+    def fijar(self, nombre, valor, ayuda="", tipo="gauge", **etiquetas):
+        """Fija el valor de un gauge (o de un contador que se lleva en otro lado, con tipo='counter')."""
+        with self.lock:
+            series, clave = self._serie(nombre, tipo, ayuda, etiquetas, float)
+            series[clave] = float(valor)
+
+    def observar(self, nombre, segundos, ayuda="", **etiquetas):
+        with self.lock:
+            series, clave = self._serie(nombre, "histogram", ayuda, etiquetas, lambda: [0] * (len(self.BUCKETS) + 1) + [0.0])
+            h = series[clave]
+            h[bisect.bisect_left(self.BUCKETS, segundos)] += 1
+            h[-1] += segundos
+
+    @contextmanager
+    def cronometrar(self, etapa):
+        """Mide una etapa interna (Airtable, Gemini, embeddings, FAISS...) en oraculo_stage_duration_seconds."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar("oraculo_stage_duration_seconds", time.perf_counter() - inicio,
+                          ayuda="Duración de etapas internas.", stage=etapa)
+
+    @staticmethod
+    def _etiquetas(clave, extra=()):
+        pares = list(clave) + list(extra)
+        if not pares:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pares) + "}"
+
+    def exportar(self):
+        with self.lock:
+            # Copia bajo el lock (los histogramas son listas mutables); el formateo se hace fuera.
+            familias = {
+                n: {**f, "series": {k: (list(v) if isinstance(v, list) else v) for k, v in f["series"].items()}}
+                for n, f in self.familias.items()
+            }
+        lineas = []
+        for nombre in sorted(familias):
+            familia = familias[nombre]
+            if familia["ayuda"]:
+                lineas.append(f"# HELP {nombre} {familia['ayuda']}")
+            lineas.append(f"# TYPE {nombre} {familia['tipo']}")
+            for clave, valor in familia["series"].items():
+                if familia["tipo"] != "histogram":
+                    lineas.append(f"{nombre}{self._etiquetas(clave)} {valor:.15g}")
+                    continue
+                acumulado = 0
+                for limite, cuenta in zip(self.BUCKETS + (float("inf"),), valor[:-1]):
+                    acumulado += cuenta
+                    le = "+Inf" if limite == float("inf") else f"{limite:g}"
+                    lineas.append(f"{nombre}_bucket{self._etiquetas(clave, [('le', le)])} {acumulado}")
+                lineas.append(f"{nombre}_sum{self._etiquetas(clave)} {valor[-1]:.6f}")
+                lineas.append(f"{nombre}_count{self._etiquetas(clave)} {acumulado}")
+        return "\n".join(lineas) + "\n"
+
+metricas = _Metricas()
+
+@app.before_request
+def _iniciar_cronometro():
+    g._inicio_peticion = time.perf_counter()
+
+@app.before_request
+def _rag_segun_rol():
+    if not app.config['RAG_ENABLED'] and request.path.startswith("/rag/"):
+        return api_response("service_unavailable", "El RAG está deshabilitado en esta instancia (RAG_ENABLED=false)."), 503
+
+def _anotar_peticion(ruta, metodo, codigo, inicio):
+    metricas.incrementar("oraculo_http_requests_total", ayuda="Peticiones HTTP por ruta, método y código.",
+                         route=ruta, method=metodo, status=codigo)
+    metricas.observar("oraculo_http_request_duration_seconds", time.perf_counter() - inicio,
+                      ayuda="Latencia de las peticiones HTTP por ruta.", route=ruta, method=metodo)
+
+@app.after_request
+def _registrar_peticion(response):
+    inicio = getattr(g, "_inicio_peticion", None)
+    if inicio is not None:
+        # La regla de la ruta (no la URL) mantiene acotada la cardinalidad de las etiquetas.
+        ruta = request.url_rule.rule if request.url_rule is not None else "desconocida"
+        # En respuestas en streaming se mide hasta que empieza a transmitirse el cuerpo.
+        _anotar_peticion(ruta, request.method, response.status_code, inicio)
+    return response
+
+# ========== FUNCIONES HELPERS Y UTILIDADES ==========
+# ... (sin cambios)
+def api_response(status, message, data=None):
+    return jsonify({"status": status, "message": message, "data": data or {}})
+
+class ErrorAPI(Exception):
+    """Respuesta de error (status, mensaje, código HTTP) compartida por los endpoints Flask y los del modo ASGI."""
+    def __init__(self, status, message, codigo):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.codigo = codigo
+
+def normalizar_fecha_str(fecha_input):
+    if not isinstance(fecha_input, str): return None
+    fecha_input = fecha_input.strip().replace("-", "/")
+    for fmt in ["%d/%m/%Y", "%d/%m/%y", "%Y/%m/%d", "%d-%m-%Y"]:
+        try:
+            dt_obj = datetime.datetime.strptime(fecha_input, fmt)
+            return f"{dt_obj.day:02d}/{dt_obj.month:02d}/{dt_obj.year}"
+        except (ValueError, TypeError):
+            pass
+    return None
+
+# ========== MOTOR LOCAL DEL SINCRONARIO (DREAMSPELL) ==========
+def _es_bisiesto(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+def _dias_bisiestos_hasta(fecha):
+    """Cantidad de 29 de febrero transcurridos hasta `fecha` (inclusive) desde el año 1."""
+    year_prev = fecha.year - 1
+    total = year_prev // 4 - year_prev // 100 + year_prev // 400
+    if _es_bisiesto(fecha.year) and (fecha.month, fecha.day) >= (2, 29):
+        total += 1
+    return total
+
+def calcular_kin_dreamspell(fecha):
+    """
+    Calcula el Kin (1..260) de una fecha gregoriana con la cuenta del Sincronario de 13 Lunas.
+    El 29 de febrero (0.0 Hunab Ku) no avanza la cuenta: comparte el Kin del 28 de febrero.
+    La cuenta anual de 365 días arranca el 26 de julio, por eso el ancla es un 26/07.
+    """
+    epoch = app.config['KIN_EPOCH_FECHA']
+    dias = (fecha - epoch).days - (_dias_bisiestos_hasta(fecha) - _dias_bisiestos_hasta(epoch))
+    return (app.config['KIN_EPOCH_KIN'] - 1 + dias) % 260 + 1
+
+def construir_tabla_calendario(desde_anio, hasta_anio):
+    """
+    Kin de cada día entre el 1/1/desde_anio y el 31/12/hasta_anio como int16 indexado por
+    `fecha.toordinal() - inicio`. Se arma con numpy: cada día avanza la cuenta salvo el 29/02.
+    """
+    inicio = datetime.date(desde_anio, 1, 1)
+    fin = datetime.date(hasta_anio, 12, 31)
+    dias = np.arange(np.datetime64(inicio), np.datetime64(fin) + 1, dtype="datetime64[D]")
+    meses = dias.astype("datetime64[M]")
+    es_29_feb = (meses.astype(np.int64) % 12 == 1) & ((dias - meses).astype(np.int64) == 28)
+    avance = np.cumsum(~es_29_feb) - 1
+    kins = (calcular_kin_dreamspell(inicio) - 1 + avance) % 260 + 1
+    return {"inicio": inicio.toordinal(), "fin": fin.toordinal(), "kins": kins.astype(np.int16)}
+
+calendario_kin = construir_tabla_calendario(Config.CALENDARIO_DESDE_ANIO, Config.CALENDARIO_HASTA_ANIO)
+_marcar_arranque("calendario")
+
+def kin_local(fecha):
+    """Kin desde la tabla precalculada; fuera de su rango se calcula con la fórmula."""
+    ordinal = fecha.toordinal()
+    if calendario_kin["inicio"] <= ordinal <= calendario_kin["fin"]:
+        return int(calendario_kin["kins"][ordinal - calendario_kin["inicio"]])
+    return calcular_kin_dreamspell(fecha)
+
+def _fecha_desde_str(fecha_str):
+    try:
+        return datetime.datetime.strptime(fecha_str, "%d/%m/%Y").date()
+    except (ValueError, TypeError):
+        return None
+
+def get_kin_from_date(fecha_str):
+    """
+    Devuelve el Kin de una fecha normalizada (dd/mm/yyyy).
+    El cálculo local es la ruta principal; Airtable queda como respaldo o como motor explícito.
+    """
+    if app.config['KIN_ENGINE'] == "airtable":
+        return _get_kin_from_airtable(fecha_str)
+    fecha = _fecha_desde_str(fecha_str)
+    if fecha is not None:
+        return kin_local(fecha)
+    if app.config['KIN_AIRTABLE_FALLBACK']:
+        return _get_kin_from_airtable(fecha_str)
+    return None
+
+def verificar_conformidad_kin(fecha_inicio, fecha_fin):
+    """
+    Compara el motor local contra TABLE_FECHAS día por día en el rango [fecha_inicio, fecha_fin].
+    Devuelve un resumen con las diferencias encontradas y las fechas ausentes en Airtable.
+    """
+    diferencias, sin_dato = [], []
+    total = 0
+    fecha = fecha_inicio
+    while fecha <= fecha_fin:
+        fecha_str = fecha.strftime("%d/%m/%Y")
+        kin_calculado = calcular_kin_dreamspell(fecha)
+        kin_airtable = _get_kin_from_airtable(fecha_str)
+        total += 1
+        if kin_airtable is None:
+            sin_dato.append(fecha_str)
+        else:
+            try:
+                coincide = int(kin_airtable) == kin_calculado
+            except (ValueError, TypeError):
+                coincide = False
+            if not coincide:
+                diferencias.append({"fecha": fecha_str, "kin_local": kin_calculado, "kin_airtable": kin_airtable})
+        fecha += datetime.timedelta(days=1)
+    return {
+        "fechas_revisadas": total,
+        "coincidencias": total - len(diferencias) - len(sin_dato),
+        "diferencias": diferencias,
+        "sin_dato_en_airtable": sin_dato,
+    }
+
+# ========== CLIENTE HTTP DE AIRTABLE ==========
+if BACKENDS_LOCALES:
+    airtable = backends_locales.AirtableLocal(app.config, calcular_kin_dreamspell, _simulador(0))
+else:
+    airtable = AirtableClient(
+        app.config['AIRTABLE_API_URL'],
+        app.config['AIRTABLE_TOKEN'],
+        app.config['AIRTABLE_RATE_LIMIT'],
+        app.config['AIRTABLE_CONNECT_TIMEOUT'],
+        app.config['AIRTABLE_READ_TIMEOUT'],
+        app.config['AIRTABLE_MAX_RETRIES'],
+        app.config['AIRTABLE_POOL_SIZE'],
+        cronometrar=metricas.cronometrar,
+    )
+_marcar_arranque("clientes")
+
+# ========== LÓGICA DE AIRTABLE ==========
+def _consultas_kin_airtable(fecha_str):
+    """Parámetros de TABLE_FECHAS para cada formato en que puede estar escrita la fecha."""
+    # ## CORRECCIÓN: Se intentan múltiples formatos de fecha para máxima compatibilidad.
+    try:
+        parts = fecha_str.split('/')
+        day_with_zero = parts[0]
+        month_with_zero = parts[1]
+        year = parts[2]
+        day_without_zero = str(int(day_with_zero))
+        month_without_zero = str(int(month_with_zero))
+        
+        formatos_a_probar = list(set([
+            f"{day_with_zero}/{month_with_zero}/{year}",
+            f"{day_without_zero}/{month_without_zero}/{year}",
+            f"{day_without_zero}/{month_with_zero}/{year}",
+            f"{day_with_zero}/{month_without_zero}/{year}",
+        ]))
+    except (ValueError, IndexError):
+        formatos_a_probar = [fecha_str]
+
+    return [
+        {"filterByFormula": f"{{{app.config['FIELD_NAME_FECHA']}}}='{fecha}'", "returnFieldsByFieldId": "true"}
+        for fecha in formatos_a_probar
+    ]
+
+def _consulta_oraculo_airtable(kin):
+    return {
+        "filterByFormula": f"{{{app.config['FIELD_NAME_KIN_ORACULO']}}}={kin}",
+        "returnFieldsByFieldId": "true"
+    }
+
+@lru_cache(maxsize=512)
+def _get_kin_from_airtable(fecha_str):
+    for params in _consultas_kin_airtable(fecha_str):
+        try:
+            records = airtable.list_records(app.config['TABLE_FECHAS'], params).get("records", [])
+            if records:
+                return records[0]['fields'].get(app.config['FIELD_ID_KIN_CENTRAL_FECHAS'])
+        except requests.exceptions.RequestException as e:
+            print(f"Error en la petición a Airtable (get_kin_from_date): {e}")
+            return None
+    return None
+
+def _kin_valido(kin):
+    try:
+        kin_num = int(kin)
+    except (ValueError, TypeError):
+        return None
+    return kin_num if 1 <= kin_num <= 260 else None
+
+def _oraculo_precargado(kin_num):
+    kins = oraculo_tabla["kins"]
+    return kins[kin_num] if kins is not None else None
+
+def get_oraculo_from_kin(kin):
+    """Resuelve el oráculo desde la tabla precargada; consulta Airtable solo si aún no está lista."""
+    kin_num = _kin_valido(kin)
+    if kin_num is None:
+        return None
+    oraculo = _oraculo_precargado(kin_num)
+    if oraculo is not None:
+        return oraculo
+    return _get_oraculo_from_airtable(kin_num)
+
+def _listar_tabla_oraculo():
+    """Descarga todos los registros de TABLE_ORACULO usando la paginación de Airtable."""
+    params = {"pageSize": 100, "returnFieldsByFieldId": "true"}
+    records = []
+    while True:
+        payload = airtable.list_records(app.config['TABLE_ORACULO'], params)
+        records.extend(payload.get("records", []))
+        offset = payload.get("offset")
+        if not offset:
+            return records
+        params["offset"] = offset
+
+def refrescar_tabla_oraculo():
+    """Construye una nueva tabla densa de 260 Kins y la publica con un único intercambio atómico."""
+    global oraculo_tabla
+    try:
+        records = _listar_tabla_oraculo()
+    except requests.exceptions.RequestException as e:
+        print(f"Error al descargar la tabla de oráculos desde Airtable: {e}")
+        return False
+
+    kins = [None] * 261
+    for record in records:
+        fields = record.get("fields", {})
+        try:
+            kin_num = int(fields.get(app.config['FIELD_ID_KIN_CENTRAL_ORACULO']))
+        except (ValueError, TypeError):
+            continue
+        if 1 <= kin_num <= 260:
+            kins[kin_num] = fields
+
+    faltantes = sum(1 for fields in kins[1:] if fields is None)
+    if faltantes == 260:
+        print("La tabla de oráculos llegó vacía. Se conserva la versión anterior.")
+        return False
+
+    checksum = hashlib.sha1(json.dumps(kins[1:], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    anterior = oraculo_tabla
+    oraculo_tabla = {
+        "kins": kins,
+        "version": anterior["version"] + (0 if checksum == anterior["checksum"] else 1),
+        "checksum": checksum,
+        "actualizado": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    if faltantes:
+        print(f"Tabla de oráculos cargada con {260 - faltantes} Kins ({faltantes} faltantes).")
+    else:
+        print(f"Tabla de oráculos cargada completa (versión {oraculo_tabla['version']}).")
+    return True
+
+# Se marca tras el primer intento de carga, exitoso o no: si falló, cada Kin se consulta a Airtable.
+oraculo_inicializado = threading.Event()
+
+def _ciclo_refresco_oraculo():
+    while True:
+        ok = refrescar_tabla_oraculo()
+        oraculo_inicializado.set()
+        # Si la descarga falló se reintenta antes, sin esperar el TTL completo.
+        time.sleep(app.config['ORACULO_REFRESH_SECONDS'] if ok else min(60, app.config['ORACULO_REFRESH_SECONDS']))
+
+def _get_oraculo_from_airtable(kin):
+    try:
+        records = airtable.list_records(app.config['TABLE_ORACULO'], _consulta_oraculo_airtable(kin)).get("records", [])
+        return records[0]['fields'] if records else None
+    except requests.exceptions.RequestException as e:
+        print(f"Error en la petición a Airtable (get_oraculo_from_kin): {e}")
+        return None
+
+# ========== RESOLUCIÓN CONCURRENTE DE KINS Y ORÁCULOS ==========
+_lookup_executor = ThreadPoolExecutor(max_workers=Config.LOOKUP_MAX_WORKERS, thread_name_prefix="lookup")
+
+def _nodos_listos(pendientes, resultados):
+    """
+    Saca de `pendientes` los nodos cuyas dependencias ya terminaron y devuelve [(nombre, fn, args)].
+    Los que dependen de un None quedan resueltos en None sin ejecutarse (y liberan a los suyos).
+    """
+    listos = []
+    hubo_avance = True
+    while hubo_avance:
+        hubo_avance = False
+        for nombre, (fn, deps) in list(pendientes.items()):
+            if not all(d in resultados for d in deps):
+                continue
+            del pendientes[nombre]
+            hubo_avance = True
+            args = [resultados[d] for d in deps]
+            if any(arg is None for arg in args):
+                resultados[nombre] = None
+            else:
+                listos.append((nombre, fn, args))
+    return listos
+
+def _ejecutar_grafo(grafo, timeout):
+    """
+    Ejecuta un grafo de dependencias {nombre: (fn, [dependencias])} sobre el pool de consultas.
+    Cada nodo se lanza en cuanto sus dependencias terminan y recibe sus resultados como argumentos.
+    Si una dependencia quedó en None (dato faltante o error), el nodo no se ejecuta y también queda en None.
+    Devuelve (resultados, errores) o lanza TimeoutError si se supera `timeout` segundos.
+    """
+    limite = time.monotonic() + timeout
+    resultados, errores = {}, {}
+    pendientes = dict(grafo)
+    en_vuelo = {}
+    while pendientes or en_vuelo:
+        for nombre, fn, args in _nodos_listos(pendientes, resultados):
+            en_vuelo[_lookup_executor.submit(fn, *args)] = nombre
+        if not en_vuelo:
+            break
+        restante = limite - time.monotonic()
+        hechos, _ = wait(en_vuelo, timeout=max(restante, 0), return_when=FIRST_COMPLETED)
+        if not hechos:
+            raise TimeoutError(f"Grafo incompleto tras {timeout}s: {sorted(en_vuelo.values())}")
+        for fut in hechos:
+            nombre = en_vuelo.pop(fut)
+            try:
+                resultados[nombre] = fut.result()
+            except Exception as e:
+                resultados[nombre] = None
+                errores[nombre] = e
+    return resultados, errores
+
+def _calcular_kin_mision(kin_natal, oraculo_natal):
+    tono_natal = int(oraculo_natal.get(app.config['FIELD_ID_TONO'], 0))
+    kin_mision_num = (int(kin_natal) - tono_natal + 1)
+    if kin_mision_num < 1: kin_mision_num += 260
+    return kin_mision_num
+
+def _calcular_constante(kin_natal, kin_ano_maya, kin_cumple):
+    return ((int(kin_natal) + int(kin_ano_maya) + int(kin_cumple) - 1) % 260) + 1
+
+def _calcular_kin_linea_tiempo(constante_personal_kin, kin_tierra):
+    return (constante_personal_kin + int(kin_tierra)) % 260 or 260
+
+def _grafo_del_analisis(fecha_nac, fecha_cumple, fecha_ano_maya, fecha_consulta, kin_de_fecha, oraculo_de_kin):
+    """Dependencias entre los cuatro Kins de fecha, los cálculos y los cinco oráculos del análisis."""
+    return {
+        "kin_natal": (lambda: kin_de_fecha(fecha_nac), []),
+        "kin_cumple": (lambda: kin_de_fecha(fecha_cumple), []),
+        "kin_ano_maya": (lambda: kin_de_fecha(fecha_ano_maya), []),
+        "kin_tierra": (lambda: kin_de_fecha(fecha_consulta), []),
+        "oraculo_natal": (oraculo_de_kin, ["kin_natal"]),
+        "kin_mision": (_calcular_kin_mision, ["kin_natal", "oraculo_natal"]),
+        "oraculo_mision": (oraculo_de_kin, ["kin_mision"]),
+        "constante": (_calcular_constante, ["kin_natal", "kin_ano_maya", "kin_cumple"]),
+        "oraculo_constante": (oraculo_de_kin, ["constante"]),
+        "oraculo_tierra": (oraculo_de_kin, ["kin_tierra"]),
+        "kin_linea_tiempo": (_calcular_kin_linea_tiempo, ["constante", "kin_tierra"]),
+        "oraculo_linea_tiempo": (oraculo_de_kin, ["kin_linea_tiempo"]),
+    }
+
+def _resolver_kins_y_oraculos(fecha_nac, fecha_cumple, fecha_ano_maya, fecha_consulta):
+    """
+    Resuelve los cuatro Kins de fecha y los cinco oráculos del análisis siguiendo sus dependencias,
+    de modo que la latencia queda acotada por la ruta crítica y no por la suma de consultas.
+    """
+    grafo = _grafo_del_analisis(fecha_nac, fecha_cumple, fecha_ano_maya, fecha_consulta, get_kin_from_date, get_oraculo_from_kin)
+    with metricas.cronometrar("analisis_lookups"):
+        return _ejecutar_grafo(grafo, app.config['ANALISIS_DEADLINE_SECONDS'])
+
+# ========== LÓGICA DE GOOGLE DRIVE Y RAG ==========
+_gcs_bucket_compartido = None
+_gcs_lock = threading.Lock()
+
+def _gcs_bucket():
+    """
+    Bucket configurado, en Cloud Storage o en el sustituto local de disco. Las credenciales y el
+    cliente se crean una sola vez y todas las transferencias (también las paralelas) los comparten.
+    """
+    global _gcs_bucket_compartido
+    with _gcs_lock:
+        if _gcs_bucket_compartido is None:
+            if gcs_local is not None:
+                _gcs_bucket_compartido = gcs_local.bucket(app.config["GCS_BUCKET_NAME"])
+            else:
+                creds = service_account.Credentials.from_service_account_file(
+                    app.config['SERVICE_ACCOUNT_FILE'], scopes=app.config['SCOPES']
+                )
+                _gcs_bucket_compartido = storage.Client(credentials=creds).bucket(app.config["GCS_BUCKET_NAME"])
+        return _gcs_bucket_compartido
+
+def _load_metadata():
+    path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_METADATA"])
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"files": {}}
+
+def _save_metadata(metadata):
+    path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_METADATA"])
+    with open(path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+def _download_from_gcs(blob_name, destination_path):
+    if not app.config["GCS_BUCKET_NAME"]: return False
+    try:
+        blob = _gcs_bucket().blob(blob_name)
+        if blob.exists():
+            blob.download_to_filename(destination_path)
+            print(f"  -> ¡Éxito! Archivo '{blob_name}' descargado desde la bóveda.")
+            return True
+        return False
+    except Exception as e:
+        print(f"Error al descargar '{blob_name}' desde GCS: {e}")
+        return False
+
+
+def _get_drive_service():
+    if drive_local is not None:
+        return drive_local
+    try:
+        creds = service_account.Credentials.from_service_account_file(
+            app.config['SERVICE_ACCOUNT_FILE'], scopes=app.config['SCOPES']
+        )
+        return googleapiclient_discovery.build('drive', 'v3', credentials=creds, cache_discovery=False)
+    except FileNotFoundError:
+        print("ERROR: El archivo 'credentials.json' no fue encontrado.")
+        return None
+    except Exception as e:
+        print(f"Error al crear el servicio de Drive: {e}")
+        return None
+
+def _descargar_archivo_drive(drive_service, file_id, mime_type):
+    """
+    Descarga el contenido crudo a un archivo temporal (no a memoria), por bloques. Devuelve
+    (ruta, mime_para_parser) o (None, None) si no aplica o falla; quien llama borra la ruta.
+    """
+    if "google-apps.document" in mime_type:
+        request = drive_service.files().export_media(fileId=file_id, mimeType='text/plain')
+        parser_mime_type = 'text/plain'
+    elif "google-apps" in mime_type:
+        return None, None
+    else:
+        request = drive_service.files().get_media(fileId=file_id)
+        parser_mime_type = mime_type
+    fd, ruta = tempfile.mkstemp(prefix="drive-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            downloader = googleapiclient_http.MediaIoBaseDownload(fh, request)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+    except googleapiclient_errors.HttpError as error:
+        print(f"Error al descargar el archivo {file_id} de Google Drive: {error}")
+        os.remove(ruta)
+        return None, None
+    return ruta, parser_mime_type
+
+_drive_local = threading.local()
+
+def _servicio_drive_del_hilo():
+    """El cliente de googleapiclient no es seguro entre hilos: cada hilo de descarga usa el suyo."""
+    if getattr(_drive_local, "service", None) is None:
+        _drive_local.service = _get_drive_service()
+    return _drive_local.service
+
+def _encolar(lotes, lote, cancelado):
+    """Pone el lote en la cola acotada del archivo; devuelve False si el consumidor abandonó el pipeline."""
+    while not cancelado.is_set():
+        try:
+            lotes.put(lote, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _descargar_y_extraer(file_info, parse_pool, lotes, cancelado):
+    """
+    Descarga un archivo y pone en `lotes` sus chunks [(chunk, pagina)] lote a lote (ver
+    `extraccion.extraer_lote`); None marca el final. La cola acotada frena la extracción cuando los
+    embeddings van por detrás.
+    """
+    file_id = file_info['id']
+    try:
+        with metricas.cronometrar("drive_download"):
+            ruta, parser_mime_type = _descargar_archivo_drive(_servicio_drive_del_hilo(), file_id, file_info.get('mimeType', ''))
+        if ruta is None:
+            return
+        avanzar_sync("downloaded")
+        en_pool = parse_pool is not None and ('pdf' in parser_mime_type or 'wordprocessingml' in parser_mime_type)
+        try:
+            estado = None
+            while True:
+                argumentos = (ruta, parser_mime_type, file_id, app.config['RAG_CHUNK_SIZE'], app.config['RAG_CHUNK_OVERLAP'],
+                              app.config['SYNC_EXTRACT_BATCH_CHUNKS'], estado)
+                with metricas.cronometrar("text_extraction"):
+                    resultado = None
+                    if en_pool:
+                        try:
+                            resultado = parse_pool.submit(extraccion.extraer_lote, *argumentos).result()
+                        except BrokenProcessPool:
+                            print(f"  -> El pool de procesos de extracción falló. Se extrae {file_info['name']} en el hilo actual.")
+                            en_pool = False
+                    if resultado is None:
+                        resultado = extraccion.extraer_lote(*argumentos)
+                chunks, estado = resultado
+                if chunks and not _encolar(lotes, chunks, cancelado):
+                    return
+                if estado is None:
+                    break
+        finally:
+            os.remove(ruta)
+        avanzar_sync("parsed")
+    finally:
+        _encolar(lotes, None, cancelado)
+
+def _lotes_del_archivo(lotes, fut):
+    while (lote := lotes.get()) is not None:
+        yield lote
+    # Los errores de la descarga se propagan al consumidor, como antes con el resultado completo.
+    fut.result()
+
+_ETAPAS_SYNC = ("listed", "downloaded", "parsed", "embedded")
+_progreso_sync = dict.fromkeys(_ETAPAS_SYNC, 0)
+_progreso_lock = threading.Lock()
+
+def reiniciar_progreso_sync():
+    with _progreso_lock:
+        for etapa in _ETAPAS_SYNC:
+            _progreso_sync[etapa] = 0
+            metricas.fijar("rag_sync_files", 0, ayuda="Archivos por etapa en la sincronización en curso (o la última).", stage=etapa)
+
+def avanzar_sync(etapa, cantidad=1):
+    with _progreso_lock:
+        _progreso_sync[etapa] += cantidad
+        metricas.fijar("rag_sync_files", _progreso_sync[etapa], stage=etapa)
+
+def _contexto_de_extraccion():
+    """
+    Contexto multiprocessing del pool de extracción. Hacer fork de este proceso (con hilos de
+    peticiones, sincronización y refresco vivos) puede dejar al hijo bloqueado en un lock copiado
+    tomado, así que los hijos nacen de un servidor forkserver limpio (spawn donde no existe).
+    Solo se precarga `extraccion`; bajo gunicorn/uvicorn los hijos no importan app.py, y con
+    `python app.py` lo reejecutan como __mp_main__ sin arrancar hilos (ver INICIALIZACIÓN).
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    contexto = multiprocessing.get_context("forkserver")
+    contexto.set_forkserver_preload(["extraccion"])
+    return contexto
+
+def _chunks_en_pipeline(archivos):
+    """
+    Descarga los archivos en un pool de hilos y extrae y fragmenta su texto en un pool de procesos
+    (fuera del GIL de los hilos que atienden peticiones). Produce (file_info, lotes) en el orden de
+    entrada, donde `lotes` itera los [(chunk, pagina)] del archivo y debe consumirse antes de pedir
+    el siguiente archivo.
+    Como mucho SYNC_QUEUE_SIZE archivos quedan descargados o en proceso, y cada uno con como mucho
+    dos lotes extraídos, a la espera de que el consumidor (embeddings) los tome: esa es la
+    contrapresión entre etapas.
+    """
+    if not archivos:
+        return
+    parse_pool = None
+    if app.config['SYNC_PARSE_WORKERS'] > 0:
+        parse_pool = ProcessPoolExecutor(max_workers=app.config['SYNC_PARSE_WORKERS'], mp_context=_contexto_de_extraccion())
+    descargas = ThreadPoolExecutor(max_workers=app.config['SYNC_DOWNLOAD_WORKERS'], thread_name_prefix="drive")
+    cancelado = threading.Event()
+    cola = deque()
+
+    def iniciar(file_info):
+        lotes = queue.Queue(maxsize=2)
+        cola.append((file_info, lotes, descargas.submit(_descargar_y_extraer, file_info, parse_pool, lotes, cancelado)))
+
+    try:
+        pendientes = iter(archivos)
+        for file_info in pendientes:
+            iniciar(file_info)
+            if len(cola) >= app.config['SYNC_QUEUE_SIZE']:
+                break
+        while cola:
+            file_info, lotes, fut = cola.popleft()
+            siguiente = next(pendientes, None)
+            if siguiente is not None:
+                iniciar(siguiente)
+            yield file_info, _lotes_del_archivo(lotes, fut)
+    finally:
+        # Las descargas en curso dejan de encolar lotes y terminan.
+        cancelado.set()
+        for _, _, fut in cola:
+            fut.cancel()
+        descargas.shutdown(wait=True)
+        if parse_pool is not None:
+            parse_pool.shutdown(wait=True)
+
+_CARPETA_MIME = 'application/vnd.google-apps.folder'
+_CAMPOS_ARCHIVO = "id, name, mimeType, modifiedTime, parents, trashed"
+
+_ESTADOS_DRIVE_TRANSITORIOS = (429, 500, 502, 503, 504)
+
+def _ejecutar_drive(crear_peticion):
+    """
+    Ejecuta una llamada de listado de Drive reintentando los errores transitorios (429/5xx) con
+    backoff exponencial y jitter. Los demás errores, o el último intento fallido, se propagan.
+    """
+    intentos = max(1, app.config['SYNC_DRIVE_MAX_RETRIES'])
+    delay = 0.5
+    for intento in range(1, intentos + 1):
+        try:
+            return crear_peticion().execute()
+        except googleapiclient_errors.HttpError as error:
+            if intento == intentos or error.resp.status not in _ESTADOS_DRIVE_TRANSITORIOS:
+                raise
+            espera = random.uniform(delay / 2, delay)
+            print(f"  -> Drive respondió {error.resp.status}. Reintentando en {espera:.1f}s... (Intento {intento}/{intentos})")
+            time.sleep(espera)
+            delay *= 2
+
+def _listar_carpeta(folder_id):
+    """Lista los hijos directos de una carpeta. Devuelve (archivos, subcarpetas, completo)."""
+    service = _servicio_drive_del_hilo()
+    archivos, subcarpetas = [], []
+    page_token = None
+    while True:
+        try:
+            response = _ejecutar_drive(lambda: service.files().list(
+                q=f"'{folder_id}' in parents and trashed=false",
+                fields=f"nextPageToken, files({_CAMPOS_ARCHIVO})",
+                pageSize=1000,
+                pageToken=page_token,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ))
+        except googleapiclient_errors.HttpError as error:
+            print(f"Error al listar archivos en la carpeta {folder_id}: {error}")
+            return archivos, subcarpetas, False
+        for file in response.get('files', []):
+            if file.get('mimeType') == _CARPETA_MIME:
+                subcarpetas.append(file.get('id'))
+            else:
+                archivos.append(file)
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            return archivos, subcarpetas, True
+
+def _escanear_arbol_drive(folder_id):
+    """
+    Recorre el árbol bajo `folder_id` listando varias carpetas a la vez.
+    Devuelve (archivos, carpetas_del_arbol, completo); `completo` es False si alguna carpeta falló.
+    """
+    archivos, carpetas = [], {folder_id}
+    completo = True
+    with ThreadPoolExecutor(max_workers=app.config['SYNC_LIST_WORKERS'], thread_name_prefix="drive-list") as pool:
+        pendientes = {pool.submit(_listar_carpeta, folder_id)}
+        while pendientes:
+            hechos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            for fut in hechos:
+                encontrados, subcarpetas, ok = fut.result()
+                completo = completo and ok
+                archivos.extend(encontrados)
+                for sub in subcarpetas:
+                    if sub not in carpetas:
+                        carpetas.add(sub)
+                        pendientes.add(pool.submit(_listar_carpeta, sub))
+    return archivos, carpetas, completo
+
+def _ruta_estado_drive():
+    return os.path.join(app.config["RAG_STATE_DIR"], "drive_changes.json")
+
+def _leer_estado_drive():
+    try:
+        with open(_ruta_estado_drive(), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _guardar_estado_drive(estado):
+    os.makedirs(app.config["RAG_STATE_DIR"], exist_ok=True)
+    ruta = _ruta_estado_drive()
+    with open(f"{ruta}.tmp", 'w') as f:
+        json.dump(estado, f)
+    os.replace(f"{ruta}.tmp", ruta)
+
+def _escaneo_completo_vencido(estado_drive):
+    ultimo = estado_drive.get("ultimo_escaneo_completo")
+    if not ultimo:
+        return True
+    transcurrido = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(ultimo)
+    return transcurrido.total_seconds() >= app.config['RAG_FULL_SCAN_HOURS'] * 3600
+
+def _comparar_con_procesados(current_drive_files, processed_files):
+    files_to_add_or_update = []
+    for file_id, file_info in current_drive_files.items():
+        if file_id not in processed_files:
+            files_to_add_or_update.append(file_info)
+            print(f"  [NUEVO] Detectado nuevo archivo: {file_info['name']}")
+        elif processed_files[file_id]["modifiedTime"] != file_info["modifiedTime"]:
+            files_to_add_or_update.append(file_info)
+            print(f"  [MODIFICADO] Detectado archivo modificado: {file_info['name']}")
+    return files_to_add_or_update
+
+def _detectar_cambios_por_escaneo(service, estado_drive, processed_files):
+    """Escaneo completo del árbol: referencia de consistencia y punto de partida del feed de cambios."""
+    # El token se pide antes de listar para no perder cambios ocurridos durante el escaneo.
+    try:
+        token = _ejecutar_drive(lambda: service.changes().getStartPageToken(supportsAllDrives=True)).get("startPageToken")
+    except googleapiclient_errors.HttpError as error:
+        # Sin token el escaneo sigue valiendo; la próxima sincronización volverá a escanear.
+        print(f"Error al pedir el token inicial del feed de cambios de Drive ({error}).")
+        token = None
+    all_found_files, carpetas, completo = _escanear_arbol_drive(app.config['FOLDER_ID'])
+    print(f"--> ¡Exploración completa! Se encontraron {len(all_found_files)} archivos en total (incluyendo subcarpetas).")
+
+    current_drive_files = {f["id"]: f for f in all_found_files}
+    files_to_add_or_update = _comparar_con_procesados(current_drive_files, processed_files)
+    deleted_ids = set(processed_files) - set(current_drive_files)
+    if not completo:
+        # Con un listado parcial no se puede distinguir un archivo borrado de uno no listado.
+        print("  -> El escaneo quedó incompleto. No se eliminará ningún archivo en esta pasada.")
+        deleted_ids = set()
+        token = None
+
+    estado_drive.update({
+        "page_token": token,
+        "carpetas": sorted(carpetas),
+        "ultimo_escaneo_completo": datetime.datetime.now(datetime.timezone.utc).isoformat() if completo else estado_drive.get("ultimo_escaneo_completo"),
+    })
+    return files_to_add_or_update, deleted_ids
+
+def _detectar_cambios_drive(service, estado_drive, processed_files):
+    """
+    Lee el feed changes.list desde el token guardado y lo filtra al subárbol de FOLDER_ID.
+    Una sincronización sin cambios cuesta una sola llamada. Devuelve None si hace falta un
+    escaneo completo (sin token, token inválido, escaneo periódico vencido o una carpeta salió
+    del árbol).
+    """
+    if not estado_drive.get("page_token") or _escaneo_completo_vencido(estado_drive):
+        return None
+
+    cambios = {}
+    token = estado_drive["page_token"]
+    try:
+        while True:
+            response = _ejecutar_drive(lambda: service.changes().list(
+                pageToken=token,
+                pageSize=1000,
+                includeRemoved=True,
+                spaces="drive",
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+                fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({_CAMPOS_ARCHIVO}))"
+            ))
+            for change in response.get("changes", []):
+                cambios[change["fileId"]] = change
+            if "newStartPageToken" in response:
+                nuevo_token = response["newStartPageToken"]
+                break
+            token = response["nextPageToken"]
+    except googleapiclient_errors.HttpError as error:
+        print(f"Error al leer el feed de cambios de Drive ({error}). Se hará un escaneo completo.")
+        return None
+
+    def dentro_del_arbol(change, carpetas):
+        file = change.get("file") or {}
+        if change.get("removed") or file.get("trashed"):
+            return False
+        return any(parent in carpetas for parent in file.get("parents", []))
+
+    carpetas = set(estado_drive.get("carpetas", [app.config['FOLDER_ID']]))
+    candidatos = {}
+    # Las carpetas se resuelven hasta un punto fijo: una carpeta nueva puede contener otras.
+    cambios_carpeta = {f_id: c for f_id, c in cambios.items() if (c.get("file") or {}).get("mimeType") == _CARPETA_MIME}
+    hubo_avance = True
+    while hubo_avance:
+        hubo_avance = False
+        for folder_id, change in cambios_carpeta.items():
+            if folder_id == app.config['FOLDER_ID']:
+                continue
+            dentro = dentro_del_arbol(change, carpetas)
+            if folder_id in carpetas and not dentro:
+                print("  -> Una carpeta salió del árbol sincronizado. Se hará un escaneo completo.")
+                return None
+            if folder_id not in carpetas and dentro:
+                # Carpeta creada o movida hacia el árbol: su contenido previo no aparece en el feed.
+                archivos, subcarpetas, completo = _escanear_arbol_drive(folder_id)
+                if not completo:
+                    return None
+                carpetas |= subcarpetas
+                candidatos.update({f["id"]: f for f in archivos})
+                hubo_avance = True
+    # Cambios de carpetas eliminadas (sin metadatos) que pertenecían al árbol.
+    if any(change.get("removed") and f_id in carpetas for f_id, change in cambios.items()):
+        print("  -> Una carpeta del árbol fue eliminada. Se hará un escaneo completo.")
+        return None
+
+    deleted_ids = set()
+    for file_id, change in cambios.items():
+        if file_id in cambios_carpeta or file_id in carpetas:
+            continue
+        if dentro_del_arbol(change, carpetas):
+            candidatos[file_id] = change["file"]
+        elif file_id in processed_files:
+            deleted_ids.add(file_id)
+    deleted_ids -= set(candidatos)
+
+    print(f"--> Feed de cambios de Drive: {len(cambios)} cambios, {len(candidatos)} archivos del árbol afectados.")
+    estado_drive.update({"page_token": nuevo_token, "carpetas": sorted(carpetas)})
+    return _comparar_con_procesados(candidatos, processed_files), deleted_ids
+
+def get_embedding_with_retries(chunk, task_type, max_retries=5):
+    retries = 0
+    delay = 1.0
+    while retries < max_retries:
+        try:
+            with metricas.cronometrar("embedding"):
+                embedding_result = gemini.embed_content(
+                    model=app.config["EMBEDDING_MODEL"],
+                    content=chunk,
+                    task_type=task_type
+                )
+            return embedding_result['embedding']
+        except (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError, google_exceptions.ResourceExhausted) as e:
+            retries += 1
+            if isinstance(e, google_exceptions.ResourceExhausted):
+                embedding_limiter.saturado()
+            print(f"  -> Error de red ({type(e).__name__}) al generar embedding. Reintentando en {delay:.1f}s... (Intento {retries}/{max_retries})")
+            time.sleep(delay)
+            delay *= 2
+        except Exception as e:
+            print(f"Error inesperado generando embedding: {e}")
+            return None
+    print(f"  -> Fallo al generar embedding después de {max_retries} intentos.")
+    return None
+
+# ========== PIPELINE DE EMBEDDINGS POR LOTES ==========
+class _LimitadorAdaptativo:
+    """
+    Limitador AIMD compartido por todas las llamadas de embedding: cada ResourceExhausted reduce
+    la tasa a la mitad y cada lote exitoso la sube un poco, hasta los límites configurados.
+    """
+    def __init__(self, rate, rate_min, rate_max):
+        self.rate = rate
+        self.rate_min = rate_min
+        self.rate_max = rate_max
+        self.siguiente = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self.siguiente)
+            self.siguiente = turno + 1.0 / self.rate
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+    def exito(self):
+        with self.lock:
+            self.rate = min(self.rate_max, self.rate + 0.1)
+
+    def saturado(self):
+        with self.lock:
+            self.rate = max(self.rate_min, self.rate / 2)
+            print(f"  -> Cuota de embeddings agotada. Tasa reducida a {self.rate:.2f} peticiones/s.")
+
+embedding_limiter = _LimitadorAdaptativo(
+    app.config['EMBEDDING_RATE_INITIAL'], app.config['EMBEDDING_RATE_MIN'], app.config['EMBEDDING_RATE_MAX']
+)
+_embedding_executor = ThreadPoolExecutor(max_workers=Config.EMBEDDING_MAX_IN_FLIGHT, thread_name_prefix="embedding")
+
+def _embeber_lote(textos, task_type, max_retries=5):
+    """Una petición de embedding por lote. Devuelve una lista alineada con `textos` (None si falló)."""
+    retries = 0
+    delay = 1.0
+    while retries < max_retries:
+        embedding_limiter.acquire()
+        try:
+            with metricas.cronometrar("embedding_batch"):
+                resultado = gemini.embed_content(
+                    model=app.config["EMBEDDING_MODEL"],
+                    content=textos,
+                    task_type=task_type
+                )
+            embedding_limiter.exito()
+            return resultado['embedding']
+        except (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError, google_exceptions.ResourceExhausted) as e:
+            retries += 1
+            if isinstance(e, google_exceptions.ResourceExhausted):
+                embedding_limiter.saturado()
+            espera = random.uniform(delay / 2, delay)
+            print(f"  -> Error ({type(e).__name__}) en lote de {len(textos)} embeddings. Reintentando en {espera:.1f}s... (Intento {retries}/{max_retries})")
+            time.sleep(espera)
+            delay *= 2
+        except Exception as e:
+            print(f"Error inesperado generando lote de embeddings: {e}")
+            return [None] * len(textos)
+    print(f"  -> Fallo al generar lote de embeddings después de {max_retries} intentos.")
+    return [None] * len(textos)
+
+def enviar_embeddings(chunks, task_type="RETRIEVAL_DOCUMENT"):
+    """Divide `chunks` en lotes y los envía al pool de embeddings. Devuelve los futures en orden."""
+    tam = app.config['EMBEDDING_BATCH_SIZE']
+    return [
+        _embedding_executor.submit(_embeber_lote, chunks[i:i + tam], task_type)
+        for i in range(0, len(chunks), tam)
+    ]
+
+def recoger_embeddings(futures):
+    embeddings = []
+    for fut in futures:
+        embeddings.extend(fut.result())
+    return embeddings
+
+def _leer_checkpoint():
+    """
+    Archivos ya embebidos por completo en una sincronización interrumpida: {file_id: registro}.
+    Cada archivo se anota lote a lote y se cierra con una línea "completo" (ver `_cerrar_checkpoint`);
+    uno sin cierre, con lotes salteados o con vectores truncados se vuelve a procesar. Cada línea de
+    lote apunta (offset en bytes, dimensión) a sus vectores en el archivo binario; los chunks sin
+    embedding figuran en "sin_vector" y se devuelven como None.
+    """
+    registros, parciales = {}, {}
+    try:
+        with open(app.config["RAG_CHECKPOINT_FILE"], 'r') as f:
+            lineas = f.readlines()
+        datos = np.memmap(app.config["RAG_CHECKPOINT_VECTORS_FILE"], dtype=np.uint8, mode="r") \
+            if os.path.getsize(app.config["RAG_CHECKPOINT_VECTORS_FILE"]) else np.zeros(0, dtype=np.uint8)
+    except (FileNotFoundError, ValueError):
+        return registros
+    for linea in lineas:
+        try:
+            registro = json.loads(linea)
+        except json.JSONDecodeError:
+            # Última línea truncada por una caída a mitad de escritura.
+            continue
+        file_id = registro["file_id"]
+        if registro.get("completo"):
+            parcial = parciales.pop(file_id, None)
+            if parcial and parcial["lotes"] == registro["lotes"] and parcial["modifiedTime"] == registro["modifiedTime"]:
+                registros[file_id] = parcial
+            continue
+        # El lote 0 abre el archivo de nuevo (otra versión o un reintento tras una caída).
+        if registro.get("lote") == 0:
+            parciales[file_id] = {"file_id": file_id, "modifiedTime": registro["modifiedTime"],
+                                  "chunks": [], "pages": [], "embeddings": [], "lotes": 0}
+        parcial = parciales.get(file_id)
+        if parcial is None or parcial["lotes"] != registro.get("lote") or parcial["modifiedTime"] != registro["modifiedTime"]:
+            parciales.pop(file_id, None)
+            continue
+        sin_vector = set(registro.get("sin_vector", []))
+        n = len(registro["chunks"]) - len(sin_vector)
+        inicio = registro["offset"]
+        fin = inicio + n * registro["dimension"] * 4
+        if fin > len(datos):
+            parciales.pop(file_id, None)
+            continue
+        filas = iter(np.frombuffer(datos[inicio:fin].tobytes(), dtype="<f4").reshape(n, registro["dimension"]).tolist())
+        parcial["chunks"].extend(registro["chunks"])
+        parcial["pages"].extend(registro["pages"])
+        parcial["embeddings"].extend(None if i in sin_vector else next(filas) for i in range(len(registro["chunks"])))
+        parcial["lotes"] += 1
+    return registros
+
+def _anotar_checkpoint(file_id, modified_time, lote, chunks, paginas, embeddings):
+    """
+    Anota el lote número `lote` de un archivo. Primero los vectores (fsync) y luego la línea que los
+    referencia: una línea presente siempre tiene sus datos.
+    """
+    validos = [e for e in embeddings if e]
+    dimension = len(validos[0]) if validos else 0
+    with open(app.config["RAG_CHECKPOINT_VECTORS_FILE"], 'ab') as f:
+        offset = f.seek(0, os.SEEK_END)
+        if validos:
+            f.write(np.asarray(validos, dtype="<f4").tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    _anexar_linea_checkpoint({
+        "file_id": file_id, "modifiedTime": modified_time, "lote": lote, "chunks": chunks, "pages": paginas,
+        "offset": offset, "dimension": dimension, "sin_vector": [i for i, e in enumerate(embeddings) if not e],
+    })
+
+def _cerrar_checkpoint(file_id, modified_time, lotes):
+    """Marca el archivo como embebido entero, en `lotes` lotes: solo entonces se reanuda desde el checkpoint."""
+    _anexar_linea_checkpoint({"file_id": file_id, "modifiedTime": modified_time, "lotes": lotes, "completo": True})
+
+def _anexar_linea_checkpoint(registro):
+    with open(app.config["RAG_CHECKPOINT_FILE"], 'a') as f:
+        f.write(json.dumps(registro) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def _borrar_checkpoint():
+    for ruta in (app.config["RAG_CHECKPOINT_FILE"], app.config["RAG_CHECKPOINT_VECTORS_FILE"]):
+        if os.path.exists(ruta):
+            os.remove(ruta)
+
+# ========== CACHÉ DE EMBEDDINGS DE DOCUMENTOS ==========
+class CacheEmbeddingsDocumento:
+    """
+    Embeddings de chunks direccionados por contenido, en un único archivo de solo anexado:
+    una cabecera (magia, dimensión, dtype) y registros de tamaño fijo con los 16 primeros bytes
+    del SHA-256 de (modelo, tarea, texto normalizado) seguidos del vector. En memoria solo se
+    guarda el diccionario clave -> fila; los vectores se leen al acertar de un mmap de solo
+    lectura, como en `ChunkStore`. Lo escribe únicamente el worker líder durante la sincronización.
+    """
+    MAGIA = b"OMEC"
+    CABECERA = 16
+
+    def __init__(self, ruta, max_entradas, dtype="float32"):
+        self.ruta = ruta
+        self.max_entradas = max_entradas
+        self.dtype = np.dtype(dtype)
+        self.dimension = None
+        self.filas = {}
+        self._mapa = None
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self._cargar()
+
+    @staticmethod
+    def clave(texto, task_type):
+        normalizado = " ".join(unicodedata.normalize("NFKC", texto).split())
+        material = "\x1f".join([app.config["EMBEDDING_MODEL"], task_type, normalizado])
+        return hashlib.sha256(material.encode("utf-8")).digest()[:16]
+
+    @property
+    def _tam_registro(self):
+        return 16 + self.dimension * self.dtype.itemsize
+
+    def _cargar(self):
+        try:
+            with open(self.ruta, "rb") as f:
+                cabecera = f.read(self.CABECERA)
+                if len(cabecera) < self.CABECERA or cabecera[:4] != self.MAGIA:
+                    return
+                dimension = int.from_bytes(cabecera[4:8], "little")
+                if np.dtype(cabecera[8:16].rstrip(b"\0").decode()) != self.dtype:
+                    print("  -> La caché de embeddings usa otro dtype. Se descarta.")
+                    return
+                self.dimension = dimension
+                tamano = os.fstat(f.fileno()).st_size - self.CABECERA
+                # Un registro final incompleto (caída a mitad de escritura) se ignora y se trunca al anexar.
+                total = tamano // self._tam_registro
+                claves = np.fromfile(f, dtype=np.dtype([("clave", "V16"), ("vector", "V%d" % (self._tam_registro - 16))]), count=total)["clave"]
+        except (FileNotFoundError, ValueError, TypeError):
+            return
+        self.filas = {bytes(c): i for i, c in enumerate(claves)}
+
+    def get(self, clave):
+        with self.lock:
+            fila = self.filas.get(clave)
+            if fila is None:
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+            inicio = self.CABECERA + fila * self._tam_registro + 16
+            vector = np.frombuffer(self._vista(inicio + self.dimension * self.dtype.itemsize), dtype=self.dtype, count=self.dimension, offset=inicio)
+            return vector.astype(np.float32).tolist()
+
+    def _vista(self, fin):
+        """mmap del archivo; se rehace solo cuando `fin` cae en registros anexados después de mapearlo."""
+        if self._mapa is None or len(self._mapa) < fin:
+            self._cerrar_mapa()
+            with open(self.ruta, "rb") as f:
+                self._mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mapa
+
+    def _cerrar_mapa(self):
+        if self._mapa is not None:
+            self._mapa.close()
+            self._mapa = None
+
+    def agregar(self, pares):
+        """Anexa [(clave, embedding)] nuevos en una sola escritura; cada clave se guarda una sola vez."""
+        with self.lock:
+            nuevos = {}
+            for c, e in pares:
+                if e and c not in self.filas:
+                    nuevos.setdefault(c, e)
+            if not nuevos:
+                return
+            pares = list(nuevos.items())
+            dimension = len(pares[0][1])
+            if self.dimension != dimension:
+                # Primer uso o cambio de modelo con otra dimensión: se empieza un archivo nuevo.
+                self._reiniciar(dimension)
+            try:
+                with open(self.ruta, "r+b") as f:
+                    f.truncate(self.CABECERA + len(self.filas) * self._tam_registro)
+                    f.seek(0, os.SEEK_END)
+                    f.write(b"".join(c + np.asarray(e, dtype=self.dtype).tobytes() for c, e in pares))
+            except OSError as e:
+                print(f"No se pudo escribir la caché de embeddings de documentos: {e}")
+                return
+            for c, _ in pares:
+                self.filas[c] = len(self.filas)
+
+    def _reiniciar(self, dimension):
+        self._cerrar_mapa()
+        os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+        with open(self.ruta, "wb") as f:
+            f.write(self.MAGIA + dimension.to_bytes(4, "little") + self.dtype.str.encode().ljust(8, b"\0"))
+        self.dimension = dimension
+        self.filas = {}
+
+    def compactar(self):
+        """Si supera el máximo, conserva las entradas más recientes (las últimas anexadas)."""
+        with self.lock:
+            if len(self.filas) <= self.max_entradas:
+                return
+            inicio = len(self.filas) - self.max_entradas
+            tmp = f"{self.ruta}.tmp"
+            with open(self.ruta, "rb") as origen, open(tmp, "wb") as destino:
+                destino.write(origen.read(self.CABECERA))
+                origen.seek(self.CABECERA + inicio * self._tam_registro)
+                destino.write(origen.read(self.max_entradas * self._tam_registro))
+            self._cerrar_mapa()
+            os.replace(tmp, self.ruta)
+            self.filas = {c: f - inicio for c, f in self.filas.items() if f >= inicio}
+            print(f"  -> Caché de embeddings compactada a {len(self.filas)} entradas.")
+
+    def estadisticas(self):
+        total = self.aciertos + self.fallos
+        return {
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "entradas": len(self.filas),
+            "tasa_aciertos": round(self.aciertos / total, 4) if total else None,
+        }
+
+document_embedding_cache = CacheEmbeddingsDocumento(
+    app.config['EMBEDDING_CACHE_FILE'], app.config['EMBEDDING_CACHE_MAX_ENTRIES'], app.config['RAG_VECTOR_DTYPE']
+)
+
+def enviar_embeddings_documento(chunks, task_type="RETRIEVAL_DOCUMENT", usar_cache=True):
+    """
+    Como `enviar_embeddings`, pero antes consulta la caché por contenido: solo se envían los chunks
+    desconocidos (y una vez cada texto repetido). Con `usar_cache=False` (reconstrucción forzada) se
+    embeben todos y la caché solo se actualiza. Devuelve un pendiente para `recoger_embeddings_documento`.
+    """
+    claves = [CacheEmbeddingsDocumento.clave(chunk, task_type) for chunk in chunks]
+    embeddings = [document_embedding_cache.get(c) if usar_cache else None for c in claves]
+    faltantes = {}
+    for i, emb in enumerate(embeddings):
+        if emb is None:
+            faltantes.setdefault(claves[i], []).append(i)
+    unicos = list(faltantes)
+    futures = enviar_embeddings([chunks[faltantes[c][0]] for c in unicos], task_type=task_type)
+    return {"claves": unicos, "posiciones": faltantes, "embeddings": embeddings, "futures": futures}
+
+def recoger_embeddings_documento(pendiente):
+    nuevos = recoger_embeddings(pendiente["futures"])
+    embeddings = pendiente["embeddings"]
+    for clave, emb in zip(pendiente["claves"], nuevos):
+        for i in pendiente["posiciones"][clave]:
+            embeddings[i] = emb
+    document_embedding_cache.agregar(zip(pendiente["claves"], nuevos))
+    return embeddings
+
+# ========== CONSTRUCCIÓN DE ÍNDICES FAISS ==========
+def _nlist_para(n):
+    nlist = app.config['RAG_IVF_NLIST'] or int(4 * np.sqrt(n))
+    # FAISS necesita ~39 vectores por centroide para entrenar bien; se recorta si no alcanza.
+    return max(1, min(nlist, n // 39))
+
+def _construir_indice_faiss(embeddings, tipo=None, ids=None):
+    """
+    Crea y llena el índice según `RAG_INDEX_TYPE`. Los índices IVF se entrenan sobre una muestra
+    de hasta RAG_TRAIN_SAMPLE vectores. Si no hay vectores suficientes para entrenar, se usa flat.
+    Con `ids` el índice se envuelve en un IndexIDMap2 para poder quitar y añadir chunks por ID.
+    """
+    tipo = tipo or app.config['RAG_INDEX_TYPE']
+    n, dimension = embeddings.shape
+
+    if tipo == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, app.config['RAG_HNSW_M'])
+        index.hnsw.efConstruction = app.config['RAG_HNSW_EF_CONSTRUCTION']
+        index.hnsw.efSearch = app.config['RAG_HNSW_EF_SEARCH']
+    elif tipo in ("ivf_flat", "ivf_pq") and n >= 39:
+        nlist = _nlist_para(n)
+        quantizer = faiss.IndexFlatL2(dimension)
+        if tipo == "ivf_pq":
+            m = app.config['RAG_PQ_M']
+            while dimension % m:
+                m -= 1
+            nbits = app.config['RAG_PQ_NBITS']
+            while nbits > 1 and n < 39 * (1 << nbits):
+                nbits -= 1
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, nbits)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+        muestra = embeddings
+        if n > app.config['RAG_TRAIN_SAMPLE']:
+            rng = np.random.default_rng(0)
+            muestra = embeddings[rng.choice(n, app.config['RAG_TRAIN_SAMPLE'], replace=False)]
+        index.train(np.ascontiguousarray(muestra))
+        index.nprobe = min(app.config['RAG_IVF_NPROBE'], nlist)
+    else:
+        if tipo != "flat":
+            print(f"  -> Muy pocos vectores ({n}) para entrenar un índice '{tipo}'. Se usa un índice exacto.")
+        index = faiss.IndexFlatL2(dimension)
+
+    if ids is None:
+        index.add(embeddings)
+        return index
+    index = faiss.IndexIDMap2(index)
+    index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+    return index
+
+def _tiene_ids(index):
+    return isinstance(faiss.downcast_index(index), (faiss.IndexIDMap, faiss.IndexIDMap2))
+
+def _indice_base(index):
+    """Índice concreto, atravesando el envoltorio IndexIDMap si lo hay."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    return index
+
+def _es_ivf(index):
+    return isinstance(_indice_base(index), faiss.IndexIVF)
+
+def _parametros_busqueda(index, nprobe=None, ef_search=None, selector=None):
+    """Parámetros de búsqueda por petición (no modifican el índice compartido entre hilos)."""
+    base = _indice_base(index)
+    extra = {"sel": selector} if selector is not None else {}
+    if nprobe and isinstance(base, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=int(nprobe), **extra)
+    if ef_search and isinstance(base, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search), **extra)
+    if selector is not None:
+        return faiss.SearchParameters(**extra)
+    return None
+
+def buscar_en_indice(index, consultas, k, nprobe=None, ef_search=None, ids_permitidos=None):
+    """`ids_permitidos` restringe la búsqueda a esos IDs de chunk (filtro por archivo)."""
+    # El selector se mantiene referenciado aquí mientras FAISS lo usa.
+    selector = faiss.IDSelectorBatch(np.asarray(ids_permitidos, dtype=np.int64)) if ids_permitidos is not None else None
+    params = _parametros_busqueda(index, nprobe, ef_search, selector)
+    with metricas.cronometrar("faiss_search"):
+        if params is None:
+            return index.search(consultas, k)
+        return index.search(consultas, k, params=params)
+
+def evaluar_indice_ann(embeddings, k=10, n_consultas=100, nprobes=(1, 4, 8, 16, 32, 64), ef_searches=(16, 32, 64, 128, 256), max_vectores=None):
+    """
+    Mide recall@k y latencia media por consulta de cada tipo de índice frente a la búsqueda exacta,
+    usando como consultas una muestra de los propios vectores del corpus. Con `max_vectores` los
+    índices de prueba se construyen sobre una muestra del corpus de ese tamaño.
+    """
+    if k < 1 or n_consultas < 1:
+        raise ValueError("k y el número de consultas deben ser al menos 1.")
+    rng = np.random.default_rng(0)
+    if max_vectores and embeddings.shape[0] > max_vectores:
+        embeddings = embeddings[np.sort(rng.choice(embeddings.shape[0], max_vectores, replace=False))]
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    n = embeddings.shape[0]
+    consultas = np.ascontiguousarray(embeddings[rng.choice(n, min(n_consultas, n), replace=False)])
+    k = min(k, n)
+
+    def medir(index, **params):
+        inicio = time.perf_counter()
+        _, I = buscar_en_indice(index, consultas, k, **params)
+        ms = (time.perf_counter() - inicio) * 1000 / len(consultas)
+        return I, ms
+
+    flat = _construir_indice_faiss(embeddings, "flat")
+    exactos, ms_flat = medir(flat)
+    verdad = [set(fila) for fila in exactos]
+
+    def recall(I):
+        return float(np.mean([len(verdad[i] & set(fila)) / k for i, fila in enumerate(I)]))
+
+    puntos = [{"tipo": "flat", "recall": 1.0, "ms_por_consulta": round(ms_flat, 4)}]
+    for tipo in ("ivf_flat", "ivf_pq"):
+        index = _construir_indice_faiss(embeddings, tipo)
+        if not _es_ivf(index):
+            continue
+        for nprobe in nprobes:
+            if nprobe > _indice_base(index).nlist:
+                break
+            I, ms = medir(index, nprobe=nprobe)
+            puntos.append({"tipo": tipo, "nprobe": nprobe, "recall": round(recall(I), 4), "ms_por_consulta": round(ms, 4)})
+    index = _construir_indice_faiss(embeddings, "hnsw")
+    for ef in ef_searches:
+        I, ms = medir(index, ef_search=ef)
+        puntos.append({"tipo": "hnsw", "ef_search": ef, "recall": round(recall(I), 4), "ms_por_consulta": round(ms, 4)})
+    return {"vectores": n, "k": k, "consultas": len(consultas), "puntos": puntos}
+
+# ========== ALMACÉN DE CHUNKS EN DISCO (MMAP) ==========
+class ChunkStore:
+    """
+    Lectura de chunks sin parsear JSON. `doc_chunks.idx` guarda N+1 offsets uint64 little-endian,
+    `doc_chunks.ids` los N IDs estables (int64, crecientes) y `doc_chunks.bin` el texto UTF-8 de
+    todos los chunks concatenado. Se abren con mmap de solo lectura, así que los workers comparten
+    las páginas del page cache. Las búsquedas lo toman con `adquirir`/`liberar`; al reemplazarlo
+    otra generación, `retirar` lo cierra cuando lo suelta la última.
+    """
+    def __init__(self, idx_path, blob_path):
+        self._usos = 0
+        self._retirado = False
+        self._al_cerrar = []
+        self._uso_lock = threading.Lock()
+        self.idx_path = idx_path
+        self.blob_path = blob_path
+        self.firma = ChunkStore.firma_de(idx_path)
+        self._idx_file = open(idx_path, "rb")
+        self._blob_file = open(blob_path, "rb")
+        self._idx_map = mmap.mmap(self._idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        blob_size = os.fstat(self._blob_file.fileno()).st_size
+        self._blob_map = mmap.mmap(self._blob_file.fileno(), 0, access=mmap.ACCESS_READ) if blob_size else b""
+        self.offsets = np.frombuffer(self._idx_map, dtype="<u8")
+        self.total = len(self.offsets) - 1
+        ids_path = ChunkStore.ruta_ids(idx_path)
+        self.ids = np.fromfile(ids_path, dtype="<i8") if os.path.exists(ids_path) else np.arange(len(self), dtype="<i8")
+
+    @staticmethod
+    def ruta_ids(idx_path):
+        return os.path.splitext(idx_path)[0] + ".ids"
+
+    @staticmethod
+    def firma_de(idx_path):
+        st = os.stat(idx_path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    def escribir(chunks, ids, idx_path, blob_path):
+        """Escribe el almacén de forma atómica (archivo temporal + rename); el índice se publica al final."""
+        offsets = [0]
+        ids_path = ChunkStore.ruta_ids(idx_path)
+        tmp_blob, tmp_idx, tmp_ids = f"{blob_path}.tmp", f"{idx_path}.tmp", f"{ids_path}.tmp"
+        with open(tmp_blob, "wb") as f:
+            posicion = 0
+            for chunk in chunks:
+                datos = chunk.encode("utf-8")
+                f.write(datos)
+                posicion += len(datos)
+                offsets.append(posicion)
+        with open(tmp_idx, "wb") as f:
+            f.write(np.asarray(offsets, dtype="<u8").tobytes())
+        with open(tmp_ids, "wb") as f:
+            f.write(np.asarray(ids, dtype="<i8").tobytes())
+        os.replace(tmp_blob, blob_path)
+        os.replace(tmp_ids, ids_path)
+        os.replace(tmp_idx, idx_path)
+
+    def __len__(self):
+        return self.total
+
+    def get(self, i):
+        inicio, fin = int(self.offsets[i]), int(self.offsets[i + 1])
+        return bytes(self._blob_map[inicio:fin]).decode("utf-8")
+
+    def posicion_de(self, chunk_id):
+        """Posición del chunk con ese ID (búsqueda binaria), o None si no existe."""
+        pos = int(np.searchsorted(self.ids, chunk_id))
+        if pos < len(self.ids) and self.ids[pos] == chunk_id:
+            return pos
+        return None
+
+    def get_por_id(self, chunk_id):
+        pos = self.posicion_de(chunk_id)
+        return None if pos is None else self.get(pos)
+
+    def adquirir(self):
+        with self._uso_lock:
+            self._usos += 1
+
+    def liberar(self):
+        with self._uso_lock:
+            self._usos -= 1
+            cerrar = self._retirado and not self._usos
+        if cerrar:
+            self.close()
+
+    def retirar(self, *recursos):
+        """Marca el almacén como reemplazado; se cierra (junto con `recursos`) en cuanto nadie lo use."""
+        with self._uso_lock:
+            self._retirado = True
+            self._al_cerrar.extend(r for r in recursos if r is not None)
+            cerrar = not self._usos
+        if cerrar:
+            self.close()
+
+    def close(self):
+        self.offsets = None
+        self._idx_map.close()
+        if not isinstance(self._blob_map, bytes):
+            self._blob_map.close()
+        self._idx_file.close()
+        self._blob_file.close()
+        for recurso in self._al_cerrar:
+            recurso.close()
+        self._al_cerrar = []
+
+def _rutas_chunk_store():
+    """Rutas del almacén heredado en la raíz de DATA_DIR (anterior a las generaciones)."""
+    return (
+        os.path.join(app.config["DATA_DIR"], app.config["CHUNK_STORE_INDEX"]),
+        os.path.join(app.config["DATA_DIR"], app.config["CHUNK_STORE_BLOB"]),
+    )
+
+def _migrar_chunks_json_a_store():
+    """Construye el almacén binario heredado una sola vez a partir de un doc_chunks.json."""
+    idx_path, blob_path = _rutas_chunk_store()
+    chunks_path = os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_CHUNKS"])
+    if os.path.exists(idx_path) or not os.path.exists(chunks_path):
+        return
+    try:
+        with open(chunks_path, 'r') as f:
+            chunks = json.load(f)
+        # Los chunks heredados no tienen ID propio: su ID es su posición, como en el índice plano.
+        ChunkStore.escribir(chunks, range(len(chunks)), idx_path, blob_path)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error al migrar {chunks_path} al almacén binario: {e}")
+
+def _abrir_store_heredado():
+    _migrar_chunks_json_a_store()
+    idx_path, blob_path = _rutas_chunk_store()
+    if not os.path.exists(idx_path):
+        return None
+    return ChunkStore(idx_path, blob_path)
+
+# ========== ÍNDICE INVERTIDO BM25 ==========
+_PATRON_TOKEN = re.compile(r"\w+")
+
+def _tokenizar(texto):
+    """Minúsculas y sin acentos, para que 'Imix', 'IMIX' e 'ímix' coincidan; se conservan los números (tonos)."""
+    plano = "".join(c for c in unicodedata.normalize("NFKD", texto.casefold()) if not unicodedata.combining(c))
+    return [t for t in _PATRON_TOKEN.findall(plano) if len(t) > 1 or t.isdigit()]
+
+class _ConstructorBM25:
+    """Acumula postings mientras se escribe el almacén de chunks de una generación."""
+    def __init__(self):
+        self.postings = {}
+        self.longitudes = []
+
+    def agregar(self, texto):
+        posicion = len(self.longitudes)
+        tokens = _tokenizar(texto)
+        self.longitudes.append(len(tokens))
+        for termino, tf in Counter(tokens).items():
+            self.postings.setdefault(termino, []).append((posicion, tf))
+        return texto
+
+    def escribir(self, directorio):
+        """Postings compactos: vocabulario ordenado, offsets por término y arreglos planos de docs/tf."""
+        vocabulario = sorted(self.postings)
+        offsets = np.zeros(len(vocabulario) + 1, dtype=np.int64)
+        np.cumsum([len(self.postings[t]) for t in vocabulario], out=offsets[1:])
+        docs = np.fromiter((d for t in vocabulario for d, _ in self.postings[t]), dtype=np.int32, count=int(offsets[-1]))
+        tfs = np.fromiter((min(tf, 65535) for t in vocabulario for _, tf in self.postings[t]), dtype=np.uint16, count=int(offsets[-1]))
+        with open(os.path.join(directorio, "bm25_vocab.json"), 'w') as f:
+            json.dump(vocabulario, f)
+        np.save(os.path.join(directorio, "bm25_offsets.npy"), offsets)
+        np.save(os.path.join(directorio, "bm25_docs.npy"), docs)
+        np.save(os.path.join(directorio, "bm25_tf.npy"), tfs)
+        np.save(os.path.join(directorio, "bm25_longitudes.npy"), np.asarray(self.longitudes, dtype=np.int32))
+
+class IndiceBM25:
+    """Índice BM25 de solo lectura de una generación; los postings se leen con mmap."""
+    def __init__(self, directorio):
+        with open(os.path.join(directorio, "bm25_vocab.json"), 'r') as f:
+            self.vocabulario = {t: i for i, t in enumerate(json.load(f))}
+        self.offsets = np.load(os.path.join(directorio, "bm25_offsets.npy"), mmap_mode="r")
+        self.docs = np.load(os.path.join(directorio, "bm25_docs.npy"), mmap_mode="r")
+        self.tfs = np.load(os.path.join(directorio, "bm25_tf.npy"), mmap_mode="r")
+        self.longitudes = np.load(os.path.join(directorio, "bm25_longitudes.npy"))
+        self.n = len(self.longitudes)
+        self.promedio = float(self.longitudes.mean()) if self.n else 0.0
+
+    def close(self):
+        # Un memmap de numpy no tiene close: su mmap se libera al soltar la última referencia.
+        self.offsets = self.docs = self.tfs = None
+
+    def buscar(self, terminos, k, permitidos=None):
+        """
+        Devuelve hasta k tuplas (posición, puntaje, términos coincidentes) ordenadas por puntaje.
+        `permitidos` es una máscara booleana por posición (filtro por archivo).
+        """
+        if not self.n or not self.promedio:
+            return []
+        k1, b = app.config["RAG_BM25_K1"], app.config["RAG_BM25_B"]
+        puntajes = np.zeros(self.n, dtype=np.float32)
+        coincidencias = np.zeros(self.n, dtype=np.int16)
+        for termino in set(terminos):
+            i = self.vocabulario.get(termino)
+            if i is None:
+                continue
+            docs = self.docs[self.offsets[i]:self.offsets[i + 1]]
+            tf = self.tfs[self.offsets[i]:self.offsets[i + 1]].astype(np.float32)
+            idf = np.log1p((self.n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norma = k1 * (1 - b + b * self.longitudes[docs] / self.promedio)
+            puntajes[docs] += idf * tf * (k1 + 1) / (tf + norma)
+            coincidencias[docs] += 1
+        if permitidos is not None:
+            puntajes[~permitidos] = 0
+        candidatos = np.flatnonzero(puntajes)
+        mejores = candidatos[np.argsort(-puntajes[candidatos], kind="stable")[:k]]
+        return [(int(p), float(puntajes[p]), int(coincidencias[p])) for p in mejores]
+
+# ========== GENERACIONES DEL ÍNDICE COMPARTIDAS ENTRE WORKERS ==========
+# Cada generación es un directorio inmutable en RAG_INDEX_DIR con el índice FAISS, el almacén de
+# chunks y el mapa chunk -> archivo. El archivo CURRENT apunta a la vigente y se reemplaza de forma
+# atómica. Todos los workers abren la generación vigente con mmap, así el índice vive una sola vez
+# en el page cache sin importar cuántos workers haya (ver `_leer_indice_mapeado`).
+indice_servido = {"generacion": None, "revisado": 0.0, "bm25": None, "archivo_de_chunk": None, "pagina_de_chunk": None, "file_ids": [], "nombres": {}}
+
+def _ruta_puntero():
+    return os.path.join(app.config["RAG_INDEX_DIR"], "CURRENT")
+
+def _generacion_actual():
+    try:
+        with open(_ruta_puntero(), 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _ruta_en_generacion(generacion, archivo):
+    return os.path.join(app.config["RAG_INDEX_DIR"], generacion, archivo)
+
+def publicar_generacion(index, textos, ids, chunk_map, nombres=None, paginas=None):
+    """
+    Escribe una generación completa (FAISS, chunks, BM25, mapa de archivos y páginas) en un
+    directorio temporal, la renombra y mueve CURRENT. Se reescribe entera en cada sincronización,
+    sin segmentos ni deltas: FAISS solo sabe escribir el índice completo, y las estadísticas de
+    BM25 y las posiciones de los chunks cambian con cualquier alta o baja. Así cada generación es un
+    directorio autocontenido que se poda con un rmtree y se sube tal cual como snapshot. El costo
+    (tiempo y bytes) queda en las métricas y en el benchmark.
+    """
+    os.makedirs(app.config["RAG_INDEX_DIR"], exist_ok=True)
+    generacion = f"{int(time.time() * 1000):013d}-{os.getpid()}"
+    tmp_dir = os.path.join(app.config["RAG_INDEX_DIR"], f".{generacion}.tmp")
+    os.makedirs(tmp_dir)
+    with metricas.cronometrar("index_publish"):
+        if index is not None:
+            faiss.write_index(index, os.path.join(tmp_dir, app.config["GCS_BLOB_NAME_FAISS"]))
+        bm25 = _ConstructorBM25()
+        ChunkStore.escribir(
+            (bm25.agregar(texto or "") for texto in textos), ids,
+            os.path.join(tmp_dir, app.config["CHUNK_STORE_INDEX"]),
+            os.path.join(tmp_dir, app.config["CHUNK_STORE_BLOB"]),
+        )
+        bm25.escribir(tmp_dir)
+        file_ids = sorted(set(chunk_map))
+        posicion = {f_id: i for i, f_id in enumerate(file_ids)}
+        np.save(os.path.join(tmp_dir, "chunk_files.npy"), np.asarray([posicion[f_id] for f_id in chunk_map], dtype=np.int32))
+        np.save(os.path.join(tmp_dir, "chunk_pages.npy"), _arreglo_de_paginas(paginas, len(chunk_map)))
+        with open(os.path.join(tmp_dir, "generacion.json"), 'w') as f:
+            json.dump({
+                "generacion": generacion,
+                "creada": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "total": len(chunk_map),
+                "tipo_indice": app.config["RAG_INDEX_TYPE"],
+                "file_ids": file_ids,
+                "nombres": {f_id: (nombres or {}).get(f_id) for f_id in file_ids},
+            }, f)
+    escritos = sum(e.stat().st_size for e in os.scandir(tmp_dir))
+    metricas.fijar("rag_index_generation_bytes", escritos, ayuda="Bytes escritos al publicar la última generación del índice.")
+
+    os.rename(tmp_dir, os.path.join(app.config["RAG_INDEX_DIR"], generacion))
+    with open(f"{_ruta_puntero()}.tmp", 'w') as f:
+        f.write(generacion)
+    os.replace(f"{_ruta_puntero()}.tmp", _ruta_puntero())
+    print(f"  -> Generación {generacion} del índice publicada ({len(chunk_map)} chunks, {escritos / 2**20:.1f} MB).")
+    _podar_generaciones(generacion)
+    return generacion
+
+def _arreglo_de_paginas(paginas, total):
+    """Páginas de origen como int32, con 0 para los chunks sin página (DOCX, texto o heredados)."""
+    if paginas is None:
+        return np.zeros(total, dtype=np.int32)
+    return np.asarray([p or 0 for p in paginas], dtype=np.int32)
+
+def _podar_generaciones(vigente):
+    # Borrar una generación que otro worker aún tiene mapeada es seguro: el mmap conserva el inode.
+    generaciones = sorted(d for d in os.listdir(app.config["RAG_INDEX_DIR"]) if not d.startswith(".") and d != "CURRENT" and d != vigente)
+    for viejo in generaciones[:max(0, len(generaciones) - (app.config["RAG_GENERATIONS_TO_KEEP"] - 1))]:
+        shutil.rmtree(os.path.join(app.config["RAG_INDEX_DIR"], viejo), ignore_errors=True)
+
+def _leer_indice_mapeado(faiss_path):
+    """
+    Lee el índice servido sin copiar sus vectores. IO_FLAG_MMAP solo mapea las listas invertidas de
+    los IVF (el flat y el HNSW se copiaban enteros a cada worker); IO_FLAG_MMAP_IFC deja apuntando
+    al archivo mapeado los vectores de flat, IVF-Flat, IVF-PQ y HNSW. Cada worker conserva en RAM
+    propia solo los IDs y el mapa inverso del IndexIDMap2 y, en IVF-PQ, las tablas precalculadas
+    de distancias. El índice queda de solo lectura.
+    """
+    try:
+        return faiss.read_index(faiss_path, getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP))
+    except RuntimeError:
+        return faiss.read_index(faiss_path)
+
+def _abrir_generacion(generacion):
+    """Abre índice (mmap), almacén de chunks, BM25 y mapa de archivos de una generación."""
+    faiss_path = _ruta_en_generacion(generacion, app.config["GCS_BLOB_NAME_FAISS"])
+    index = _leer_indice_mapeado(faiss_path) if os.path.exists(faiss_path) else None
+    store = ChunkStore(
+        _ruta_en_generacion(generacion, app.config["CHUNK_STORE_INDEX"]),
+        _ruta_en_generacion(generacion, app.config["CHUNK_STORE_BLOB"]),
+    )
+    with open(_ruta_en_generacion(generacion, "generacion.json"), 'r') as f:
+        meta = json.load(f)
+    file_ids = meta["file_ids"]
+    archivo_de_chunk = np.load(_ruta_en_generacion(generacion, "chunk_files.npy"))
+    mapa = [file_ids[i] for i in archivo_de_chunk]
+    # Las generaciones anteriores al índice léxico se sirven solo con búsqueda vectorial.
+    bm25 = IndiceBM25(_ruta_en_generacion(generacion, "")) if os.path.exists(_ruta_en_generacion(generacion, "bm25_vocab.json")) else None
+    ruta_paginas = _ruta_en_generacion(generacion, "chunk_pages.npy")
+    pagina_de_chunk = np.load(ruta_paginas) if os.path.exists(ruta_paginas) else np.zeros(len(archivo_de_chunk), dtype=np.int32)
+    extras = {"bm25": bm25, "archivo_de_chunk": archivo_de_chunk, "pagina_de_chunk": pagina_de_chunk, "file_ids": file_ids, "nombres": meta.get("nombres", {})}
+    return index, store, mapa, extras
+
+_apertura_lock = threading.Lock()
+
+def refrescar_generacion(forzar=False):
+    """
+    Cambia en caliente a la generación vigente si otro proceso publicó una nueva. El puntero se
+    consulta como mucho cada RAG_GENERATION_POLL_SECONDS (salvo con `forzar`). La revisión y la
+    apertura van bajo `_apertura_lock`, así peticiones concurrentes abren cada generación una sola vez.
+    """
+    global faiss_index, doc_chunks, chunk_to_file_id
+    if not forzar and time.monotonic() - indice_servido["revisado"] < app.config["RAG_GENERATION_POLL_SECONDS"]:
+        return
+    with _apertura_lock:
+        ahora = time.monotonic()
+        # Otro hilo pudo revisar mientras se esperaba el lock.
+        if not forzar and ahora - indice_servido["revisado"] < app.config["RAG_GENERATION_POLL_SECONDS"]:
+            return
+        indice_servido["revisado"] = ahora
+        generacion = _generacion_actual()
+        if generacion is None or generacion == indice_servido["generacion"]:
+            return
+        try:
+            index, store, mapa, extras = _abrir_generacion(generacion)
+        except (OSError, RuntimeError, ValueError, KeyError) as e:
+            print(f"Error al abrir la generación {generacion} del índice: {e}")
+            return
+        with index_lock:
+            anterior, bm25_anterior = doc_chunks, indice_servido["bm25"]
+            faiss_index, doc_chunks, chunk_to_file_id = index, store, mapa
+            indice_servido.update(extras, generacion=generacion)
+    # Las búsquedas en curso sobre la generación anterior la terminan; después se cierran sus mmap.
+    if isinstance(anterior, ChunkStore):
+        anterior.retirar(bm25_anterior)
+    metricas.fijar("rag_index_chunks", len(store), ayuda="Chunks de la generación del índice en servicio.")
+    metricas.fijar("rag_index_vectors", index.ntotal if index is not None else 0, ayuda="Vectores en el índice FAISS en servicio.")
+    # Los resultados de la generación anterior ya no se pueden consultar; se libera su memoria.
+    search_result_cache.clear()
+    print(f"Generación {generacion} del índice en servicio ({len(store)} chunks).")
+
+def get_chunk_store():
+    """Almacén de chunks de la generación en servicio, o None si aún no hay ninguna."""
+    refrescar_generacion()
+    store = doc_chunks
+    return store if isinstance(store, ChunkStore) else None
+
+# ========== SINCRONIZACIÓN (SOLO EL WORKER LÍDER) ==========
+_lider_lock_file = None
+_sync_en_curso = threading.Lock()
+
+def _es_lider():
+    """Intenta tomar (una sola vez por proceso) el lock exclusivo de sincronización en disco."""
+    global _lider_lock_file
+    if _lider_lock_file is not None:
+        return True
+    os.makedirs(os.path.dirname(app.config["RAG_SYNC_LOCK_FILE"]) or ".", exist_ok=True)
+    f = open(app.config["RAG_SYNC_LOCK_FILE"], "a+")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    _lider_lock_file = f
+    return True
+
+def background_intelligent_sync(reconstruir=False):
+    if not _es_lider():
+        print("Otro worker es el dueño de la sincronización. Este worker sirve la generación publicada.")
+        refrescar_generacion(forzar=True)
+        return
+    if not _sync_en_curso.acquire(blocking=False):
+        print("Ya hay una sincronización en curso en este worker.")
+        return
+    reiniciar_progreso_sync()
+    metricas.fijar("rag_sync_running", 1, ayuda="1 mientras hay una sincronización en curso en este worker.")
+    resultado = "error"
+    try:
+        with metricas.cronometrar("rag_sync"):
+            _sincronizar_como_lider(reconstruir)
+        resultado = "success"
+        metricas.fijar("rag_sync_last_success_timestamp_seconds", time.time(), ayuda="Fin de la última sincronización exitosa.")
+    except Exception as e:
+        # El estado y el token de Drive solo avanzan al final: la próxima sincronización retoma desde el checkpoint.
+        print(f"Error en la sincronización del índice RAG ({type(e).__name__}: {e}). Se reintentará en la próxima.")
+    finally:
+        metricas.fijar("rag_sync_running", 0)
+        metricas.incrementar("rag_sync_runs_total", ayuda="Sincronizaciones ejecutadas por resultado.", result=resultado)
+        _sync_en_curso.release()
+
+def _sincronizar_como_lider(reconstruir=False):
+    """
+    Lleva el índice al estado actual de Drive. Con `reconstruir` se descarta el estado previo
+    (sin restaurar snapshots ni usar el checkpoint o la caché de embeddings), se reprocesan todos
+    los archivos y el índice se construye desde cero; la generación en servicio sigue respondiendo
+    hasta que se publica la nueva.
+    """
+    global rag_state
+    print("Iniciando reconstrucción completa del índice RAG..." if reconstruir else "Iniciando sincronización inteligente del índice RAG...")
+    # Sin estado en el disco (instancia nueva): se restaura el último snapshot de la bóveda antes
+    # de hablar con Drive, así la instancia sirve búsquedas sin volver a embeber nada.
+    if not reconstruir and not os.path.exists(_ruta_manifiesto()) and not os.path.exists(app.config["RAG_STATE_FILE"]):
+        print("  -> No se encontró un cerebro local en el disco.")
+        if not restaurar_snapshot() and app.config["GCS_BUCKET_NAME"]:
+            # Bóvedas anteriores a los snapshots: estado JSON + chunks, que se migran al cargar.
+            if _download_from_gcs(app.config["GCS_BLOB_NAME_STATE"], app.config["RAG_STATE_FILE"]):
+                _download_from_gcs(app.config["GCS_BLOB_NAME_CHUNKS"], os.path.join(app.config["DATA_DIR"], app.config["GCS_BLOB_NAME_CHUNKS"]))
+    service = _get_drive_service()
+    if not service: return
+
+    rag_state = _load_rag_state()
+    refrescar_generacion(forzar=True)
+    rag_state["next_id"] = _siguiente_id_libre(rag_state)
+    if reconstruir:
+        rag_state = _estado_rag_vacio(next_id=rag_state["next_id"])
+        _borrar_checkpoint()
+    else:
+        _asegurar_generacion_del_estado()
+
+    processed_files = rag_state.get("files", {})
+    
+    # Sin token ni carpetas conocidas se hace un escaneo completo del árbol.
+    estado_drive = {} if reconstruir else _leer_estado_drive()
+    cambios = _detectar_cambios_drive(service, estado_drive, processed_files)
+    if cambios is None:
+        cambios = _detectar_cambios_por_escaneo(service, estado_drive, processed_files)
+    files_to_add_or_update, deleted_ids = cambios
+    avanzar_sync("listed", len(files_to_add_or_update))
+    print("--> Ahora, comenzando el análisis para procesar los archivos...")
+
+    if deleted_ids:
+        print(f"  [ELIMINADO] Se eliminarán {len(deleted_ids)} archivos del índice.")
+
+    if not reconstruir and not files_to_add_or_update and not deleted_ids:
+        _refrescar_drive_file_index()
+        _guardar_estado_drive(estado_drive)
+        print("Sincronización finalizada. No se encontraron cambios.")
+        publicar_snapshot()
+        return
+
+    # Los chunks de archivos eliminados o modificados se retiran en una sola pasada.
+    archivos_a_retirar = deleted_ids | {f["id"] for f in files_to_add_or_update if f["id"] in processed_files}
+    ids_retirados = _retirar_chunks_de_archivos(archivos_a_retirar)
+    for file_id in deleted_ids:
+        if file_id in rag_state["files"]:
+            del rag_state["files"][file_id]
+
+    nuevos_ids, nuevos_vectores, nuevos_textos, nuevos_map, nuevas_paginas = [], [], [], [], []
+    checkpoint = _leer_checkpoint()
+    cache_antes = document_embedding_cache.estadisticas()
+    en_vuelo = deque()
+    lotes_en_vuelo = 0
+
+    def registrar_lote(file_id, chunks, paginas, embeddings):
+        for chunk, pagina, embedding in zip(chunks, paginas, embeddings):
+            if embedding:
+                nuevos_ids.append(rag_state["next_id"])
+                rag_state["next_id"] += 1
+                nuevos_vectores.append(embedding)
+                nuevos_textos.append(chunk)
+                nuevos_map.append(file_id)
+                nuevas_paginas.append(pagina)
+
+    def marcar_procesado(file_info):
+        rag_state["files"][file_info['id']] = {"name": file_info["name"], "modifiedTime": file_info["modifiedTime"], "status": "processed"}
+        avanzar_sync("embedded")
+
+    def drenar_mas_antiguo():
+        nonlocal lotes_en_vuelo
+        file_info, numero, chunks, paginas, pendiente = en_vuelo.popleft()
+        if pendiente is None:
+            # Fin del archivo: todos sus lotes ya están anotados.
+            _cerrar_checkpoint(file_info['id'], file_info["modifiedTime"], numero)
+            marcar_procesado(file_info)
+            return
+        lotes_en_vuelo -= len(pendiente["futures"])
+        embeddings = recoger_embeddings_documento(pendiente)
+        _anotar_checkpoint(file_info['id'], file_info["modifiedTime"], numero, chunks, paginas, embeddings)
+        registrar_lote(file_info['id'], chunks, paginas, embeddings)
+
+    por_descargar = []
+    for file_info in files_to_add_or_update:
+        file_id = file_info['id']
+        
+        mime_type = file_info.get('mimeType', '')
+        supported_mimes = [
+            'application/pdf',
+            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+            'text/plain', 'text/csv',
+            'application/vnd.google-apps.document'
+        ]
+        
+        if not any(supported in mime_type for supported in supported_mimes):
+            print(f"  -> Omitiendo y recordando archivo no soportado: {file_info['name']} (Tipo: {mime_type})")
+            rag_state["files"][file_id] = {"name": file_info["name"], "modifiedTime": file_info["modifiedTime"], "status": "omitted"}
+            continue
+
+        previo = checkpoint.get(file_id)
+        if previo and previo["modifiedTime"] == file_info["modifiedTime"]:
+            print(f"  -> Reanudando desde el checkpoint: {file_info['name']}")
+            registrar_lote(file_id, previo["chunks"], previo["pages"], previo["embeddings"])
+            marcar_procesado(file_info)
+            continue
+
+        por_descargar.append(file_info)
+
+    for file_info, lotes in _chunks_en_pipeline(por_descargar):
+        numero = 0
+        for fragmentos in lotes:
+            if numero == 0:
+                print(f"  -> Procesando chunks para: {file_info['name']}")
+            chunks = [chunk for chunk, _ in fragmentos]
+            paginas = [pagina for _, pagina in fragmentos]
+            pendiente = enviar_embeddings_documento(chunks, usar_cache=not reconstruir)
+            en_vuelo.append((file_info, numero, chunks, paginas, pendiente))
+            numero += 1
+            lotes_en_vuelo += len(pendiente["futures"])
+            # Contrapresión: no se extraen más lotes mientras haya demasiados lotes de embeddings pendientes.
+            while lotes_en_vuelo > 2 * app.config['EMBEDDING_MAX_IN_FLIGHT'] and len(en_vuelo) > 1:
+                drenar_mas_antiguo()
+        if numero:
+            en_vuelo.append((file_info, numero, None, None, None))
+        else:
+            rag_state["files"][file_info['id']] = {"name": file_info["name"], "modifiedTime": file_info["modifiedTime"], "status": "no_text"}
+
+    while en_vuelo:
+        drenar_mas_antiguo()
+    document_embedding_cache.compactar()
+    cache_despues = document_embedding_cache.estadisticas()
+    aciertos = cache_despues["aciertos"] - cache_antes["aciertos"]
+    consultados = aciertos + cache_despues["fallos"] - cache_antes["fallos"]
+    if consultados:
+        print(f"  -> Caché de embeddings de documentos: {aciertos}/{consultados} chunks reutilizados ({aciertos / consultados:.0%}).")
+    metricas.fijar("rag_sync_embedding_cache_hit_ratio", aciertos / consultados if consultados else 0,
+                   ayuda="Fracción de chunks de la última sincronización resueltos por la caché de embeddings.")
+
+    _anexar_chunks(nuevos_ids, nuevos_vectores, nuevos_map, nuevas_paginas)
+    indice = _aplicar_cambios_al_indice(ids_retirados, nuevos_ids, nuevos_vectores, desde_cero=reconstruir)
+    _publicar_generacion_del_estado(indice, dict(zip(nuevos_ids, nuevos_textos)))
+    _refrescar_drive_file_index()
+    # El token del feed solo avanza cuando los cambios ya quedaron persistidos.
+    _guardar_estado_drive(estado_drive)
+    _borrar_checkpoint()
+    publicar_snapshot()
+
+def _siguiente_id_libre(estado):
+    """
+    Primer ID de chunk sin usar ni por el estado ni por la generación en servicio. Cubre los estados
+    perdidos o reiniciados (next_id en 0) mientras se sirve un IndexIDMap2 con esos IDs.
+    """
+    store = get_chunk_store()
+    servido = int(store.ids[-1]) + 1 if store is not None and len(store.ids) else 0
+    return max(estado.get("next_id", 0), servido)
+
+def _refrescar_drive_file_index():
+    """Archivos de Drive conocidos por el estado (procesados, omitidos o sin texto), para /rag/status."""
+    global drive_file_index
+    drive_file_index = [{"id": file_id, **info} for file_id, info in rag_state["files"].items()]
+
+def _ruta_manifiesto():
+    return os.path.join(app.config["RAG_STATE_DIR"], "manifest.json")
+
+def _sha256_archivo(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+def _load_rag_state():
+    """
+    Carga el estado binario: los vectores se abren con `np.load(mmap_mode="r")`, así el arranque
+    no lee el arreglo completo y las páginas se comparten entre procesos. Si solo existe el
+    estado JSON heredado, se migra una vez al formato binario.
+    """
+    manifest_path = _ruta_manifiesto()
+    if not os.path.exists(manifest_path):
+        return _migrar_estado_json()
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != 1:
+            raise ValueError(f"versión de formato desconocida: {manifest.get('format_version')}")
+        rutas = {}
+        for nombre, artefacto in manifest["artefactos"].items():
+            ruta = os.path.join(app.config["RAG_STATE_DIR"], artefacto["archivo"])
+            if os.path.getsize(ruta) != artefacto["bytes"]:
+                raise ValueError(f"tamaño inesperado en {artefacto['archivo']}")
+            if app.config["RAG_VERIFY_CHECKSUMS"] and _sha256_archivo(ruta) != artefacto["sha256"]:
+                raise ValueError(f"checksum inválido en {artefacto['archivo']}")
+            rutas[nombre] = ruta
+        vectors = np.load(rutas["vectors"], mmap_mode="r")
+        chunk_ids = np.load(rutas["chunk_ids"], mmap_mode="r")
+        indices_archivo = np.load(rutas["chunk_map"])
+        # Los manifiestos anteriores a la procedencia por página no traen chunk_pages.
+        paginas = np.load(rutas["chunk_pages"]) if "chunk_pages" in rutas else np.zeros(len(indices_archivo), dtype=np.int32)
+    except (OSError, ValueError, KeyError, json.JSONDecodeError) as e:
+        print(f"Error al cargar el estado binario del RAG ({e}). Se partirá de un estado vacío.")
+        return _estado_rag_vacio()
+    file_ids = manifest["file_ids"]
+    return {
+        "files": manifest["files"],
+        "vectors": vectors,
+        "chunk_ids": chunk_ids,
+        "chunk_map": [file_ids[i] for i in indices_archivo],
+        "chunk_pages": [int(p) or None for p in paginas],
+        "next_id": manifest["next_id"],
+        "generacion": manifest["generacion"],
+        "generacion_indice": manifest.get("generacion_indice"),
+    }
+
+def _migrar_estado_json():
+    try:
+        with open(app.config["RAG_STATE_FILE"], 'r') as f:
+            legado = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return _estado_rag_vacio()
+    print("  -> Migrando rag_index_state.json al formato binario...")
+    chunks = legado.get("chunks", [])
+    ids = legado.get("chunk_ids") or list(range(len(chunks)))
+    state = {
+        "files": legado.get("files", {}),
+        "vectors": np.asarray(legado.get("embeddings", []), dtype=np.float32).reshape(len(chunks), -1) if chunks else np.zeros((0, 0), dtype=np.float32),
+        "chunk_ids": np.asarray(ids, dtype=np.int64),
+        "chunk_map": legado.get("chunk_map", []),
+        "chunk_pages": [None] * len(chunks),
+        "next_id": legado.get("next_id", len(chunks)),
+    }
+    idx_path, blob_path = _rutas_chunk_store()
+    if not os.path.exists(idx_path):
+        ChunkStore.escribir(chunks, ids, idx_path, blob_path)
+    _save_rag_state(state)
+    os.replace(app.config["RAG_STATE_FILE"], f"{app.config['RAG_STATE_FILE']}.migrado")
+    return _load_rag_state()
+
+def _save_rag_state(state):
+    """
+    Escribe una nueva generación: cada arreglo va a un archivo propio con la generación en el
+    nombre (temp + rename) y el manifiesto, que es lo único que los lectores consultan primero,
+    se reemplaza al final. Luego se borran los archivos de generaciones anteriores.
+    """
+    directorio = app.config["RAG_STATE_DIR"]
+    os.makedirs(directorio, exist_ok=True)
+    generacion = state.get("generacion", 0) + 1
+
+    file_ids = sorted(set(state["chunk_map"]))
+    posicion = {f_id: i for i, f_id in enumerate(file_ids)}
+    arreglos = {
+        "vectors": np.asarray(state["vectors"], dtype=app.config["RAG_VECTOR_DTYPE"]),
+        "chunk_ids": np.asarray(state["chunk_ids"], dtype=np.int64),
+        "chunk_map": np.asarray([posicion[f_id] for f_id in state["chunk_map"]], dtype=np.int32),
+        "chunk_pages": _arreglo_de_paginas(state.get("chunk_pages"), len(state["chunk_map"])),
+    }
+    artefactos = {}
+    for nombre, arreglo in arreglos.items():
+        archivo = f"{nombre}.{generacion}.npy"
+        ruta = os.path.join(directorio, archivo)
+        with open(f"{ruta}.tmp", "wb") as f:
+            np.save(f, arreglo)
+        os.replace(f"{ruta}.tmp", ruta)
+        artefactos[nombre] = {"archivo": archivo, "bytes": os.path.getsize(ruta), "sha256": _sha256_archivo(ruta)}
+
+    vectors = arreglos["vectors"]
+    manifest = {
+        "format_version": 1,
+        "generacion": generacion,
+        "creado": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "dtype": str(vectors.dtype),
+        "dimension": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+        "total": int(len(arreglos["chunk_ids"])),
+        "next_id": state["next_id"],
+        "generacion_indice": state.get("generacion_indice"),
+        "files": state["files"],
+        "file_ids": file_ids,
+        "artefactos": artefactos,
+    }
+    manifest_path = _ruta_manifiesto()
+    with open(f"{manifest_path}.tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    state["generacion"] = generacion
+
+    vigentes = {a["archivo"] for a in artefactos.values()}
+    for archivo in os.listdir(directorio):
+        if archivo.endswith(".npy") and archivo not in vigentes:
+            os.remove(os.path.join(directorio, archivo))
+
+def _retirar_chunks_de_archivos(file_ids):
+    """Quita de `rag_state` los chunks de esos archivos y devuelve sus IDs."""
+    if not file_ids:
+        return []
+    conservar = np.fromiter((f_id not in file_ids for f_id in rag_state["chunk_map"]), dtype=bool, count=len(rag_state["chunk_map"]))
+    retirados = np.asarray(rag_state["chunk_ids"])[~conservar].tolist()
+    rag_state["vectors"] = np.asarray(rag_state["vectors"])[conservar]
+    rag_state["chunk_ids"] = np.asarray(rag_state["chunk_ids"])[conservar]
+    rag_state["chunk_map"] = [f_id for f_id, ok in zip(rag_state["chunk_map"], conservar) if ok]
+    rag_state["chunk_pages"] = [p for p, ok in zip(_paginas_del_estado(), conservar) if ok]
+    return retirados
+
+def _paginas_del_estado():
+    return rag_state.get("chunk_pages") or [None] * len(rag_state["chunk_map"])
+
+def _anexar_chunks(nuevos_ids, nuevos_vectores, nuevos_map, nuevas_paginas):
+    if not nuevos_ids:
+        return
+    nuevos = np.asarray(nuevos_vectores, dtype=np.float32)
+    actuales = rag_state["vectors"]
+    rag_state["vectors"] = np.concatenate([actuales, nuevos.astype(actuales.dtype)]) if len(actuales) else nuevos
+    rag_state["chunk_ids"] = np.concatenate([rag_state["chunk_ids"], np.asarray(nuevos_ids, dtype=np.int64)])
+    rag_state["chunk_pages"] = _paginas_del_estado() + nuevas_paginas
+    rag_state["chunk_map"] = rag_state["chunk_map"] + nuevos_map
+
+def _publicar_generacion_del_estado(indice, nuevos_textos):
+    """
+    Publica una generación con el orden del estado (los textos existentes se copian por ID desde la
+    generación en servicio) y después guarda el estado apuntando a ella. Si el proceso cae entre
+    ambos pasos, la próxima sincronización detecta el desfase y republica desde el estado.
+    """
+    anterior = get_chunk_store() or _abrir_store_heredado()
+    ids = rag_state["chunk_ids"]
+    if anterior is not None:
+        # Los textos sin cambios se copian desde él: no puede cerrarse mientras se publica.
+        anterior.adquirir()
+
+    def texto(c_id):
+        c_id = int(c_id)
+        if c_id in nuevos_textos:
+            return nuevos_textos[c_id]
+        return anterior.get_por_id(c_id) if anterior is not None else None
+
+    nombres = {f_id: info.get("name") for f_id, info in rag_state["files"].items()}
+    try:
+        rag_state["generacion_indice"] = publicar_generacion(indice, (texto(c_id) for c_id in ids), ids, rag_state["chunk_map"], nombres, _paginas_del_estado())
+    finally:
+        if anterior is not None:
+            anterior.liberar()
+    _save_rag_state(rag_state)
+    refrescar_generacion(forzar=True)
+
+def _asegurar_generacion_del_estado():
+    """Republica la generación si no existe o no corresponde al estado guardado (arranque o caída previa)."""
+    global rag_state
+    if not len(rag_state["chunk_ids"]):
+        return
+    actual = _generacion_actual()
+    if (actual is not None and actual == rag_state.get("generacion_indice")
+            and os.path.exists(_ruta_en_generacion(actual, "bm25_vocab.json"))):
+        return
+    if get_chunk_store() is None and _abrir_store_heredado() is None:
+        print("  -> No hay textos para los chunks del estado. Se reprocesarán todos los archivos.")
+        rag_state = _estado_rag_vacio(next_id=rag_state["next_id"])
+        return
+    print("  -> La generación del índice no corresponde al estado guardado (o le falta el índice léxico). Se republica desde el estado.")
+    _publicar_generacion_del_estado(_aplicar_cambios_al_indice([], [], [], desde_cero=True), {})
+
+def _aplicar_cambios_al_indice(ids_retirados, nuevos_ids, nuevos_vectores, desde_cero=False):
+    """
+    Devuelve el índice de la próxima generación. Parte de una copia privada y escribible de la
+    generación vigente (la servida está mapeada en solo lectura) y aplica `remove_ids` de los chunks
+    retirados y `add_with_ids` de los nuevos, con un costo proporcional al cambio. Se reconstruye
+    completo desde el estado si no hay generación, si la generación no es la del estado (estado
+    reiniciado o perdido: sus vectores no son la base correcta), si es un índice heredado sin IDs
+    o si el tipo no admite borrados (HNSW).
+    """
+    generacion = None if desde_cero else _generacion_actual()
+    if generacion is not None and generacion != rag_state.get("generacion_indice"):
+        generacion = None
+    faiss_path = _ruta_en_generacion(generacion, app.config["GCS_BLOB_NAME_FAISS"]) if generacion else None
+    if faiss_path and os.path.exists(faiss_path):
+        indice = faiss.read_index(faiss_path)
+        if _tiene_ids(indice):
+            try:
+                if ids_retirados:
+                    indice.remove_ids(np.asarray(ids_retirados, dtype=np.int64))
+                if nuevos_ids:
+                    indice.add_with_ids(np.asarray(nuevos_vectores, dtype=np.float32), np.asarray(nuevos_ids, dtype=np.int64))
+                print(f"Índice FAISS actualizado de forma incremental (-{len(ids_retirados)} / +{len(nuevos_ids)}). Total chunks: {indice.ntotal}")
+                return indice
+            except RuntimeError as e:
+                print(f"  -> El índice no admite actualización incremental ({e}). Se reconstruirá.")
+
+    if not len(rag_state["chunk_ids"]):
+        print("Índice FAISS vacío tras la actualización.")
+        return None
+    embeddings = np.ascontiguousarray(rag_state["vectors"], dtype=np.float32)
+    indice = _construir_indice_faiss(embeddings, ids=rag_state["chunk_ids"])
+    print(f"Índice FAISS reconstruido exitosamente. Total chunks: {indice.ntotal}")
+    return indice
+
+def force_rebuild_index():
+    if not _es_lider():
+        print("La reconstrucción debe ejecutarla el worker dueño de la sincronización. Se omite.")
+        return
+    print("Forzando reconstrucción completa del índice...")
+    background_intelligent_sync(reconstruir=True)
+
+# ========== SNAPSHOTS DEL ÍNDICE EN LA BÓVEDA (GCS) ==========
+# Disposición en el bucket:
+#   <prefijo>/<generación>/<archivo>.gz   artefactos comprimidos (gzip)
+#   <prefijo>/<generación>/manifest.json  tamaños y SHA-256 (crudo y comprimido); se sube al final
+#   <prefijo>/LATEST                      generación del último snapshot completo
+# La generación del snapshot es la del índice publicado, así que cada snapshot es inmutable.
+
+def _prefijo_snapshot(*partes):
+    return "/".join([app.config["GCS_SNAPSHOT_PREFIX"].strip("/"), *partes])
+
+def _con_reintentos(funcion, intentos=4):
+    """Reintenta errores transitorios de GCS con backoff exponencial."""
+    delay = 0.5
+    for intento in range(1, intentos + 1):
+        try:
+            return funcion()
+        except (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                google_exceptions.TooManyRequests, google_exceptions.DeadlineExceeded, requests.exceptions.ConnectionError):
+            if intento == intentos:
+                raise
+            time.sleep(random.uniform(delay / 2, delay))
+            delay *= 2
+
+def _archivos_del_snapshot():
+    """(ruta local, nombre lógico) de todo lo necesario para servir y seguir sincronizando."""
+    generacion = rag_state.get("generacion_indice")
+    if not generacion or generacion != _generacion_actual() or not os.path.exists(_ruta_manifiesto()):
+        return generacion, []
+    archivos = []
+    directorio = _ruta_en_generacion(generacion, "")
+    for nombre in sorted(os.listdir(directorio)):
+        archivos.append((os.path.join(directorio, nombre), f"index/{nombre}"))
+    with open(_ruta_manifiesto(), 'r') as f:
+        manifest = json.load(f)
+    for artefacto in manifest["artefactos"].values():
+        archivos.append((os.path.join(app.config["RAG_STATE_DIR"], artefacto["archivo"]), f"state/{artefacto['archivo']}"))
+    # El manifiesto del estado va después de sus artefactos: al restaurar se escribe en ese orden.
+    archivos.append((_ruta_manifiesto(), "state/manifest.json"))
+    if os.path.exists(_ruta_estado_drive()):
+        archivos.append((_ruta_estado_drive(), "state/drive_changes.json"))
+    return generacion, archivos
+
+def _subir_comprimido(bucket, generacion, ruta, nombre, tmp_dir):
+    crudo, comprimido = hashlib.sha256(), hashlib.sha256()
+    compresor = zlib.compressobj(app.config["GCS_SNAPSHOT_COMPRESSION_LEVEL"], zlib.DEFLATED, 31)
+    tmp = os.path.join(tmp_dir, nombre.replace("/", "__") + ".gz")
+    with open(ruta, "rb") as origen, open(tmp, "wb") as destino:
+        for bloque in iter(lambda: origen.read(1 << 20), b""):
+            crudo.update(bloque)
+            datos = compresor.compress(bloque)
+            comprimido.update(datos)
+            destino.write(datos)
+        datos = compresor.flush()
+        comprimido.update(datos)
+        destino.write(datos)
+    entrada = {
+        "nombre": nombre,
+        "objeto": _prefijo_snapshot(generacion, f"{nombre}.gz"),
+        "bytes": os.path.getsize(ruta),
+        "bytes_comprimidos": os.path.getsize(tmp),
+        "sha256": crudo.hexdigest(),
+        "sha256_comprimido": comprimido.hexdigest(),
+    }
+    _con_reintentos(lambda: bucket.blob(entrada["objeto"]).upload_from_filename(tmp))
+    os.remove(tmp)
+    return entrada
+
+# Última generación que este proceso sabe que está en la bóveda (evita consultar LATEST en cada sync).
+_snapshot_en_boveda = None
+
+def _snapshot_publicado():
+    try:
+        return json.loads(_con_reintentos(lambda: _gcs_bucket().blob(_prefijo_snapshot("LATEST")).download_as_bytes()))
+    except google_exceptions.NotFound:
+        return None
+
+def publicar_snapshot():
+    """
+    Sube la generación en servicio como snapshot si la bóveda aún no la tiene. Los archivos se
+    comprimen y suben en paralelo; el manifiesto y luego LATEST se escriben al final, así que un
+    snapshot a medias nunca se restaura. Devuelve la generación publicada o None.
+    """
+    global _snapshot_en_boveda
+    if not app.config["GCS_BUCKET_NAME"]:
+        return None
+    generacion, archivos = _archivos_del_snapshot()
+    if not archivos or generacion == _snapshot_en_boveda:
+        return None
+    try:
+        with metricas.cronometrar("snapshot_publish"):
+            bucket = _gcs_bucket()
+            latest = _snapshot_publicado()
+            if latest and latest.get("generacion") == generacion:
+                _snapshot_en_boveda = generacion
+                return None
+            print(f"  -> Publicando el snapshot {generacion} en la bóveda ({len(archivos)} archivos)...")
+            tmp_dir = tempfile.mkdtemp(prefix="snapshot-", dir=app.config["DATA_DIR"])
+            try:
+                with ThreadPoolExecutor(max_workers=app.config["GCS_SNAPSHOT_WORKERS"], thread_name_prefix="snapshot") as pool:
+                    entradas = list(pool.map(lambda a: _subir_comprimido(bucket, generacion, a[0], a[1], tmp_dir), archivos))
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            manifest = {
+                "format_version": 1,
+                "generacion": generacion,
+                "creado": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "modelo_embeddings": app.config["EMBEDDING_MODEL"],
+                "archivos": entradas,
+            }
+            _con_reintentos(lambda: bucket.blob(_prefijo_snapshot(generacion, "manifest.json")).upload_from_string(json.dumps(manifest), content_type="application/json"))
+            _con_reintentos(lambda: bucket.blob(_prefijo_snapshot("LATEST")).upload_from_string(json.dumps({"generacion": generacion}), content_type="application/json"))
+    except Exception as e:
+        print(f"Error al publicar el snapshot en GCS: {e}")
+        return None
+    total = sum(e["bytes"] for e in entradas)
+    comprimido = sum(e["bytes_comprimidos"] for e in entradas)
+    print(f"  -> Snapshot {generacion} publicado ({total / 1e6:.1f} MB, {comprimido / 1e6:.1f} MB comprimidos).")
+    _snapshot_en_boveda = generacion
+    _podar_snapshots(generacion)
+    return generacion
+
+def _podar_snapshots(vigente):
+    try:
+        bucket = _gcs_bucket()
+        por_generacion = {}
+        for blob in bucket.list_blobs(prefix=_prefijo_snapshot("")):
+            partes = blob.name[len(_prefijo_snapshot("")):].split("/", 1)
+            if len(partes) == 2:
+                por_generacion.setdefault(partes[0], []).append(blob)
+        viejas = sorted(g for g in por_generacion if g != vigente)
+        for generacion in viejas[:max(0, len(viejas) - (app.config["GCS_SNAPSHOTS_TO_KEEP"] - 1))]:
+            for blob in por_generacion[generacion]:
+                blob.delete()
+    except Exception as e:
+        print(f"No se pudieron podar los snapshots viejos de GCS: {e}")
+
+def _descargar_parte(bucket, objeto, destino, inicio, fin):
+    datos = _con_reintentos(lambda: bucket.blob(objeto).download_as_bytes(start=inicio, end=fin))
+    fd = os.open(destino, os.O_WRONLY)
+    try:
+        os.pwrite(fd, datos, inicio)
+    finally:
+        os.close(fd)
+
+def _descomprimir_y_verificar(entrada, comprimido, destino):
+    h = hashlib.sha256()
+    with open(comprimido, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    if h.hexdigest() != entrada["sha256_comprimido"]:
+        raise ValueError(f"checksum inválido en {entrada['objeto']}")
+    h = hashlib.sha256()
+    descompresor = zlib.decompressobj(31)
+    with open(comprimido, "rb") as origen, open(destino, "wb") as salida:
+        for bloque in iter(lambda: origen.read(1 << 20), b""):
+            datos = descompresor.decompress(bloque)
+            h.update(datos)
+            salida.write(datos)
+        datos = descompresor.flush()
+        h.update(datos)
+        salida.write(datos)
+    if h.hexdigest() != entrada["sha256"] or os.path.getsize(destino) != entrada["bytes"]:
+        raise ValueError(f"contenido inválido tras descomprimir {entrada['nombre']}")
+    os.remove(comprimido)
+
+def restaurar_snapshot():
+    """
+    Restaura el último snapshot de la bóveda: descarga todos los archivos por rangos en paralelo
+    con un único cliente, verifica tamaños y SHA-256 en un directorio temporal y solo entonces
+    coloca la generación del índice, el estado y el token de Drive, y mueve CURRENT.
+    """
+    global _snapshot_en_boveda
+    if not app.config["GCS_BUCKET_NAME"]:
+        print("  -> Nombre del bucket de GCS no configurado. Omitiendo descarga.")
+        return False
+    tmp_dir = None
+    try:
+        with metricas.cronometrar("snapshot_restore"):
+            inicio = time.monotonic()
+            bucket = _gcs_bucket()
+            latest = _snapshot_publicado()
+            if not latest:
+                print("  -> No se encontró un snapshot en la bóveda. Se construirá un índice nuevo.")
+                return False
+            generacion = latest["generacion"]
+            manifest = json.loads(_con_reintentos(lambda: bucket.blob(_prefijo_snapshot(generacion, "manifest.json")).download_as_bytes()))
+            if manifest.get("modelo_embeddings") != app.config["EMBEDDING_MODEL"]:
+                print("  -> El snapshot de la bóveda usa otro modelo de embeddings. Se construirá un índice nuevo.")
+                return False
+            os.makedirs(app.config["RAG_INDEX_DIR"], exist_ok=True)
+            tmp_dir = os.path.join(app.config["RAG_INDEX_DIR"], f".restaurando-{generacion}.tmp")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(os.path.join(tmp_dir, "index"))
+            os.makedirs(os.path.join(tmp_dir, "state"))
+
+            parte = app.config["GCS_SNAPSHOT_PART_MB"] << 20
+            partes = []
+            for entrada in manifest["archivos"]:
+                comprimido = os.path.join(tmp_dir, f"{entrada['nombre']}.gz")
+                with open(comprimido, "wb") as f:
+                    f.truncate(entrada["bytes_comprimidos"])
+                for desde in range(0, entrada["bytes_comprimidos"], parte):
+                    hasta = min(desde + parte, entrada["bytes_comprimidos"]) - 1
+                    partes.append((entrada["objeto"], comprimido, desde, hasta))
+            with ThreadPoolExecutor(max_workers=app.config["GCS_SNAPSHOT_WORKERS"], thread_name_prefix="snapshot") as pool:
+                list(pool.map(lambda p: _descargar_parte(bucket, *p), partes))
+                list(pool.map(
+                    lambda e: _descomprimir_y_verificar(e, os.path.join(tmp_dir, f"{e['nombre']}.gz"), os.path.join(tmp_dir, e["nombre"])),
+                    manifest["archivos"],
+                ))
+
+            # Todo verificado: se coloca la generación, luego el estado (manifiesto al final) y el puntero.
+            destino = os.path.join(app.config["RAG_INDEX_DIR"], generacion)
+            if not os.path.exists(destino):
+                os.rename(os.path.join(tmp_dir, "index"), destino)
+            os.makedirs(app.config["RAG_STATE_DIR"], exist_ok=True)
+            for entrada in manifest["archivos"]:
+                if entrada["nombre"].startswith("state/") and entrada["nombre"] != "state/manifest.json":
+                    os.replace(os.path.join(tmp_dir, entrada["nombre"]), os.path.join(app.config["RAG_STATE_DIR"], entrada["nombre"][len("state/"):]))
+            os.replace(os.path.join(tmp_dir, "state", "manifest.json"), _ruta_manifiesto())
+            with open(f"{_ruta_puntero()}.tmp", 'w') as f:
+                f.write(generacion)
+            os.replace(f"{_ruta_puntero()}.tmp", _ruta_puntero())
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception as e:
+        print(f"Error al restaurar el snapshot desde GCS: {e}")
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    _snapshot_en_boveda = generacion
+    total = sum(e["bytes_comprimidos"] for e in manifest["archivos"])
+    print(f"  -> ¡Éxito! Snapshot {generacion} restaurado desde la bóveda ({total / 1e6:.1f} MB en {time.monotonic() - inicio:.1f}s).")
+    refrescar_generacion(forzar=True)
+    return True
+
+# ========== CACHÉ DE ANÁLISIS GENERADOS ==========
+class _LRUCache:
+    """Caché LRU acotada y segura entre hilos, con caducidad opcional y contadores de aciertos."""
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, key):
+        with self.lock:
+            entrada = self.data.get(key)
+            if entrada is None or (entrada[1] is not None and entrada[1] < time.monotonic()):
+                if entrada is not None:
+                    del self.data[key]
+                self.fallos += 1
+                return None
+            self.data.move_to_end(key)
+            self.aciertos += 1
+            return entrada[0]
+
+    def set(self, key, value):
+        expira = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data[key] = (value, expira)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def estadisticas(self):
+        with self.lock:
+            total = self.aciertos + self.fallos
+            return {
+                "entradas": len(self.data),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": round(self.aciertos / total, 4) if total else None,
+            }
+
+    def __len__(self):
+        return len(self.data)
+
+class AnalisisCache:
+    """
+    Caché de dos niveles para los textos generados por Gemini: LRU en memoria y, opcionalmente,
+    un archivo por clave en disco (compartido entre workers y persistente entre despliegues).
+    Un archivo con más de `ttl` segundos (por fecha de modificación) cuenta como fallo, y tras las
+    escrituras el directorio se poda en segundo plano, como mucho una vez cada PODA_CADA segundos.
+    """
+    PODA_CADA = 600
+
+    def __init__(self, maxsize, disk_dir=None, ttl=None, max_bytes=None):
+        self.memoria = _LRUCache(maxsize, ttl)
+        self.disk_dir = disk_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._ultima_poda = 0.0
+        self._poda_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _ruta(self, clave):
+        return os.path.join(self.disk_dir, clave[:2], f"{clave}.txt")
+
+    def get(self, clave):
+        texto = self.memoria.get(clave)
+        if texto is not None or not self.disk_dir:
+            return texto
+        try:
+            with open(self._ruta(clave), "r", encoding="utf-8") as f:
+                if self.ttl and time.time() - os.fstat(f.fileno()).st_mtime > self.ttl:
+                    return None
+                texto = f.read()
+        except (FileNotFoundError, OSError):
+            return None
+        self.memoria.set(clave, texto)
+        return texto
+
+    def set(self, clave, texto):
+        self.memoria.set(clave, texto)
+        if not self.disk_dir:
+            return
+        ruta = self._ruta(clave)
+        try:
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            tmp = f"{ruta}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(texto)
+            os.replace(tmp, ruta)
+        except OSError as e:
+            print(f"No se pudo escribir la caché de análisis en disco: {e}")
+        self._podar_si_toca()
+
+    def _podar_si_toca(self):
+        if not (self.ttl or self.max_bytes) or time.monotonic() - self._ultima_poda < self.PODA_CADA:
+            return
+        if not self._poda_lock.acquire(blocking=False):
+            return
+        self._ultima_poda = time.monotonic()
+        threading.Thread(target=self.podar, name="analisis-cache-poda", daemon=True).start()
+
+    def podar(self):
+        """
+        Borra los archivos vencidos y, si el resto supera `max_bytes`, los más antiguos hasta quedar
+        en el 90 % del tope. Varios workers pueden podar a la vez: un archivo ya borrado se ignora.
+        Se llama con `_poda_lock` tomado.
+        """
+        try:
+            limite = time.time() - self.ttl if self.ttl else None
+            archivos = []
+            for raiz, _, nombres in os.walk(self.disk_dir):
+                for nombre in nombres:
+                    ruta = os.path.join(raiz, nombre)
+                    try:
+                        st = os.stat(ruta)
+                    except FileNotFoundError:
+                        continue
+                    if limite is not None and st.st_mtime < limite:
+                        self._borrar(ruta)
+                    else:
+                        archivos.append((st.st_mtime, st.st_size, ruta))
+            total = sum(tam for _, tam, _ in archivos)
+            if self.max_bytes and total > self.max_bytes:
+                archivos.sort()
+                for _, tam, ruta in archivos:
+                    if total <= 0.9 * self.max_bytes:
+                        break
+                    self._borrar(ruta)
+                    total -= tam
+            metricas.fijar("analisis_cache_disk_bytes", total, ayuda="Bytes del nivel en disco de la caché de análisis tras la última poda.")
+        finally:
+            self._poda_lock.release()
+
+    @staticmethod
+    def _borrar(ruta):
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass
+
+analisis_cache = AnalisisCache(
+    app.config['ANALISIS_CACHE_SIZE'],
+    os.path.join(app.config['RENDER_DISK_PATH'], "analisis_cache") if app.config['ANALISIS_CACHE_DISK'] else None,
+    ttl=app.config['ANALISIS_CACHE_DISK_TTL_DAYS'] * 86400 or None,
+    max_bytes=int(app.config['ANALISIS_CACHE_DISK_MAX_MB'] * 1024 * 1024) or None,
+)
+
+# ========== CACHÉS DE BÚSQUEDA RAG ==========
+def _normalizar_consulta(query):
+    """Misma clave para consultas que solo difieren en mayúsculas, espacios o forma Unicode."""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+class EmbeddingConsultaCache:
+    """
+    Embeddings de consultas normalizadas: LRU con TTL en memoria y, opcionalmente, un archivo
+    float32 por clave en disco (compartido entre workers; la edad se toma del mtime).
+    """
+    def __init__(self, maxsize, ttl, disk_dir=None):
+        self.memoria = _LRUCache(maxsize, ttl)
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.aciertos_disco = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def clave(query, task_type):
+        material = "\x1f".join([app.config["EMBEDDING_MODEL"], task_type, _normalizar_consulta(query)])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _ruta(self, clave):
+        return os.path.join(self.disk_dir, clave[:2], f"{clave}.f32")
+
+    def get(self, clave):
+        emb = self.memoria.get(clave)
+        if emb is not None or not self.disk_dir:
+            return emb
+        ruta = self._ruta(clave)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(ruta) > self.ttl:
+                return None
+            emb = np.fromfile(ruta, dtype=np.float32).tolist()
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        self.aciertos_disco += 1
+        self.memoria.set(clave, emb)
+        return emb
+
+    def set(self, clave, emb):
+        self.memoria.set(clave, emb)
+        if not self.disk_dir:
+            return
+        ruta = self._ruta(clave)
+        try:
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            tmp = f"{ruta}.{os.getpid()}.tmp"
+            np.asarray(emb, dtype=np.float32).tofile(tmp)
+            os.replace(tmp, ruta)
+        except OSError as e:
+            print(f"No se pudo escribir la caché de embeddings en disco: {e}")
+
+    def estadisticas(self):
+        return {**self.memoria.estadisticas(), "aciertos_disco": self.aciertos_disco}
+
+query_embedding_cache = EmbeddingConsultaCache(
+    app.config['QUERY_EMBEDDING_CACHE_SIZE'],
+    app.config['QUERY_EMBEDDING_CACHE_TTL'],
+    os.path.join(app.config['RENDER_DISK_PATH'], "query_embedding_cache") if app.config['QUERY_EMBEDDING_CACHE_DISK'] else None,
+)
+# La clave incluye la generación del índice: al publicarse una nueva, los resultados viejos ya no se consultan.
+search_result_cache = _LRUCache(app.config['SEARCH_RESULT_CACHE_SIZE'], app.config['SEARCH_RESULT_CACHE_TTL'])
+
+def get_query_embedding(query):
+    """Embedding de una consulta de búsqueda, reutilizando la caché antes de llamar a la API."""
+    clave = EmbeddingConsultaCache.clave(query, "RETRIEVAL_QUERY")
+    emb = query_embedding_cache.get(clave)
+    if emb is None:
+        emb = get_embedding_with_retries(query, task_type="RETRIEVAL_QUERY")
+        if emb:
+            query_embedding_cache.set(clave, emb)
+    return emb
+
+def get_query_embeddings(queries):
+    """Versión por lotes: las consultas que no están en caché se embeben juntas, en lotes de EMBEDDING_BATCH_SIZE."""
+    claves = [EmbeddingConsultaCache.clave(q, "RETRIEVAL_QUERY") for q in queries]
+    embs = [query_embedding_cache.get(c) for c in claves]
+    faltantes = [i for i, emb in enumerate(embs) if emb is None]
+    if faltantes:
+        nuevos = recoger_embeddings(enviar_embeddings([queries[i] for i in faltantes], task_type="RETRIEVAL_QUERY"))
+        for i, emb in zip(faltantes, nuevos):
+            if emb:
+                query_embedding_cache.set(claves[i], emb)
+                embs[i] = emb
+    return embs
+
+# ========== RECUPERACIÓN HÍBRIDA (BM25 + VECTORES) ==========
+def _fusion_rrf(listas, k):
+    """Reciprocal Rank Fusion sobre listas de IDs ya ordenadas; devuelve los k IDs con mayor puntaje."""
+    puntajes = {}
+    for lista in listas:
+        for rango, c_id in enumerate(lista, start=1):
+            puntajes[c_id] = puntajes.get(c_id, 0.0) + 1.0 / (app.config["RAG_RRF_K"] + rango)
+    return sorted(puntajes.items(), key=lambda par: par[1], reverse=True)[:k]
+
+def _fase_lexica(query, k, modo, file_ids, index, store, servido):
+    """
+    Primera fase de una búsqueda: filtro por archivo, BM25 y decisión de atajo léxico (una consulta
+    corta cuyas mejores coincidencias contienen todos sus términos no necesita embedding).
+    Devuelve el plan que consumen `_fase_vectorial` y `_combinar`.
+    """
+    bm25 = servido["bm25"]
+    if bm25 is None:
+        modo = "vector"
+    elif index is None:
+        # Generación sin índice vectorial legible: cualquier modo se resuelve solo con BM25.
+        modo = "lexical"
+    permitidos = None
+    if file_ids:
+        filtro = set(file_ids)
+        codigos = [i for i, f_id in enumerate(servido["file_ids"]) if f_id in filtro]
+        permitidos = np.isin(servido["archivo_de_chunk"], codigos)
+    candidatos = max(k, app.config["RAG_FUSION_CANDIDATES"]) if modo == "hybrid" else k
+
+    lexicos = []
+    if modo in ("hybrid", "lexical"):
+        terminos = set(_tokenizar(query))
+        with metricas.cronometrar("bm25_search"):
+            lexicos = bm25.buscar(terminos, candidatos, permitidos)
+        corta = 0 < len(terminos) <= app.config["RAG_LEXICAL_SHORTCIRCUIT_MAX_TERMS"]
+        completos = len(lexicos) >= k and all(c == len(terminos) for _, _, c in lexicos[:k])
+        if modo == "hybrid" and app.config["RAG_LEXICAL_SHORTCIRCUIT"] and corta and completos:
+            modo = "lexical"
+    return {
+        "query": query,
+        "k": k,
+        "modo": modo,
+        "candidatos": candidatos,
+        "ids_permitidos": store.ids[permitidos] if permitidos is not None else None,
+        "lexico": {int(store.ids[p]): puntaje for p, puntaje, _ in lexicos},
+        "distancias": {},
+    }
+
+def _necesita_vectores(plan):
+    return plan["modo"] in ("hybrid", "vector")
+
+def _fase_vectorial(planes, embeddings, index, nprobe=None, ef_search=None):
+    """
+    Segunda fase: los planes sin filtro se resuelven con una sola llamada `search` multi-fila; los
+    filtrados necesitan su propio selector de IDs y se buscan por separado.
+    """
+    sin_filtro = [(plan, emb) for plan, emb in zip(planes, embeddings) if plan["ids_permitidos"] is None]
+    grupos = [sin_filtro] if sin_filtro else []
+    grupos += [[(plan, emb)] for plan, emb in zip(planes, embeddings) if plan["ids_permitidos"] is not None]
+    for grupo in grupos:
+        k_max = max(plan["candidatos"] for plan, _ in grupo)
+        D, I = buscar_en_indice(
+            index, np.asarray([emb for _, emb in grupo], dtype=np.float32), k_max,
+            nprobe=nprobe, ef_search=ef_search, ids_permitidos=grupo[0][0]["ids_permitidos"],
+        )
+        for (plan, _), fila_d, fila_i in zip(grupo, D, I):
+            plan["distancias"] = {int(c_id): float(d) for c_id, d in zip(fila_i[:plan["candidatos"]], fila_d) if c_id >= 0}
+
+def _combinar(plan, store, servido):
+    """Tercera fase: fusiona (o toma) los rankings y arma las coincidencias con texto y archivo."""
+    k, lexico, distancias = plan["k"], plan["lexico"], plan["distancias"]
+    if plan["modo"] == "hybrid":
+        elegidos = _fusion_rrf([list(lexico), list(distancias)], k)
+    elif plan["modo"] == "lexical":
+        elegidos = list(lexico.items())[:k]
+    else:
+        elegidos = [(c_id, 1.0 / (app.config["RAG_RRF_K"] + r)) for r, c_id in enumerate(distancias, start=1)][:k]
+
+    coincidencias = []
+    for c_id, puntaje in elegidos:
+        pos = store.posicion_de(c_id)
+        if pos is None:
+            continue
+        f_id = servido["file_ids"][servido["archivo_de_chunk"][pos]]
+        pagina = int(servido["pagina_de_chunk"][pos])
+        coincidencias.append({
+            "chunk_id": c_id,
+            "file_id": f_id,
+            "file_name": servido["nombres"].get(f_id),
+            "page": pagina or None,
+            "score": round(puntaje, 6),
+            "bm25": round(lexico[c_id], 4) if c_id in lexico else None,
+            "distance": round(distancias[c_id], 6) if c_id in distancias else None,
+            "text": store.get(pos),
+        })
+    return coincidencias
+
+def buscar_chunks(query, k, modo, file_ids, index, store, servido, nprobe=None, ef_search=None):
+    """
+    Recupera hasta k chunks de la generación `servido` (índice y almacén tomados juntos).
+    modo: "hybrid" (BM25 + vectores fusionados con RRF), "vector" o "lexical".
+    Devuelve (modo_usado, coincidencias) o None si falló el embedding.
+    """
+    plan = _fase_lexica(query, k, modo, file_ids, index, store, servido)
+    if _necesita_vectores(plan):
+        emb = get_query_embedding(query)
+        if not emb:
+            return None
+        _fase_vectorial([plan], [emb], index, nprobe, ef_search)
+    return plan["modo"], _combinar(plan, store, servido)
+
+def buscar_chunks_lote(consultas, index, store, servido, nprobe=None, ef_search=None):
+    """
+    Igual que `buscar_chunks` para muchas consultas (query, k, modo, file_ids): los embeddings que
+    faltan se piden en lote y FAISS se consulta con una búsqueda multi-fila.
+    Devuelve una lista alineada con `consultas` de (modo_usado, coincidencias) o None.
+    """
+    planes = [_fase_lexica(q, k, modo, f_ids, index, store, servido) for q, k, modo, f_ids in consultas]
+    vectoriales = [plan for plan in planes if _necesita_vectores(plan)]
+    embeddings = get_query_embeddings([plan["query"] for plan in vectoriales]) if vectoriales else []
+    fallidos = {id(plan) for plan, emb in zip(vectoriales, embeddings) if not emb}
+    listos = [(plan, emb) for plan, emb in zip(vectoriales, embeddings) if emb]
+    if listos:
+        _fase_vectorial([plan for plan, _ in listos], [emb for _, emb in listos], index, nprobe, ef_search)
+    return [None if id(plan) in fallidos else (plan["modo"], _combinar(plan, store, servido)) for plan in planes]
+
+# ========== LÓGICA DE ANÁLISIS Y PERFILAMIENTO ==========
+# ... (sin cambios en esta sección)
+def _crear_perfil_psicologico(oraculo_natal):
+    sellos_pragmaticos = ["Espejo", "Perro", "Guerrero", "Tierra"]
+    tonos_pragmaticos = [5, 8, 10, 11]
+    sello = oraculo_natal.get(app.config['FIELD_ID_SELLO'])
+    tono = oraculo_natal.get(app.config['FIELD_ID_TONO'])
+    if sello in sellos_pragmaticos or tono in tonos_pragmaticos:
+        return "pragmatico"
+    return "neofito"
+
+def _construir_prompt_analisis(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo):
+    datos_oraculo = f"""
+    - Oráculo Natal (Tu Esencia):
+      - Sello: {oraculo_natal.get(app.config['FIELD_ID_SELLO'])}
+      - Tono: {oraculo_natal.get(app.config['FIELD_ID_TONO'])}
+      - Guía: {oraculo_natal.get(app.config['FIELD_ID_GUIA'])}
+      - Análogo: {oraculo_natal.get(app.config['FIELD_ID_ANALOGO'])}
+      - Antípoda: {oraculo_natal.get(app.config['FIELD_ID_ANTIPODA'])}
+      - Oculto: {oraculo_natal.get(app.config['FIELD_ID_OCULTO'])}
+    - Misión de Vida (Tu Propósito de Fondo):
+      - Sello de la Misión: {oraculo_mision.get(app.config['FIELD_ID_SELLO'])}
+    - Energía del Día para la Tierra (El Clima Colectivo):
+      - Sello: {oraculo_tierra.get(app.config['FIELD_ID_SELLO'])}
+      - Tono: {oraculo_tierra.get(app.config['FIELD_ID_TONO'])}
+      - Guía: {oraculo_tierra.get(app.config['FIELD_ID_GUIA'])}
+      - Análogo: {oraculo_tierra.get(app.config['FIELD_ID_ANALOGO'])}
+      - Antípoda: {oraculo_tierra.get(app.config['FIELD_ID_ANTIPODA'])}
+      - Oculto: {oraculo_tierra.get(app.config['FIELD_ID_OCULTO'])}
+    - Tu Línea de Tiempo Personal (Tu Clima Personal Hoy):
+      - Sello: {oraculo_linea_tiempo.get(app.config['FIELD_ID_SELLO'])}
+      - Tono: {oraculo_linea_tiempo.get(app.config['FIELD_ID_TONO'])}
+      - Guía: {oraculo_linea_tiempo.get(app.config['FIELD_ID_GUIA'])}
+      - Análogo: {oraculo_linea_tiempo.get(app.config['FIELD_ID_ANALOGO'])}
+      - Antípoda: {oraculo_linea_tiempo.get(app.config['FIELD_ID_ANTIPODA'])}
+      - Oculto: {oraculo_linea_tiempo.get(app.config['FIELD_ID_OCULTO'])}
+    """
+    if perfil == "pragmatico":
+        prompt = f"""
+        Eres un experto en psicología profunda y arquetipos junguianos. Realiza un análisis comparativo y pragmático para una persona, basado en sus datos del Oráculo Maya.
+        1.  **Análisis Natal:** Primero, analiza su Oráculo Natal y Misión de Vida. Traduce los conceptos mayas a un lenguaje psicológico y práctico (Sello = arquetipo esencial, Tono = frecuencia operativa, etc.). Describe los potenciales y sombras de estos 7 aspectos natales.
+        2.  **Análisis del Día:** Luego, analiza la "Energía del Día para la Tierra" y la "Línea de Tiempo Personal". Explica cómo el "clima colectivo" (Tierra) interactúa con el "clima personal" del individuo (Línea de Tiempo).
+        3.  **Síntesis y Consejo:** Ofrece una síntesis que conecte su perfil natal con las energías del día. Dale un consejo práctico y accionable sobre cómo navegar el día de la consulta.
+        Al final, debes preguntar "¿Qué aspecto de tu vida o desafío te gustaría explorar hoy con más detalle? También puedes solicitar este mismo análisis para una fecha diferente si lo deseas.".
+        Datos para el Análisis:
+        {datos_oraculo}
+        """
+    else: # Perfil Neofito
+        prompt = f"""
+        Eres un guía espiritual sabio y cercano. Explica de manera sencilla y aterrizada las energías de una persona para el día de hoy, basadas en el Sincronario Maya.
+        1.  **Tu Esencia:** Comienza explicando su Oráculo Natal y su Misión de Vida. Usa un lenguaje fácil de entender (luz y sombra) para describir estos 7 aspectos que son su base.
+        2.  **La Energía de Hoy:** Luego, explica el "Clima Colectivo" (la energía del día para todos) y su "Clima Personal" (su Línea de Tiempo Personal). Haz una analogía para que entienda cómo la energía general del día le afecta de una manera única.
+        3.  **Consejo del Día:** Ofrece una síntesis amorosa y un consejo práctico sobre cómo puede aprovechar mejor las energías del día, conectando su esencia con lo que está sucediendo hoy.
+        El objetivo es que la persona se sienta comprendida y empoderada. Al final, debes preguntar "¿Qué aspecto de tu vida te gustaría que exploremos juntos hoy? Si quieres, también podemos hacer este mismo análisis para otra fecha.".
+        Datos para el Análisis:
+        {datos_oraculo}
+        """
+    return prompt
+
+def _clave_analisis(perfil, kins_oraculos, oraculos):
+    """
+    Clave de contenido: versión del prompt, modelo, perfil, Kins de los cinco oráculos y el contenido
+    de los registros de oráculo con que se arma el prompt, así una edición en la tabla de Airtable
+    no sirve textos generados con los registros anteriores.
+    """
+    base = json.dumps([app.config['PROMPT_VERSION'], app.config['GENERATION_MODEL'], perfil, [int(k) for k in kins_oraculos], oraculos],
+                      sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+def _generar_analisis_con_gemini(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo, kins_oraculos=None):
+    """
+    Genera el análisis de texto. Si se indican los Kins de los cinco oráculos (natal, misión,
+    constante, tierra, línea de tiempo) la respuesta se busca y se guarda en la caché de análisis.
+    Los mensajes de error nunca se guardan en caché.
+    """
+    clave = _clave_analisis(perfil, kins_oraculos, [oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo]) if kins_oraculos else None
+    if clave:
+        texto_cacheado = analisis_cache.get(clave)
+        if texto_cacheado is not None:
+            return texto_cacheado
+
+    prompt = _construir_prompt_analisis(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo)
+    try:
+        model = gemini.GenerativeModel(app.config['GENERATION_MODEL'])
+        
+        retries = 0
+        delay = 2.0
+        max_retries = 3
+        while retries < max_retries:
+            try:
+                with metricas.cronometrar("gemini_generation"):
+                    response = model.generate_content(prompt)
+                if clave:
+                    analisis_cache.set(clave, response.text)
+                return response.text
+            except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded) as e:
+                retries += 1
+                if retries == max_retries:
+                    raise e
+                print(f"  -> Error de cuota/servicio ({type(e).__name__}) al generar análisis. Reintentando en {delay:.1f}s...")
+                time.sleep(delay)
+                delay *= 2
+
+    except Exception as e:
+        print(f"Error al generar análisis con Gemini: {e}")
+        return f"Hubo un error al generar el análisis después de varios intentos: {e}"
+
+def _generar_analisis_en_stream(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo, kins_oraculos):
+    """
+    Variante en streaming de `_generar_analisis_con_gemini`: produce los fragmentos de texto a medida
+    que Gemini los entrega. Solo se reintenta si aún no se ha emitido ningún fragmento; al terminar
+    el texto completo se guarda en la caché de análisis.
+    """
+    clave = _clave_analisis(perfil, kins_oraculos, [oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo])
+    texto_cacheado = analisis_cache.get(clave)
+    if texto_cacheado is not None:
+        yield texto_cacheado
+        return
+
+    prompt = _construir_prompt_analisis(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo)
+    model = gemini.GenerativeModel(app.config['GENERATION_MODEL'])
+    partes = []
+    retries = 0
+    delay = 2.0
+    max_retries = 3
+    inicio = time.perf_counter()
+    while True:
+        try:
+            for chunk in model.generate_content(prompt, stream=True):
+                try:
+                    fragmento = chunk.text
+                except ValueError:
+                    # Fragmentos sin partes de texto (p. ej. bloqueados por seguridad).
+                    continue
+                if fragmento:
+                    partes.append(fragmento)
+                    yield fragmento
+            break
+        except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded) as e:
+            retries += 1
+            if partes or retries == max_retries:
+                raise
+            print(f"  -> Error de cuota/servicio ({type(e).__name__}) al generar análisis. Reintentando en {delay:.1f}s...")
+            time.sleep(delay)
+            delay *= 2
+
+    metricas.observar("oraculo_stage_duration_seconds", time.perf_counter() - inicio, stage="gemini_generation_stream")
+    if partes:
+        analisis_cache.set(clave, "".join(partes))
+
+# ========== SERVER-SENT EVENTS ==========
+def _pide_stream(args, accept):
+    if args.get("stream", "").lower() in ("1", "true"):
+        return True
+    return "text/event-stream" in accept
+
+def _quiere_stream():
+    return _pide_stream(request.args, request.headers.get("Accept", ""))
+
+def _evento_sse(evento, datos):
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False, default=str)}\n\n"
+
+def _respuesta_sse(calculo, generador):
+    """
+    Emite primero los cálculos ya resueltos (evento `calculo`), luego cada fragmento del
+    análisis (evento `token`) y finalmente `fin`, o `error` si la generación falla a medias.
+    """
+    def eventos():
+        yield _evento_sse("calculo", calculo)
+        try:
+            for fragmento in generador:
+                yield _evento_sse("token", {"texto": fragmento})
+        except Exception as e:
+            print(f"Error al generar análisis en streaming con Gemini: {e}")
+            yield _evento_sse("error", {"message": f"Hubo un error al generar el análisis: {e}"})
+            return
+        yield _evento_sse("fin", {"status": "success"})
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(eventos()), mimetype="text/event-stream", headers=headers)
+
+# ========== CALENDARIO POR RANGO ==========
+_CAMPOS_RESUMEN_ORACULO = {
+    "sello": "FIELD_ID_SELLO",
+    "num_sello": "FIELD_ID_NUM_SELLO",
+    "tono": "FIELD_ID_TONO",
+    "guia": "FIELD_ID_GUIA",
+    "analogo": "FIELD_ID_ANALOGO",
+    "antipoda": "FIELD_ID_ANTIPODA",
+    "oculto": "FIELD_ID_OCULTO",
+}
+
+@lru_cache(maxsize=2)
+def _fragmentos_oraculo(version):
+    """
+    Resumen de oráculo ya serializado en JSON para cada Kin (índice 1..260) de esa versión de la
+    tabla; así cada día del calendario es solo una concatenación de cadenas.
+    """
+    kins = oraculo_tabla["kins"] or [None] * 261
+    fragmentos = ["null"] * 261
+    for kin_num in range(1, 261):
+        fields = kins[kin_num]
+        if fields is not None:
+            resumen = {nombre: fields.get(app.config[campo]) for nombre, campo in _CAMPOS_RESUMEN_ORACULO.items()}
+            fragmentos[kin_num] = json.dumps(resumen, ensure_ascii=False, default=str)
+    return fragmentos
+
+def _lineas_calendario(fecha_inicio, fecha_fin, bloque=512):
+    """Genera bloques de líneas NDJSON (fecha, kin, oráculo) leyendo la tabla precalculada."""
+    fragmentos = _fragmentos_oraculo(oraculo_tabla["version"])
+    inicio = fecha_inicio.toordinal() - calendario_kin["inicio"]
+    kins = calendario_kin["kins"][inicio:inicio + (fecha_fin - fecha_inicio).days + 1]
+    fecha = fecha_inicio
+    un_dia = datetime.timedelta(days=1)
+    for desde in range(0, len(kins), bloque):
+        lineas = []
+        for kin in kins[desde:desde + bloque].tolist():
+            lineas.append(f'{{"fecha": "{fecha.day:02d}/{fecha.month:02d}/{fecha.year}", "kin": {kin}, "oraculo": {fragmentos[kin]}}}\n')
+            fecha += un_dia
+        yield "".join(lineas)
+
+# ========== ENDPOINTS DE LA API ==========
+@app.route("/")
+def home():
+    return api_response("success", "Oráculo Maya API v6.13 (Corrección Definitiva) - Powered by Gemini")
+
+def _metricas_de_caches():
+    """Los contadores de las cachés viven en cada caché; aquí se copian al registro antes de exportar."""
+    caches = {
+        "analisis": analisis_cache.memoria.estadisticas(),
+        "query_embeddings": query_embedding_cache.estadisticas(),
+        "search_results": search_result_cache.estadisticas(),
+        "document_embeddings": document_embedding_cache.estadisticas(),
+    }
+    for nombre, funcion in (("kin_airtable", _get_kin_from_airtable), ("oraculo_resumenes", _fragmentos_oraculo)):
+        info = funcion.cache_info()
+        caches[nombre] = {"aciertos": info.hits, "fallos": info.misses, "entradas": info.currsize}
+    for nombre, stats in caches.items():
+        metricas.fijar("oraculo_cache_hits_total", stats["aciertos"], ayuda="Aciertos por caché.", tipo="counter", cache=nombre)
+        metricas.fijar("oraculo_cache_misses_total", stats["fallos"], ayuda="Fallos por caché.", tipo="counter", cache=nombre)
+        metricas.fijar("oraculo_cache_entries", stats["entradas"], ayuda="Entradas en memoria por caché.", cache=nombre)
+    metricas.fijar("oraculo_cache_hits_total", query_embedding_cache.aciertos_disco, tipo="counter", cache="query_embeddings_disco")
+    metricas.fijar("oraculo_tabla_version", oraculo_tabla["version"], ayuda="Versión de la tabla de oráculos en memoria.")
+    metricas.fijar("embedding_rate_limit", embedding_limiter.rate, ayuda="Tasa actual del limitador adaptativo de embeddings (peticiones/s).")
+
+def _metricas_de_arranque():
+    for etapa, segundos in arranque["etapas"].items():
+        metricas.fijar("oraculo_startup_seconds", segundos, ayuda="Duración de cada etapa del arranque del worker.", stage=etapa)
+    for modulo, segundos in list(arranque["imports_diferidos"].items()):
+        metricas.fijar("oraculo_lazy_import_seconds", segundos, ayuda="Duración del import diferido de cada librería pesada.", module=modulo)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    _metricas_de_caches()
+    _metricas_de_arranque()
+    return Response(metricas.exportar(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/health/live")
+def health_live_endpoint():
+    """El proceso responde: no consulta dependencias."""
+    return api_response("success", "Proceso vivo.", {"pid": os.getpid(), "uptime_seconds": round(time.perf_counter() - _inicio_arranque, 3)})
+
+@app.route("/health/ready")
+def health_ready_endpoint():
+    """Qué subsistemas están calientes en este worker; 200 solo si están listos los de HEALTH_READY_REQUIRES."""
+    with index_lock:
+        rag_cargado = indice_servido["generacion"] is not None
+    subsistemas = {
+        "oraculo": {
+            "listo": oraculo_inicializado.is_set(),
+            "tabla_cargada": oraculo_tabla["kins"] is not None,
+            "version": oraculo_tabla["version"],
+        },
+        "calendario": {"listo": True, "desde": Config.CALENDARIO_DESDE_ANIO, "hasta": Config.CALENDARIO_HASTA_ANIO},
+        "rag": {
+            "habilitado": app.config['RAG_ENABLED'],
+            # Listo si este worker ya sirve una generación o hay una publicada que cargará en la primera búsqueda.
+            "listo": app.config['RAG_ENABLED'] and (rag_cargado or _generacion_actual() is not None),
+            "cargado": rag_cargado,
+            "generacion": indice_servido["generacion"],
+            "es_lider_sync": _lider_lock_file is not None,
+            "sync_en_curso": _sync_en_curso.locked(),
+        },
+    }
+    modulos = {m._nombre: m.cargado for m in _MODULOS_DIFERIDOS}
+    pendientes = [nombre for nombre in app.config['HEALTH_READY_REQUIRES'] if not subsistemas.get(nombre, {}).get("listo")]
+    data = {
+        "subsistemas": subsistemas,
+        "modulos_cargados": modulos,
+        "arranque": {"etapas": arranque["etapas"], "imports_diferidos": dict(arranque["imports_diferidos"])},
+        "pendientes": pendientes,
+    }
+    if pendientes:
+        return api_response("service_unavailable", f"Instancia aún no lista: {', '.join(pendientes)}.", data), 503
+    return api_response("success", "Instancia lista.", data)
+
+@app.route("/kin")
+def kin_endpoint():
+    fecha_str = request.args.get("fecha")
+    if not fecha_str:
+        return api_response("error", "Parámetro 'fecha' es requerido."), 400
+    
+    fecha_norm = normalizar_fecha_str(fecha_str)
+    if not fecha_norm:
+        return api_response("error", f"Formato de fecha inválido: {fecha_str}"), 400
+        
+    kin = get_kin_from_date(fecha_norm)
+    if kin:
+        return api_response("success", "Kin encontrado", {"fecha": fecha_norm, "kin": kin})
+    else:
+        return api_response("not_found", f"No se encontró Kin para la fecha {fecha_norm}."), 404
+
+@app.route("/kin/batch", methods=["POST"])
+def kin_batch_endpoint():
+    data = request.get_json(silent=True) or {}
+    fechas = data.get("fechas")
+    if not isinstance(fechas, list) or not fechas:
+        return api_response("error", "El cuerpo debe ser JSON con una lista no vacía 'fechas'."), 400
+    if len(fechas) > app.config['BATCH_MAX_ITEMS']:
+        return api_response("error", f"Máximo {app.config['BATCH_MAX_ITEMS']} fechas por petición."), 400
+
+    normalizadas = [normalizar_fecha_str(f) for f in fechas]
+    # Cada fecha distinta se resuelve una sola vez, aunque se repita en la petición.
+    unicas = list(dict.fromkeys(f for f in normalizadas if f))
+    kins = dict(zip(unicas, _lookup_executor.map(get_kin_from_date, unicas)))
+
+    resultados = []
+    for original, fecha_norm in zip(fechas, normalizadas):
+        if not fecha_norm:
+            resultados.append({"fecha": original, "status": "error", "message": f"Formato de fecha inválido: {original}"})
+        elif kins[fecha_norm]:
+            resultados.append({"fecha": fecha_norm, "status": "success", "kin": kins[fecha_norm]})
+        else:
+            resultados.append({"fecha": fecha_norm, "status": "not_found", "message": f"No se encontró Kin para la fecha {fecha_norm}."})
+    return api_response("success", f"{len(resultados)} fechas procesadas.", {"resultados": resultados})
+
+@app.route("/kin/conformidad")
+def kin_conformidad_endpoint():
+    desde = normalizar_fecha_str(request.args.get("desde"))
+    hasta = normalizar_fecha_str(request.args.get("hasta"))
+    if not desde or not hasta:
+        return api_response("error", "Parámetros 'desde' y 'hasta' son requeridos con un formato de fecha válido."), 400
+
+    fecha_inicio, fecha_fin = _fecha_desde_str(desde), _fecha_desde_str(hasta)
+    if fecha_fin < fecha_inicio:
+        return api_response("error", "La fecha 'hasta' debe ser posterior a 'desde'."), 400
+    if (fecha_fin - fecha_inicio).days + 1 > app.config['KIN_CONFORMANCE_MAX_DAYS']:
+        return api_response("error", f"El rango máximo permitido es de {app.config['KIN_CONFORMANCE_MAX_DAYS']} días."), 400
+
+    resumen = verificar_conformidad_kin(fecha_inicio, fecha_fin)
+    return api_response("success", "Conformidad del motor local contra Airtable.", resumen)
+
+@app.route("/calendario")
+def calendario_endpoint():
+    """
+    Kin y resumen de oráculo por día en [desde, hasta]. Se transmite en bloques: NDJSON por defecto
+    (una línea por día) o, con formato=json, el mismo sobre {status, message, data} de la API.
+    """
+    desde = normalizar_fecha_str(request.args.get("desde"))
+    hasta = normalizar_fecha_str(request.args.get("hasta"))
+    if not desde or not hasta:
+        return api_response("error", "Parámetros 'desde' y 'hasta' son requeridos con un formato de fecha válido."), 400
+    formato = request.args.get("formato", "ndjson")
+    if formato not in ("ndjson", "json"):
+        return api_response("error", "'formato' debe ser 'ndjson' o 'json'."), 400
+
+    fecha_inicio, fecha_fin = _fecha_desde_str(desde), _fecha_desde_str(hasta)
+    if fecha_fin < fecha_inicio:
+        return api_response("error", "La fecha 'hasta' debe ser posterior a 'desde'."), 400
+    if (fecha_fin - fecha_inicio).days + 1 > app.config['CALENDARIO_MAX_DIAS']:
+        return api_response("error", f"El rango máximo permitido es de {app.config['CALENDARIO_MAX_DIAS']} días."), 400
+    if fecha_inicio.toordinal() < calendario_kin["inicio"] or fecha_fin.toordinal() > calendario_kin["fin"]:
+        return api_response("error", f"El calendario cubre de {app.config['CALENDARIO_DESDE_ANIO']} a {app.config['CALENDARIO_HASTA_ANIO']}."), 400
+
+    if formato == "ndjson":
+        return Response(_lineas_calendario(fecha_inicio, fecha_fin), mimetype="application/x-ndjson")
+
+    def json_por_bloques():
+        yield f'{{"status": "success", "message": "Calendario de {desde} a {hasta}.", "data": {{"desde": "{desde}", "hasta": "{hasta}", "dias": ['
+        separador = ""
+        for bloque in _lineas_calendario(fecha_inicio, fecha_fin):
+            yield separador + bloque.rstrip("\n").replace("\n", ", ")
+            separador = ", "
+        yield "]}}"
+
+    return Response(json_por_bloques(), mimetype="application/json")
+
+@app.route("/oraculo")
+def oraculo_endpoint():
+    kin_str = request.args.get("kin")
+    if not kin_str:
+        return api_response("error", "Parámetro 'kin' es requerido."), 400
+    
+    oraculo = get_oraculo_from_kin(kin_str)
+    if oraculo:
+        return api_response("success", "Oráculo encontrado", oraculo)
+    else:
+        return api_response("not_found", f"No se encontró oráculo para el Kin {kin_str}."), 404
+
+@app.route("/oraculo/batch", methods=["POST"])
+def oraculo_batch_endpoint():
+    data = request.get_json(silent=True) or {}
+    kins = data.get("kins")
+    if not isinstance(kins, list) or not kins:
+        return api_response("error", "El cuerpo debe ser JSON con una lista no vacía 'kins'."), 400
+    if len(kins) > app.config['BATCH_MAX_ITEMS']:
+        return api_response("error", f"Máximo {app.config['BATCH_MAX_ITEMS']} kins por petición."), 400
+
+    numeros = [_kin_valido(k) for k in kins]
+    unicos = list(dict.fromkeys(n for n in numeros if n))
+    oraculos = dict(zip(unicos, _lookup_executor.map(get_oraculo_from_kin, unicos)))
+
+    resultados = []
+    for original, kin_num in zip(kins, numeros):
+        if kin_num is None:
+            resultados.append({"kin": original, "status": "error", "message": f"Kin inválido: {original}. Debe ser un entero entre 1 y 260."})
+        elif oraculos[kin_num]:
+            resultados.append({"kin": kin_num, "status": "success", "oraculo": oraculos[kin_num]})
+        else:
+            resultados.append({"kin": kin_num, "status": "not_found", "message": f"No se encontró oráculo para el Kin {kin_num}."})
+    return api_response("success", f"{len(resultados)} kins procesados.", {"resultados": resultados})
+
+@app.route("/oraculo/estado")
+def oraculo_estado_endpoint():
+    tabla = oraculo_tabla
+    cargados = sum(1 for fields in tabla["kins"][1:] if fields is not None) if tabla["kins"] else 0
+    return api_response("success", "Estado de la tabla de oráculos.", {
+        "version": tabla["version"],
+        "checksum": tabla["checksum"],
+        "ultimo_refresco": tabla["actualizado"],
+        "kins_cargados": cargados,
+        "refresco_cada_segundos": app.config['ORACULO_REFRESH_SECONDS'],
+    })
+
+def _fechas_del_analisis(data):
+    """Valida el cuerpo de /analisis y devuelve (nacimiento, cumpleaños a usar, Año Nuevo Maya, consulta) normalizadas."""
+    if not data or "fecha_nacimiento" not in data:
+        raise ErrorAPI("error", "Cuerpo de la petición debe ser JSON con 'fecha_nacimiento'.", 400)
+
+    fecha_nac_norm = normalizar_fecha_str(data["fecha_nacimiento"])
+    if not fecha_nac_norm:
+        raise ErrorAPI("error", f"Formato de fecha de nacimiento inválido: {data['fecha_nacimiento']}", 400)
+    
+    hoy_dt = datetime.datetime.now(app.config['TIMEZONE'])
+    fecha_consulta_norm = normalizar_fecha_str(data.get("fecha_consulta", hoy_dt.strftime("%d/%m/%Y")))
+    if not fecha_consulta_norm:
+        raise ErrorAPI("error", f"Formato de fecha de consulta inválido: {data.get('fecha_consulta')}", 400)
+
+    fecha_nac_dt = datetime.datetime.strptime(fecha_nac_norm, "%d/%m/%Y")
+    fecha_consulta_dt = datetime.datetime.strptime(fecha_consulta_norm, "%d/%m/%Y")
+
+    fecha_cumple_este_ano = fecha_nac_dt.replace(year=fecha_consulta_dt.year)
+    fecha_cumple_a_usar = (
+        fecha_cumple_este_ano.replace(year=fecha_consulta_dt.year - 1)
+        if fecha_consulta_dt < fecha_cumple_este_ano
+        else fecha_cumple_este_ano
+    )
+    ano_maya_inicio_ano = (
+        fecha_consulta_dt.year if fecha_consulta_dt.month > 7 or (fecha_consulta_dt.month == 7 and fecha_consulta_dt.day >= 26) else fecha_consulta_dt.year - 1
+    )
+    fecha_ano_maya_str = f"26/07/{ano_maya_inicio_ano}"
+    return fecha_nac_norm, fecha_cumple_a_usar.strftime("%d/%m/%Y"), fecha_ano_maya_str, fecha_consulta_norm
+
+def _calculo_del_analisis(fechas, resultados, errores):
+    """
+    Comprueba los Kins y oráculos resueltos y devuelve (respuesta con los cálculos, argumentos para
+    generar el análisis). Un dato faltante o un cálculo fallido se lanza como ErrorAPI.
+    """
+    fecha_nac_norm, fecha_cumple_str, fecha_ano_maya_str, fecha_consulta_norm = fechas
+    kin_natal = resultados["kin_natal"]
+    if not kin_natal: 
+        raise ErrorAPI("not_found", f"Dato Faltante: No se encontró el Kin para la fecha de nacimiento ({fecha_nac_norm}). Por favor, verifica que la fecha exista en tu Airtable.", 404)
+        
+    oraculo_natal = resultados["oraculo_natal"]
+    if not oraculo_natal: 
+        raise ErrorAPI("not_found", f"Dato Faltante: No se encontró Oráculo para el Kin natal ({kin_natal}).", 404)
+
+    if "kin_mision" in errores:
+        raise ErrorAPI("error", f"Error en los cálculos de la misión: {errores['kin_mision']}", 500)
+    kin_mision_num = resultados["kin_mision"]
+    oraculo_mision = resultados["oraculo_mision"]
+    if not oraculo_mision: 
+        raise ErrorAPI("not_found", f"Dato Faltante: No se encontró Oráculo para la misión (Kin {kin_mision_num}).", 404)
+
+    kin_cumple = resultados["kin_cumple"]
+    kin_ano_maya = resultados["kin_ano_maya"]
+    if not all([kin_cumple, kin_ano_maya]): 
+        raise ErrorAPI("not_found", f"Dato Faltante: No se pudo encontrar el Kin para la fecha de cumpleaños ({fecha_cumple_str}) o del Año Nuevo Maya ({fecha_ano_maya_str}).", 404)
+
+    if "constante" in errores:
+        raise ErrorAPI("error", f"Error en los cálculos de la constante: {errores['constante']}", 500)
+    constante_personal_kin = resultados["constante"]
+
+    kin_tierra = resultados["kin_tierra"]
+    if not kin_tierra: 
+        raise ErrorAPI("not_found", f"Dato Faltante: No se encontró Kin para la fecha de consulta ({fecha_consulta_norm}).", 404)
+    
+    oraculo_tierra = resultados["oraculo_tierra"]
+    if not oraculo_tierra: 
+        raise ErrorAPI("not_found", f"Dato Faltante: No se encontró Oráculo para el Kin de la Tierra ({kin_tierra}).", 404)
+    
+    if "kin_linea_tiempo" in errores:
+        raise ErrorAPI("error", f"Error en los cálculos de la línea de tiempo: {errores['kin_linea_tiempo']}", 500)
+    kin_linea_tiempo_num = resultados["kin_linea_tiempo"]
+    oraculo_linea_tiempo = resultados["oraculo_linea_tiempo"]
+    if not oraculo_linea_tiempo: 
+        raise ErrorAPI("not_found", f"Dato Faltante: No se encontró Oráculo para la línea de tiempo (Kin {kin_linea_tiempo_num}).", 404)
+
+    perfil = _crear_perfil_psicologico(oraculo_natal)
+    
+    oraculo_constante = resultados["oraculo_constante"]
+    kins_oraculos = [kin_natal, kin_mision_num, constante_personal_kin, kin_tierra, kin_linea_tiempo_num]
+
+    respuesta_final = {
+        "pasos_calculo": {
+            "fecha_nacimiento_norm": fecha_nac_norm,
+            "kin_natal": kin_natal,
+            "fecha_consulta_norm": fecha_consulta_norm,
+            "fecha_cumpleanos_usada": fecha_cumple_str,
+            "fecha_ano_maya_usada": fecha_ano_maya_str,
+            "kin_cumpleanos": kin_cumple,
+            "kin_ano_maya": kin_ano_maya,
+            "constante_personal_kin": constante_personal_kin,
+            "kin_tierra": kin_tierra,
+            "linea_tiempo_personal_kin": kin_linea_tiempo_num
+        },
+        "oraculos_calculados": {
+            "natal": oraculo_natal,
+            "mision": oraculo_mision,
+            "constante_personal": oraculo_constante,
+            "tierra": oraculo_tierra,
+            "linea_tiempo_personal": oraculo_linea_tiempo
+        }
+    }
+    return respuesta_final, (perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo, kins_oraculos)
+
+@app.route("/analisis", methods=["POST"])
+def analisis_integrado():
+    try:
+        fechas = _fechas_del_analisis(request.get_json())
+        try:
+            resultados, errores = _resolver_kins_y_oraculos(*fechas)
+        except TimeoutError:
+            raise ErrorAPI("error", f"Las consultas del análisis superaron el límite de {app.config['ANALISIS_DEADLINE_SECONDS']}s.", 504)
+        respuesta_final, argumentos = _calculo_del_analisis(fechas, resultados, errores)
+    except ErrorAPI as e:
+        return api_response(e.status, e.message), e.codigo
+
+    if _quiere_stream():
+        return _respuesta_sse(respuesta_final, _generar_analisis_en_stream(*argumentos))
+
+    texto_analisis = _generar_analisis_con_gemini(*argumentos)
+
+    # Mismos cálculos que el primer evento del stream, más el texto generado.
+    return api_response("success", "Análisis generado.", {**respuesta_final, "analisis": texto_analisis})
+
+def _parametros_de_busqueda(item, defaults):
+    """Valida una consulta de búsqueda; devuelve (query, k, modo, file_ids) o lanza ValueError."""
+    if isinstance(item, str):
+        item = {"query": item}
+    if not isinstance(item, dict) or not item.get("query"):
+        raise ValueError("Debes indicar 'query' a buscar.")
+    opciones = {**defaults, **item}
+    modo = opciones.get("mode", "hybrid")
+    if modo not in ("hybrid", "vector", "lexical"):
+        raise ValueError("'mode' debe ser 'hybrid', 'vector' o 'lexical'.")
+    try:
+        k = max(1, min(int(opciones.get("k", app.config["RAG_SEARCH_K"])), app.config["RAG_SEARCH_MAX_K"]))
+    except (TypeError, ValueError):
+        raise ValueError("'k' debe ser un entero.")
+    file_ids = opciones.get("file_ids") or None
+    if file_ids is not None and not isinstance(file_ids, list):
+        raise ValueError("'file_ids' debe ser una lista de IDs de archivo.")
+    return item["query"], k, modo, file_ids
+
+def _indice_para_busqueda():
+    """
+    Índice, almacén y metadatos de la generación en servicio, tomados juntos (o None si no está lista).
+    El almacén queda adquirido: quien lo recibe llama a `store.liberar()` al terminar.
+    """
+    refrescar_generacion()
+    with index_lock:
+        index, store, servido = faiss_index, doc_chunks, dict(indice_servido)
+        if not store or (index is None and servido["bm25"] is None):
+            return None
+        store.adquirir()
+    return index, store, servido
+
+@contextmanager
+def _generacion_para_busqueda():
+    """`_indice_para_busqueda` que libera el almacén al salir del bloque."""
+    servicio = _indice_para_busqueda()
+    try:
+        yield servicio
+    finally:
+        if servicio is not None:
+            servicio[1].liberar()
+
+def _clave_busqueda(generacion, query, k, modo, file_ids, nprobe, ef_search):
+    return (generacion, _normalizar_consulta(query), k, modo, tuple(sorted(file_ids)) if file_ids else None, nprobe, ef_search)
+
+def _respuesta_busqueda(resultado):
+    modo_usado, coincidencias = resultado
+    return {"mode": modo_usado, "results": [c["text"] for c in coincidencias], "matches": coincidencias}
+
+@app.route('/rag/search', methods=['POST'])
+def rag_search_endpoint():
+    data = request.get_json(silent=True) or {}
+    try:
+        query, k, modo, file_ids = _parametros_de_busqueda(data, {})
+    except ValueError as e:
+        return api_response("error", str(e)), 400
+    
+    # Índice, almacén y metadatos se toman juntos: pertenecen a la misma generación aunque haya un cambio en curso.
+    with _generacion_para_busqueda() as servicio:
+        if servicio is None:
+            return api_response("service_unavailable", "El índice de búsqueda RAG no está listo o está vacío."), 503
+        index, store, servido = servicio
+
+        clave = _clave_busqueda(servido["generacion"], query, k, modo, file_ids, data.get("nprobe"), data.get("ef_search"))
+        respuesta = search_result_cache.get(clave)
+        if respuesta is not None:
+            return api_response("success", "Resultados de búsqueda semántica.", {"query": query, **respuesta})
+
+        try:
+            resultado = buscar_chunks(query, k, modo, file_ids, index, store, servido,
+                                      nprobe=data.get("nprobe"), ef_search=data.get("ef_search"))
+            if resultado is None:
+                return api_response("error", "No se pudo generar el embedding para la búsqueda."), 500
+            # ## MEJORA: Los chunks se leen por ID desde el almacén mmap, sin parsear JSON.
+            respuesta = _respuesta_busqueda(resultado)
+            search_result_cache.set(clave, respuesta)
+            return api_response("success", "Resultados de búsqueda semántica.", {"query": query, **respuesta})
+        except Exception as e:
+            return api_response("error", f"Error en la búsqueda semántica: {str(e)}", None), 500
+
+@app.route('/rag/search/batch', methods=['POST'])
+def rag_search_batch_endpoint():
+    """
+    Varias búsquedas en una petición. `queries` acepta textos u objetos con query/k/mode/file_ids;
+    k, mode y file_ids del nivel superior sirven de valores por defecto.
+    """
+    data = request.get_json(silent=True) or {}
+    queries = data.get("queries")
+    if not isinstance(queries, list) or not queries:
+        return api_response("error", "El cuerpo debe ser JSON con una lista no vacía 'queries'."), 400
+    if len(queries) > app.config['RAG_BATCH_MAX_QUERIES']:
+        return api_response("error", f"Máximo {app.config['RAG_BATCH_MAX_QUERIES']} consultas por petición."), 400
+
+    with _generacion_para_busqueda() as servicio:
+        if servicio is None:
+            return api_response("service_unavailable", "El índice de búsqueda RAG no está listo o está vacío."), 503
+        index, store, servido = servicio
+        nprobe, ef_search = data.get("nprobe"), data.get("ef_search")
+        defaults = {c: data[c] for c in ("k", "mode", "file_ids") if c in data}
+
+        resultados = [None] * len(queries)
+        pendientes = {}  # clave -> (consulta, posiciones); las consultas repetidas se buscan una vez
+        for i, item in enumerate(queries):
+            try:
+                consulta = _parametros_de_busqueda(item, defaults)
+            except ValueError as e:
+                resultados[i] = {"status": "error", "message": str(e)}
+                continue
+            clave = _clave_busqueda(servido["generacion"], *consulta, nprobe, ef_search)
+            respuesta = search_result_cache.get(clave)
+            if respuesta is not None:
+                resultados[i] = {"status": "success", "query": consulta[0], **respuesta}
+            else:
+                pendientes.setdefault(clave, (consulta, []))[1].append(i)
+
+        if pendientes:
+            try:
+                encontrados = buscar_chunks_lote([c for c, _ in pendientes.values()], index, store, servido, nprobe, ef_search)
+            except Exception as e:
+                return api_response("error", f"Error en la búsqueda semántica por lotes: {str(e)}", None), 500
+            for (clave, (consulta, posiciones)), resultado in zip(pendientes.items(), encontrados):
+                if resultado is None:
+                    item = {"status": "error", "query": consulta[0], "message": "No se pudo generar el embedding para la búsqueda."}
+                else:
+                    respuesta = _respuesta_busqueda(resultado)
+                    search_result_cache.set(clave, respuesta)
+                    item = {"status": "success", "query": consulta[0], **respuesta}
+                for i in posiciones:
+                    resultados[i] = item
+        return api_response("success", f"{len(resultados)} búsquedas procesadas.", {"resultados": resultados})
+
+def vectores_de_generacion_servida():
+    """
+    Vectores (mmap) del estado que corresponde a la generación en servicio. Cualquier worker los lee
+    del manifiesto en disco; devuelve None si no hay generación o el estado ya es de otra.
+    """
+    refrescar_generacion()
+    generacion = indice_servido["generacion"]
+    estado = rag_state
+    if estado.get("generacion_indice") != generacion and os.path.exists(_ruta_manifiesto()):
+        estado = _load_rag_state()
+    if generacion is None or estado.get("generacion_indice") != generacion:
+        return None
+    return estado["vectors"]
+
+_evaluacion_en_curso = threading.Lock()
+
+@app.route('/rag/evaluacion')
+def rag_evaluacion_endpoint():
+    if not app.config['RAG_EVAL_ENDPOINT_ENABLED']:
+        return api_response("error", "La evaluación en línea está deshabilitada (RAG_EVAL_ENDPOINT_ENABLED). Use evaluar_indice.py."), 403
+    try:
+        k = int(request.args.get("k", 10))
+        n_consultas = int(request.args.get("consultas", 100))
+    except ValueError:
+        return api_response("error", "'k' y 'consultas' deben ser enteros."), 400
+    if not 1 <= k <= app.config['RAG_EVAL_MAX_K']:
+        return api_response("error", f"'k' debe ser un entero entre 1 y {app.config['RAG_EVAL_MAX_K']}."), 400
+    if not 1 <= n_consultas <= app.config['RAG_EVAL_MAX_QUERIES']:
+        return api_response("error", f"'consultas' debe ser un entero entre 1 y {app.config['RAG_EVAL_MAX_QUERIES']}."), 400
+    vectores = vectores_de_generacion_servida()
+    if vectores is None or not len(vectores):
+        return api_response("service_unavailable", "No hay vectores indexados para evaluar."), 503
+    if not _evaluacion_en_curso.acquire(blocking=False):
+        return api_response("error", "Ya hay una evaluación en curso en este worker."), 429
+    try:
+        resultado = evaluar_indice_ann(vectores, k=k, n_consultas=n_consultas, max_vectores=app.config['RAG_EVAL_MAX_VECTORS'])
+    finally:
+        _evaluacion_en_curso.release()
+    resultado["indice_activo"] = app.config['RAG_INDEX_TYPE']
+    resultado["generacion"] = indice_servido["generacion"]
+    return api_response("success", "Evaluación recall/latencia frente al índice exacto.", resultado)
+
+@app.route('/rag/status')
+def rag_status_endpoint():
+    refrescar_generacion()
+    with index_lock:
+        status = {
+            "drive_files_found": len(drive_file_index),
+            "is_faiss_index_built": faiss_index is not None,
+            "indexed_chunks_count": len(doc_chunks),
+            "index_generation": indice_servido["generacion"],
+            "bm25_terms": len(indice_servido["bm25"].vocabulario) if indice_servido["bm25"] else 0,
+            "is_sync_leader": _lider_lock_file is not None,
+            "worker_pid": os.getpid(),
+            "caches": {
+                "query_embeddings": query_embedding_cache.estadisticas(),
+                "search_results": search_result_cache.estadisticas(),
+                "document_embeddings": document_embedding_cache.estadisticas(),
+                "analisis": analisis_cache.memoria.estadisticas(),
+            }
+        }
+    return api_response("success", "Estado del sistema RAG.", status)
+
+@app.route('/rag/sync', methods=['POST'])
+def rag_sync_endpoint():
+    threading.Thread(target=background_intelligent_sync).start()
+    return api_response("success", "La sincronización inteligente ha comenzado en segundo plano. Consulta el estado en /rag/status en unos minutos.")
+
+@app.route('/rag/rebuild', methods=['POST'])
+def rag_rebuild_endpoint():
+    threading.Thread(target=force_rebuild_index).start()
+    return api_response("success", "La reconstrucción completa del índice ha comenzado en segundo plano. Consulta el estado en /rag/status en unos minutos.")
+
+@app.route('/rag/download_state', methods=['GET'])
+def download_rag_state():
+    try:
+        return send_file(_ruta_manifiesto(), as_attachment=True)
+    except FileNotFoundError:
+        return api_response("not_found", "El manifiesto del estado del índice (rag_state/manifest.json) no existe aún."), 404
+
+# ========== MODO ASÍNCRONO (ASGI) ==========
+# Con `uvicorn app:asgi_app` las rutas de _RUTAS_ASYNC se atienden en el bucle de eventos: un análisis
+# que espera a Airtable, a Gemini o a un reintento no ocupa un hilo, así un proceso sostiene cientos
+# en vuelo. BM25/FAISS (CPU) van al pool de búsqueda y el resto de rutas a Flask en un pool de hilos.
+_busqueda_executor = ThreadPoolExecutor(max_workers=Config.ASYNC_SEARCH_WORKERS, thread_name_prefix="busqueda")
+_wsgi_executor = ThreadPoolExecutor(max_workers=Config.ASYNC_WSGI_THREADS, thread_name_prefix="wsgi")
+# Kins de TABLE_FECHAS ya resueltos por la ruta async (los errores no se guardan).
+_kins_airtable_async = _LRUCache(512)
+# Semáforo de generaciones simultáneas con Gemini, del bucle que lo creó.
+_limite_gemini_async = (None, None)
+
+def _limite_gemini():
+    global _limite_gemini_async
+    bucle = asyncio.get_running_loop()
+    if _limite_gemini_async[0] is not bucle:
+        _limite_gemini_async = (bucle, asyncio.Semaphore(app.config['ASYNC_GEMINI_MAX_CONCURRENCY']))
+    return _limite_gemini_async[1]
+
+async def _get_kin_from_airtable_async(fecha_str):
+    kin = _kins_airtable_async.get(fecha_str)
+    if kin is not None:
+        return kin
+    for params in _consultas_kin_airtable(fecha_str):
+        try:
+            records = (await airtable.list_records_async(app.config['TABLE_FECHAS'], params)).get("records", [])
+        except requests.exceptions.RequestException as e:
+            print(f"Error en la petición a Airtable (get_kin_from_date): {e}")
+            return None
+        if records:
+            kin = records[0]['fields'].get(app.config['FIELD_ID_KIN_CENTRAL_FECHAS'])
+            if kin is not None:
+                _kins_airtable_async.set(fecha_str, kin)
+            return kin
+    return None
+
+async def get_kin_from_date_async(fecha_str):
+    """`get_kin_from_date` para el modo async: el cálculo local es inmediato y solo Airtable se espera."""
+    if app.config['KIN_ENGINE'] != "airtable":
+        fecha = _fecha_desde_str(fecha_str)
+        if fecha is not None:
+            return kin_local(fecha)
+        if not app.config['KIN_AIRTABLE_FALLBACK']:
+            return None
+    return await _get_kin_from_airtable_async(fecha_str)
+
+async def get_oraculo_from_kin_async(kin):
+    kin_num = _kin_valido(kin)
+    if kin_num is None:
+        return None
+    oraculo = _oraculo_precargado(kin_num)
+    if oraculo is not None:
+        return oraculo
+    try:
+        records = (await airtable.list_records_async(app.config['TABLE_ORACULO'], _consulta_oraculo_airtable(kin_num))).get("records", [])
+    except requests.exceptions.RequestException as e:
+        print(f"Error en la petición a Airtable (get_oraculo_from_kin): {e}")
+        return None
+    return records[0]['fields'] if records else None
+
+async def _ejecutar_grafo_async(grafo, timeout):
+    """`_ejecutar_grafo` sobre el bucle de eventos: cada nodo devuelve un valor (cálculos) o una corrutina (consultas)."""
+    async def nodo(fn, args):
+        valor = fn(*args)
+        return await valor if asyncio.iscoroutine(valor) else valor
+
+    bucle = asyncio.get_running_loop()
+    limite = bucle.time() + timeout
+    resultados, errores = {}, {}
+    pendientes = dict(grafo)
+    en_vuelo = {}
+    try:
+        while pendientes or en_vuelo:
+            for nombre, fn, args in _nodos_listos(pendientes, resultados):
+                en_vuelo[asyncio.ensure_future(nodo(fn, args))] = nombre
+            if not en_vuelo:
+                break
+            hechos, _ = await asyncio.wait(en_vuelo, timeout=max(limite - bucle.time(), 0), return_when=asyncio.FIRST_COMPLETED)
+            if not hechos:
+                raise TimeoutError(f"Grafo incompleto tras {timeout}s: {sorted(en_vuelo.values())}")
+            for tarea in hechos:
+                nombre = en_vuelo.pop(tarea)
+                try:
+                    resultados[nombre] = tarea.result()
+                except Exception as e:
+                    resultados[nombre] = None
+                    errores[nombre] = e
+    finally:
+        # Plazo vencido o petición cancelada: las consultas que quedaban no siguen corriendo.
+        for tarea in en_vuelo:
+            tarea.cancel()
+    return resultados, errores
+
+async def _generar_analisis_con_gemini_async(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo, kins_oraculos=None):
+    """`_generar_analisis_con_gemini` con la API async de Gemini: la espera entre reintentos no bloquea el bucle."""
+    clave = _clave_analisis(perfil, kins_oraculos, [oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo]) if kins_oraculos else None
+    if clave:
+        texto_cacheado = analisis_cache.get(clave)
+        if texto_cacheado is not None:
+            return texto_cacheado
+
+    prompt = _construir_prompt_analisis(perfil, oraculo_natal, oraculo_mision, oraculo_tierra, oraculo_linea_tiempo)
+    try:
+        model = gemini.GenerativeModel(app.config['GENERATION_MODEL'])
+
+        retries = 0
+        delay = 2.0
+        max_retries = 3
+        while retries < max_retries:
+            try:
+                async with _limite_gemini():
+                    with metricas.cronometrar("gemini_generation"):
+                        response = await model.generate_content_async(prompt)
+                if clave:
+                    analisis_cache.set(clave, response.text)
+                return response.text
+            except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded) as e:
+                retries += 1
+                if retries == max_retries:
+                    raise e
+                print(f"  -> Error de cuota/servicio ({type(e).__name__}) al generar análisis. Reintentando en {delay:.1f}s...")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    except Exception as e:
+        print(f"Error al generar análisis con Gemini: {e}")
+        return f"Hubo un error al generar el análisis después de varios intentos: {e}"
+
+async def _embedding_consulta_async(query, max_retries=5):
+    """`get_embedding_with_retries` para una consulta de búsqueda, con la API async de Gemini."""
+    retries = 0
+    delay = 1.0
+    while retries < max_retries:
+        try:
+            with metricas.cronometrar("embedding"):
+                embedding_result = await gemini.embed_content_async(
+                    model=app.config["EMBEDDING_MODEL"],
+                    content=query,
+                    task_type="RETRIEVAL_QUERY"
+                )
+            return embedding_result['embedding']
+        except (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError, google_exceptions.ResourceExhausted) as e:
+            retries += 1
+            if isinstance(e, google_exceptions.ResourceExhausted):
+                embedding_limiter.saturado()
+            print(f"  -> Error de red ({type(e).__name__}) al generar embedding. Reintentando en {delay:.1f}s... (Intento {retries}/{max_retries})")
+            await asyncio.sleep(delay)
+            delay *= 2
+        except Exception as e:
+            print(f"Error inesperado generando embedding: {e}")
+            return None
+    print(f"  -> Fallo al generar embedding después de {max_retries} intentos.")
+    return None
+
+async def get_query_embedding_async(query):
+    clave = EmbeddingConsultaCache.clave(query, "RETRIEVAL_QUERY")
+    emb = query_embedding_cache.get(clave)
+    if emb is None:
+        emb = await _embedding_consulta_async(query)
+        if emb:
+            query_embedding_cache.set(clave, emb)
+    return emb
+
+async def buscar_chunks_async(query, k, modo, file_ids, index, store, servido, nprobe=None, ef_search=None):
+    """`buscar_chunks` para el modo async: BM25 y FAISS corren en el pool de búsqueda y el embedding se espera en el bucle."""
+    bucle = asyncio.get_running_loop()
+    plan = await bucle.run_in_executor(_busqueda_executor, _fase_lexica, query, k, modo, file_ids, index, store, servido)
+    if not _necesita_vectores(plan):
+        return plan["modo"], await bucle.run_in_executor(_busqueda_executor, _combinar, plan, store, servido)
+    emb = await get_query_embedding_async(query)
+    if not emb:
+        return None
+
+    def vectorial_y_combinar():
+        _fase_vectorial([plan], [emb], index, nprobe, ef_search)
+        return _combinar(plan, store, servido)
+    return plan["modo"], await bucle.run_in_executor(_busqueda_executor, vectorial_y_combinar)
+
+# Cada manejador recibe la petición ya leída y devuelve (status, mensaje, datos), lanza ErrorAPI o
+# devuelve None para que la atienda Flask (p. ej. /analisis en streaming SSE).
+async def _kin_async(peticion):
+    fecha_str = peticion["args"].get("fecha")
+    if not fecha_str:
+        raise ErrorAPI("error", "Parámetro 'fecha' es requerido.", 400)
+    fecha_norm = normalizar_fecha_str(fecha_str)
+    if not fecha_norm:
+        raise ErrorAPI("error", f"Formato de fecha inválido: {fecha_str}", 400)
+    kin = await get_kin_from_date_async(fecha_norm)
+    if not kin:
+        raise ErrorAPI("not_found", f"No se encontró Kin para la fecha {fecha_norm}.", 404)
+    return "success", "Kin encontrado", {"fecha": fecha_norm, "kin": kin}
+
+async def _oraculo_async(peticion):
+    kin_str = peticion["args"].get("kin")
+    if not kin_str:
+        raise ErrorAPI("error", "Parámetro 'kin' es requerido.", 400)
+    oraculo = await get_oraculo_from_kin_async(kin_str)
+    if not oraculo:
+        raise ErrorAPI("not_found", f"No se encontró oráculo para el Kin {kin_str}.", 404)
+    return "success", "Oráculo encontrado", oraculo
+
+async def _analisis_async(peticion):
+    if _pide_stream(peticion["args"], peticion["headers"].get("accept", "")):
+        return None
+    # Sin silent, como request.get_json() en Flask: 415 si no es JSON y 400 si no se puede decodificar.
+    fechas = _fechas_del_analisis(peticion["request"].get_json())
+    grafo = _grafo_del_analisis(*fechas, get_kin_from_date_async, get_oraculo_from_kin_async)
+    try:
+        with metricas.cronometrar("analisis_lookups"):
+            resultados, errores = await _ejecutar_grafo_async(grafo, app.config['ANALISIS_DEADLINE_SECONDS'])
+    except TimeoutError:
+        raise ErrorAPI("error", f"Las consultas del análisis superaron el límite de {app.config['ANALISIS_DEADLINE_SECONDS']}s.", 504)
+    respuesta_final, argumentos = _calculo_del_analisis(fechas, resultados, errores)
+    texto_analisis = await _generar_analisis_con_gemini_async(*argumentos)
+    return "success", "Análisis generado.", {**respuesta_final, "analisis": texto_analisis}
+
+async def _rag_search_async(peticion):
+    data = peticion["json"] or {}
+    try:
+        query, k, modo, file_ids = _parametros_de_busqueda(data, {})
+    except ValueError as e:
+        raise ErrorAPI("error", str(e), 400)
+
+    bucle = asyncio.get_running_loop()
+    # Puede abrir una generación recién publicada (mmap del almacén y del índice): va al pool.
+    pendiente = bucle.run_in_executor(_busqueda_executor, _indice_para_busqueda)
+    try:
+        servicio = await asyncio.shield(pendiente)
+    except asyncio.CancelledError:
+        # El hilo termina de todos modos y deja el almacén adquirido: se libera cuando acabe.
+        pendiente.add_done_callback(_liberar_servicio_abandonado)
+        raise
+    if servicio is None:
+        raise ErrorAPI("service_unavailable", "El índice de búsqueda RAG no está listo o está vacío.", 503)
+    try:
+        return await _rag_search_en_generacion(data, query, k, modo, file_ids, *servicio)
+    finally:
+        servicio[1].liberar()
+
+def _liberar_servicio_abandonado(futuro):
+    if not futuro.cancelled() and futuro.exception() is None and futuro.result() is not None:
+        futuro.result()[1].liberar()
+
+async def _rag_search_en_generacion(data, query, k, modo, file_ids, index, store, servido):
+    clave = _clave_busqueda(servido["generacion"], query, k, modo, file_ids, data.get("nprobe"), data.get("ef_search"))
+    respuesta = search_result_cache.get(clave)
+    if respuesta is None:
+        try:
+            resultado = await buscar_chunks_async(query, k, modo, file_ids, index, store, servido,
+                                                  nprobe=data.get("nprobe"), ef_search=data.get("ef_search"))
+        except Exception as e:
+            raise ErrorAPI("error", f"Error en la búsqueda semántica: {str(e)}", 500)
+        if resultado is None:
+            raise ErrorAPI("error", "No se pudo generar el embedding para la búsqueda.", 500)
+        respuesta = _respuesta_busqueda(resultado)
+        search_result_cache.set(clave, respuesta)
+    return "success", "Resultados de búsqueda semántica.", {"query": query, **respuesta}
+
+_RUTAS_ASYNC = {
+    ("GET", "/kin"): _kin_async,
+    ("GET", "/oraculo"): _oraculo_async,
+    ("POST", "/analisis"): _analisis_async,
+    ("POST", "/rag/search"): _rag_search_async,
+}
+
+async def _leer_cuerpo(receive):
+    partes = []
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] != "http.request":
+            break
+        partes.append(mensaje.get("body", b""))
+        if not mensaje.get("more_body"):
+            break
+    return b"".join(partes)
+
+def _peticion_asgi(scope, cuerpo):
+    """
+    Método, argumentos de la URL (primer valor de cada uno, como request.args.get), cabeceras, JSON
+    del cuerpo (como get_json(silent=True)) y el Request de Flask, para leer el cuerpo con sus mismas reglas.
+    """
+    headers = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+    args = {k: v[0] for k, v in parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True).items()}
+    peticion_flask = app.request_class(_entorno_wsgi(scope, cuerpo))
+    return {"metodo": scope["method"], "args": args, "headers": headers, "json": peticion_flask.get_json(silent=True), "request": peticion_flask}
+
+async def _enviar(send, peticion, codigo, cuerpo, cabeceras):
+    cabeceras = [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in cabeceras if k.lower() != "content-length"]
+    cabeceras.append((b"content-length", str(len(cuerpo)).encode("latin-1")))
+    # Las mismas cabeceras que CORS(app) añade a las rutas de Flask (origen, Vary...), calculadas por flask-cors.
+    cors = get_cors_headers(get_cors_options(app), peticion["headers"], peticion["metodo"])
+    cabeceras += [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in cors.items(multi=True) if v]
+    await send({"type": "http.response.start", "status": codigo, "headers": cabeceras})
+    await send({"type": "http.response.body", "body": cuerpo})
+
+async def _enviar_json(send, peticion, codigo, status, message, data=None):
+    # Mismo sobre y serialización que api_response/jsonify.
+    cuerpo = (app.json.dumps({"status": status, "message": message, "data": data or {}}, separators=(",", ":")) + "\n").encode("utf-8")
+    await _enviar(send, peticion, codigo, cuerpo, [("content-type", "application/json")])
+
+async def _enviar_error_http(send, peticion, error):
+    """Código, cuerpo HTML y cabeceras con los que Flask responde un HTTPException no manejado."""
+    respuesta = error.get_response()
+    await _enviar(send, peticion, respuesta.status_code, respuesta.get_data(), respuesta.headers.items())
+
+def _entorno_wsgi(scope, cuerpo):
+    servidor = scope.get("server") or ("localhost", 80)
+    cliente = scope.get("client") or ("", 0)
+    entorno = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": servidor[0],
+        "SERVER_PORT": str(servidor[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": cliente[0],
+        "CONTENT_LENGTH": str(len(cuerpo)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(cuerpo),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for nombre, valor in scope["headers"]:
+        nombre = nombre.decode("latin-1").upper().replace("-", "_")
+        valor = valor.decode("latin-1")
+        if nombre == "CONTENT_LENGTH":
+            continue
+        clave = nombre if nombre == "CONTENT_TYPE" else f"HTTP_{nombre}"
+        entorno[clave] = f"{entorno[clave]},{valor}" if clave in entorno else valor
+    return entorno
+
+def _ejecutar_wsgi(entorno, bucle, cola):
+    """
+    Corre la app Flask en un hilo del pool y pasa el inicio de la respuesta y cada bloque del cuerpo a la
+    cola del bucle. Todo el cuerpo se itera en el mismo hilo: los generadores con stream_with_context
+    (SSE, NDJSON) necesitan que el contexto de la petición se abra y se cierre en un único hilo.
+    """
+    def start_response(status, headers, exc_info=None):
+        cabeceras = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+        bucle.call_soon_threadsafe(cola.put_nowait, ("inicio", int(status.split(" ", 1)[0]), cabeceras))
+
+    try:
+        respuesta = app(entorno, start_response)
+        try:
+            for bloque in respuesta:
+                if bloque:
+                    bucle.call_soon_threadsafe(cola.put_nowait, ("cuerpo", bloque))
+        finally:
+            if hasattr(respuesta, "close"):
+                respuesta.close()
+    finally:
+        bucle.call_soon_threadsafe(cola.put_nowait, ("fin",))
+
+async def _servir_con_flask(scope, cuerpo, send):
+    bucle = asyncio.get_running_loop()
+    cola = asyncio.Queue()
+    hilo = bucle.run_in_executor(_wsgi_executor, _ejecutar_wsgi, _entorno_wsgi(scope, cuerpo), bucle, cola)
+    iniciada = False
+    while (mensaje := await cola.get())[0] != "fin":
+        if mensaje[0] == "inicio":
+            iniciada = True
+            await send({"type": "http.response.start", "status": mensaje[1], "headers": mensaje[2]})
+        else:
+            await send({"type": "http.response.body", "body": mensaje[1], "more_body": True})
+    try:
+        await hilo
+    except Exception as e:
+        print(f"Error no controlado al servir {scope['path']} con Flask (modo ASGI): {e}")
+        if not iniciada:
+            # La app falló antes de start_response: el servidor ASGI exige el inicio antes de cualquier cuerpo.
+            respuesta = InternalServerError().get_response()
+            cabeceras = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in respuesta.headers.items()]
+            await send({"type": "http.response.start", "status": 500, "headers": cabeceras})
+            await send({"type": "http.response.body", "body": respuesta.get_data()})
+            return
+    await send({"type": "http.response.body", "body": b""})
+
+async def _ciclo_de_vida(receive, send):
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "lifespan.startup":
+            print(f"Modo ASGI activo en el worker {os.getpid()}: {', '.join(ruta for _, ruta in _RUTAS_ASYNC)} en el bucle de eventos.")
+            await send({"type": "lifespan.startup.complete"})
+        elif mensaje["type"] == "lifespan.shutdown":
+            if hasattr(airtable, "cerrar_async"):
+                await airtable.cerrar_async()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def asgi_app(scope, receive, send):
+    """
+    Punto de entrada ASGI (`uvicorn app:asgi_app`). /kin, /oraculo, /analisis y /rag/search se
+    resuelven con corrutinas; cualquier otra ruta, o /analisis con streaming, la atiende Flask.
+    """
+    if scope["type"] == "lifespan":
+        await _ciclo_de_vida(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    cuerpo = await _leer_cuerpo(receive)
+    manejador = _RUTAS_ASYNC.get((scope["method"], scope["path"]))
+    # Con el RAG deshabilitado, Flask responde el 503 de /rag/* (ver _rag_segun_rol).
+    if manejador is not None and (app.config['RAG_ENABLED'] or not scope["path"].startswith("/rag/")):
+        inicio = time.perf_counter()
+        peticion = _peticion_asgi(scope, cuerpo)
+        codigo, error = 200, None
+        try:
+            resultado = await manejador(peticion)
+        except ErrorAPI as e:
+            resultado, codigo = (e.status, e.message, None), e.codigo
+        except HTTPException as e:
+            resultado, codigo, error = None, e.code, e
+        except Exception as e:
+            # Como Flask fuera de modo debug: la traza va al log y el cliente recibe el 500 genérico.
+            app.logger.error(f"Exception on {scope['path']} [{scope['method']}]", exc_info=e)
+            resultado, codigo, error = None, 500, InternalServerError(original_exception=e)
+        if error is not None:
+            await _enviar_error_http(send, peticion, error)
+            _anotar_peticion(scope["path"], scope["method"], codigo, inicio)
+            return
+        if resultado is not None:
+            await _enviar_json(send, peticion, codigo, *resultado)
+            _anotar_peticion(scope["path"], scope["method"], codigo, inicio)
+            return
+    await _servir_con_flask(scope, cuerpo, send)
+
+# ========== INICIALIZACIÓN DE LA APLICACIÓN ==========
+_marcar_arranque("modulo")
+# Con `python app.py`, multiprocessing reejecuta este archivo como __mp_main__ en cada proceso del
+# pool de extracción: ahí no se arrancan el refresco de oráculos ni la sincronización.
+if __name__ != "__mp_main__":
+    with app.app_context():
+        threading.Thread(target=_ciclo_refresco_oraculo, daemon=True).start()
+        if app.config['RAG_ENABLED'] and app.config['RAG_SYNC_ON_STARTUP']:
+            # Diferida: FAISS, Drive y GCS se importan y cargan después de que el worker ya atiende peticiones.
+            threading.Timer(app.config['RAG_SYNC_START_DELAY_SECONDS'], background_intelligent_sync).start()
+_marcar_arranque("inicializacion")
+print(f"Arranque en {time.perf_counter() - _inicio_arranque:.2f}s: " + ", ".join(f"{etapa} {seg:.2f}s" for etapa, seg in arranque["etapas"].items()))
+
+if __name__ == '__main__':
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)), debug=False)
\ No newline at end of file
@@ -0,0 +1,438 @@
+"""
+Sustitutos locales y deterministas de Airtable, Google Drive, Google Cloud Storage y Gemini.
+
+Se activan con BACKENDS=local (ver `Config` en app.py) y permiten correr la API y benchmark.py
+sin red. Cada backend simula latencia (media con jitter) y puede inyectar errores con la misma
+forma que los servicios reales, para ejercitar los reintentos.
+"""
+import asyncio
+import datetime
+import hashlib
+import os
+import random
+import re
+import shutil
+import threading
+import time
+
+import httplib2
+import numpy as np
+import requests
+from google.api_core import exceptions as google_exceptions
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+SELLOS = [
+    "Dragón", "Viento", "Noche", "Semilla", "Serpiente", "Enlazador de Mundos", "Mano", "Estrella",
+    "Luna", "Perro", "Mono", "Humano", "Caminante del Cielo", "Mago", "Águila", "Guerrero",
+    "Tierra", "Espejo", "Tormenta", "Sol",
+]
+TONOS = [
+    "Magnético", "Lunar", "Eléctrico", "Auto-existente", "Entonado", "Rítmico", "Resonante",
+    "Galáctico", "Solar", "Planetario", "Espectral", "Cristal", "Cósmico",
+]
+_PALABRAS = (
+    "kin tono sello oráculo guía análogo antípoda oculto luna tun katún sincronario calendario "
+    "tzolkin haab ciclo energía intención servicio memoria despertar poder forma medida "
+    "atención propósito desafío reto radial cubo onda encantada castillo galaxia tierra "
+    "semilla florecer navegar espacio tiempo sueño abundancia corazón sabiduría intuición"
+).split() + [s.lower() for s in SELLOS] + [t.lower() for t in TONOS]
+
+class Simulador:
+    """Latencia simulada y errores inyectados de un backend, con contadores de llamadas."""
+    def __init__(self, latencia_ms=0.0, tasa_error=0.0, semilla=0):
+        self.latencia = latencia_ms / 1000.0
+        self.tasa_error = tasa_error
+        self._rng = random.Random(semilla)
+        self._lock = threading.Lock()
+        self.llamadas = 0
+        self.errores = 0
+
+    def _sortear(self):
+        with self._lock:
+            self.llamadas += 1
+            espera = self.latencia * self._rng.uniform(0.5, 1.5) if self.latencia else 0.0
+            falla = self._rng.random() < self.tasa_error
+            if falla:
+                self.errores += 1
+        return espera, falla
+
+    def llamada(self, crear_error):
+        """Espera la latencia simulada y, con probabilidad `tasa_error`, lanza `crear_error()`."""
+        espera, falla = self._sortear()
+        if espera:
+            time.sleep(espera)
+        if falla:
+            raise crear_error()
+
+    async def llamada_async(self, crear_error):
+        """Igual que `llamada`, pero la latencia se espera sin bloquear el bucle de eventos."""
+        espera, falla = self._sortear()
+        if espera:
+            await asyncio.sleep(espera)
+        if falla:
+            raise crear_error()
+
+    def estadisticas(self):
+        return {"llamadas": self.llamadas, "errores": self.errores}
+
+# ========== AIRTABLE ==========
+def campos_oraculo(kin, config):
+    """Registro de TABLE_ORACULO de un Kin, con las reglas del Sincronario para guía/análogo/antípoda/oculto."""
+    sello = (kin - 1) % 20 + 1  # 1 = Dragón ... 20 = Sol
+    tono = (kin - 1) % 13 + 1
+    desplazamiento_guia = {1: 0, 2: 12, 3: 4, 4: 16, 0: 8}[tono % 5]
+    nombre = lambda n: SELLOS[(n - 1) % 20]
+    return {
+        config['FIELD_ID_KIN_CENTRAL_ORACULO']: kin,
+        config['FIELD_ID_IDKIN']: kin,
+        config['FIELD_ID_SELLO']: SELLOS[sello - 1],
+        config['FIELD_ID_NUM_SELLO']: sello % 20,
+        config['FIELD_ID_TONO']: tono,
+        config['FIELD_ID_GUIA']: nombre(sello + desplazamiento_guia),
+        config['FIELD_ID_ANALOGO']: nombre(19 - sello),
+        config['FIELD_ID_ANTIPODA']: nombre(sello + 10),
+        config['FIELD_ID_OCULTO']: nombre(21 - sello),
+    }
+
+class AirtableLocal:
+    """Misma interfaz que `AirtableClient.list_records` (y su variante async), con TABLE_FECHAS y TABLE_ORACULO generadas en memoria."""
+    def __init__(self, config, kin_de_fecha, simulador):
+        self.config = config
+        self.kin_de_fecha = kin_de_fecha
+        self.simulador = simulador
+
+    @staticmethod
+    def _error():
+        return requests.exceptions.ConnectionError("Error inyectado por el backend local de Airtable")
+
+    def list_records(self, table, params):
+        self.simulador.llamada(self._error)
+        return self._registros(table, params)
+
+    async def list_records_async(self, table, params):
+        await self.simulador.llamada_async(self._error)
+        return self._registros(table, params)
+
+    def _registros(self, table, params):
+        formula = params.get("filterByFormula", "")
+        if table == self.config['TABLE_FECHAS']:
+            m = re.search(r"'(\d{1,2})/(\d{1,2})/(\d{4})'", formula)
+            try:
+                fecha = datetime.date(int(m.group(3)), int(m.group(2)), int(m.group(1))) if m else None
+            except ValueError:
+                fecha = None
+            if fecha is None:
+                return {"records": []}
+            fields = {self.config['FIELD_ID_FECHA']: fecha.isoformat(), self.config['FIELD_ID_KIN_CENTRAL_FECHAS']: self.kin_de_fecha(fecha)}
+            return {"records": [{"id": f"rec{fecha.toordinal()}", "fields": fields}]}
+        if table == self.config['TABLE_ORACULO']:
+            m = re.search(r"=\s*(\d+)\s*$", formula)
+            if m:
+                kin = int(m.group(1))
+                return {"records": [{"id": f"kin{kin}", "fields": campos_oraculo(kin, self.config)}] if 1 <= kin <= 260 else []}
+            tamano = int(params.get("pageSize", 100))
+            inicio = int(params.get("offset", 0))
+            fin = min(inicio + tamano, 260)
+            payload = {"records": [{"id": f"kin{kin}", "fields": campos_oraculo(kin, self.config)} for kin in range(inicio + 1, fin + 1)]}
+            if fin < 260:
+                payload["offset"] = str(fin)
+            return payload
+        return {"records": []}
+
+# ========== GEMINI ==========
+def _error_gemini():
+    return google_exceptions.ServiceUnavailable("Error inyectado por el backend local de Gemini")
+
+class _RespuestaLocal:
+    def __init__(self, text):
+        self.text = text
+
+class _ModeloLocal:
+    def __init__(self, gemini, nombre):
+        self.gemini = gemini
+        self.nombre = nombre
+
+    def _texto(self, prompt):
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        palabras = [rng.choice(_PALABRAS) for _ in range(self.gemini.palabras_por_respuesta)]
+        return f"Análisis local ({self.nombre}). " + " ".join(palabras) + "."
+
+    def generate_content(self, prompt, stream=False):
+        self.gemini.simulador.llamada(_error_gemini)
+        texto = self._texto(prompt)
+        if not stream:
+            return _RespuestaLocal(texto)
+        return iter([_RespuestaLocal(texto[i:i + 80]) for i in range(0, len(texto), 80)])
+
+    async def generate_content_async(self, prompt):
+        await self.gemini.simulador.llamada_async(_error_gemini)
+        return _RespuestaLocal(self._texto(prompt))
+
+class GeminiLocal:
+    """Sustituto del módulo google.generativeai: `embed_content` (y `_async`) y `GenerativeModel` deterministas."""
+    def __init__(self, simulador, dimension=768, palabras_por_respuesta=300):
+        self.simulador = simulador
+        self.dimension = dimension
+        self.palabras_por_respuesta = palabras_por_respuesta
+
+    def _vector(self, texto):
+        # Bolsa de palabras con hashing: textos que comparten palabras quedan cerca, como con un modelo real.
+        v = np.zeros(self.dimension, dtype=np.float32)
+        for palabra in re.findall(r"\w+", texto.casefold()):
+            h = int.from_bytes(hashlib.blake2b(palabra.encode("utf-8"), digest_size=8).digest(), "little")
+            v[h % self.dimension] += 1.0 if h >> 63 else -1.0
+        norma = np.linalg.norm(v)
+        return (v / norma if norma else v).tolist()
+
+    def _embeddings(self, content):
+        if isinstance(content, list):
+            return {"embedding": [self._vector(t) for t in content]}
+        return {"embedding": self._vector(content)}
+
+    def embed_content(self, model, content, task_type=None, **kwargs):
+        self.simulador.llamada(_error_gemini)
+        return self._embeddings(content)
+
+    async def embed_content_async(self, model, content, task_type=None, **kwargs):
+        await self.simulador.llamada_async(_error_gemini)
+        return self._embeddings(content)
+
+    def GenerativeModel(self, nombre):
+        return _ModeloLocal(self, nombre)
+
+# ========== GOOGLE DRIVE ==========
+def _error_http(motivo="Error inyectado por el backend local de Drive"):
+    return HttpError(httplib2.Response({"status": "503"}), motivo.encode("utf-8"))
+
+class _Peticion:
+    """Equivalente a la petición de googleapiclient: el trabajo ocurre en `execute()`."""
+    def __init__(self, simulador, funcion):
+        self.simulador = simulador
+        self.funcion = funcion
+
+    def execute(self, num_retries=0):
+        self.simulador.llamada(_error_http)
+        return self.funcion()
+
+class _HttpLocal:
+    """Objeto `http` mínimo para que MediaIoBaseDownload descargue desde memoria sin cambios."""
+    def __init__(self, drive, file_id):
+        self.drive = drive
+        self.file_id = file_id
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        try:
+            self.drive.simulador.llamada(_error_http)
+        except HttpError:
+            return httplib2.Response({"status": "503"}), b""
+        contenido = self.drive.contenido(self.file_id)
+        return httplib2.Response({"status": "200", "content-length": str(len(contenido))}), contenido
+
+class _ArchivosLocal:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q, pageSize=100, pageToken=None, **kwargs):
+        carpeta = q.split("'")[1]
+        def ejecutar():
+            hijos = self.drive.hijos(carpeta)
+            inicio = int(pageToken or 0)
+            payload = {"files": hijos[inicio:inicio + pageSize]}
+            if inicio + pageSize < len(hijos):
+                payload["nextPageToken"] = str(inicio + pageSize)
+            return payload
+        return _Peticion(self.drive.simulador, ejecutar)
+
+    def get_media(self, fileId, **kwargs):
+        return HttpRequest(_HttpLocal(self.drive, fileId), None, f"local://drive/{fileId}")
+
+    def export_media(self, fileId, mimeType=None, **kwargs):
+        return self.get_media(fileId)
+
+class _CambiosLocal:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def getStartPageToken(self, **kwargs):
+        return _Peticion(self.drive.simulador, lambda: {"startPageToken": str(len(self.drive.cambios))})
+
+    def list(self, pageToken, pageSize=1000, **kwargs):
+        def ejecutar():
+            with self.drive.lock:
+                inicio = int(pageToken)
+                pagina = self.drive.cambios[inicio:inicio + pageSize]
+                if inicio + pageSize < len(self.drive.cambios):
+                    return {"changes": pagina, "nextPageToken": str(inicio + pageSize)}
+                return {"changes": pagina, "newStartPageToken": str(len(self.drive.cambios))}
+        return _Peticion(self.drive.simulador, ejecutar)
+
+class DriveLocal:
+    """
+    Servicio de Drive v3 en memoria con un corpus sintético de `n_archivos` archivos de texto
+    repartidos en subcarpetas de la carpeta raíz. Es seguro entre hilos, así que todos los hilos
+    de descarga pueden compartir la misma instancia.
+    """
+    CARPETA_MIME = "application/vnd.google-apps.folder"
+
+    def __init__(self, carpeta_raiz, n_archivos, tamano_kb, simulador, archivos_por_carpeta=50, semilla=0):
+        self.carpeta_raiz = carpeta_raiz
+        self.tamano = tamano_kb * 1024
+        self.simulador = simulador
+        self.semilla = semilla
+        self.lock = threading.Lock()
+        self.archivos = {}
+        self.cambios = []
+        self.siguiente = n_archivos
+        for i in range(n_archivos):
+            carpeta = f"{carpeta_raiz}-sub{i // archivos_por_carpeta}" if archivos_por_carpeta else carpeta_raiz
+            if carpeta != carpeta_raiz and carpeta not in self.archivos:
+                self.archivos[carpeta] = self._meta(carpeta, carpeta, self.CARPETA_MIME, carpeta_raiz, 1)
+            file_id = f"doc{i:06d}"
+            self.archivos[file_id] = self._meta(file_id, f"Documento {i}.txt", "text/plain", carpeta, 1)
+
+    @staticmethod
+    def _meta(file_id, nombre, mime, padre, version):
+        return {
+            "id": file_id, "name": nombre, "mimeType": mime, "parents": [padre], "trashed": False,
+            "modifiedTime": f"2024-01-01T00:00:{version:02d}.000Z", "version": version,
+        }
+
+    def files(self):
+        return _ArchivosLocal(self)
+
+    def changes(self):
+        return _CambiosLocal(self)
+
+    def hijos(self, carpeta):
+        with self.lock:
+            return [dict(m) for m in self.archivos.values() if m["parents"] == [carpeta] and not m["trashed"]]
+
+    def contenido(self, file_id):
+        """
+        Texto determinista por (archivo, versión), del tamaño configurado, en párrafos. Cada versión
+        reescribe un solo párrafo de la anterior, como una edición real de un documento.
+        """
+        meta = self.archivos[file_id]
+        rng = random.Random(f"{self.semilla}-{file_id}")
+        parrafos, total = [], 0
+        while total < self.tamano:
+            parrafos.append(_parrafo(rng))
+            total += len(parrafos[-1]) + 2
+        for version in range(1, meta["version"] + 1):
+            rng = random.Random(f"{self.semilla}-{file_id}-{version}")
+            parrafos[rng.randrange(len(parrafos))] = _parrafo(rng)
+        return "\n\n".join(parrafos).encode("utf-8")
+
+    def modificar(self, file_ids):
+        """Sube la versión de esos archivos y lo anota en el feed de cambios (sincronización incremental)."""
+        with self.lock:
+            for file_id in file_ids:
+                meta = self.archivos[file_id]
+                meta["version"] += 1
+                meta["modifiedTime"] = f"2024-01-01T00:{meta['version'] // 60:02d}:{meta['version'] % 60:02d}.000Z"
+                self.cambios.append({"fileId": file_id, "removed": False, "file": dict(meta)})
+
+    def agregar(self, n):
+        """Crea `n` documentos nuevos en la carpeta raíz y los anota en el feed. Devuelve sus IDs."""
+        with self.lock:
+            nuevos = []
+            for i in range(self.siguiente, self.siguiente + n):
+                file_id = f"doc{i:06d}"
+                self.archivos[file_id] = self._meta(file_id, f"Documento {i}.txt", "text/plain", self.carpeta_raiz, 1)
+                self.cambios.append({"fileId": file_id, "removed": False, "file": dict(self.archivos[file_id])})
+                nuevos.append(file_id)
+            self.siguiente += n
+            return nuevos
+
+    def eliminar(self, file_ids):
+        """Borra esos archivos de forma definitiva: el feed solo trae `removed`, sin metadatos."""
+        with self.lock:
+            for file_id in file_ids:
+                del self.archivos[file_id]
+                self.cambios.append({"fileId": file_id, "removed": True})
+
+    def ids_de_documentos(self):
+        return [f_id for f_id, m in self.archivos.items() if m["mimeType"] != self.CARPETA_MIME]
+
+def _parrafo(rng):
+    frases = (" ".join(rng.choice(_PALABRAS) for _ in range(rng.randint(6, 16))).capitalize() + "." for _ in range(rng.randint(3, 8)))
+    return " ".join(frases)
+
+# ========== GOOGLE CLOUD STORAGE ==========
+class _BlobLocal:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.ruta = os.path.join(bucket.raiz, name)
+
+    def exists(self):
+        self.bucket.simulador.llamada(lambda: google_exceptions.ServiceUnavailable("Error inyectado por el backend local de GCS"))
+        return os.path.exists(self.ruta)
+
+    def download_to_filename(self, destino):
+        self.bucket.simulador.llamada(lambda: google_exceptions.ServiceUnavailable("Error inyectado por el backend local de GCS"))
+        if not os.path.exists(self.ruta):
+            raise google_exceptions.NotFound(f"No existe el objeto {self.name}")
+        shutil.copyfile(self.ruta, destino)
+
+    def download_as_bytes(self, start=None, end=None):
+        """Como en google-cloud-storage, `end` es inclusivo."""
+        self.bucket.simulador.llamada(lambda: google_exceptions.ServiceUnavailable("Error inyectado por el backend local de GCS"))
+        try:
+            with open(self.ruta, "rb") as f:
+                f.seek(start or 0)
+                return f.read(-1 if end is None else end - (start or 0) + 1)
+        except FileNotFoundError:
+            raise google_exceptions.NotFound(f"No existe el objeto {self.name}")
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket.simulador.llamada(lambda: google_exceptions.ServiceUnavailable("Error inyectado por el backend local de GCS"))
+        os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+        tmp = f"{self.ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+        os.replace(tmp, self.ruta)
+
+    def upload_from_filename(self, origen):
+        self.bucket.simulador.llamada(lambda: google_exceptions.ServiceUnavailable("Error inyectado por el backend local de GCS"))
+        os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+        tmp = f"{self.ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(origen, tmp)
+        os.replace(tmp, self.ruta)
+
+    def delete(self):
+        self.bucket.simulador.llamada(lambda: google_exceptions.ServiceUnavailable("Error inyectado por el backend local de GCS"))
+        os.remove(self.ruta)
+        # GCS no tiene directorios: los que quedan vacíos se quitan hasta la raíz del bucket.
+        directorio = os.path.dirname(self.ruta)
+        while directorio != self.bucket.raiz and not os.listdir(directorio):
+            os.rmdir(directorio)
+            directorio = os.path.dirname(directorio)
+
+class _BucketLocal:
+    def __init__(self, raiz, simulador):
+        self.raiz = raiz
+        self.simulador = simulador
+
+    def blob(self, name):
+        return _BlobLocal(self, name)
+
+    def list_blobs(self, prefix=""):
+        self.simulador.llamada(lambda: google_exceptions.ServiceUnavailable("Error inyectado por el backend local de GCS"))
+        for directorio, _, archivos in os.walk(self.raiz):
+            for archivo in archivos:
+                if archivo.endswith(".tmp"):
+                    continue
+                nombre = os.path.relpath(os.path.join(directorio, archivo), self.raiz).replace(os.sep, "/")
+                if nombre.startswith(prefix):
+                    yield _BlobLocal(self, nombre)
+
+class GCSLocal:
+    """Cliente de Cloud Storage respaldado por un directorio: `bucket(nombre).blob(ruta)` con la interfaz básica."""
+    def __init__(self, raiz, simulador):
+        self.raiz = raiz
+        self.simulador = simulador
+
+    def bucket(self, nombre):
+        return _BucketLocal(os.path.join(self.raiz, nombre), self.simulador)
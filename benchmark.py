@@ -0,0 +1,319 @@
+"""Benchmark offline del Oráculo Maya.
+
+Levanta la app con los backends locales de backends_locales.py (sin red ni credenciales) y mide:
+arranque, sincronización completa e incremental del índice RAG (con lo que lleva publicar la
+generación), memoria que añade un worker al abrir el índice y carga concurrente sobre /kin,
+/oraculo, /analisis y /rag/search. Imprime un informe JSON reproducible.
+
+Uso:
+    python benchmark.py --archivos 200 --peticiones 2000 --concurrencia 8 --latencia-ms 20
+    python benchmark.py --modo async --concurrencia 200 --latencia-ms 200
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CONSULTAS_RAG = [
+    "kin solar", "sello del águila y la tierra", "onda encantada del mono",
+    "tono magnético y propósito", "energía del guerrero cósmico", "oráculo de la semilla",
+    "luna resonante", "espejo y tormenta", "caminante del cielo espectral", "mago blanco",
+]
+
+
+def _parsear_argumentos():
+    parser = argparse.ArgumentParser(description="Benchmark offline con backends locales.")
+    parser.add_argument("--archivos", type=int, default=200, help="Documentos del corpus sintético de Drive.")
+    parser.add_argument("--tamano-kb", type=int, default=8, help="Tamaño aproximado de cada documento (KB).")
+    parser.add_argument("--peticiones", type=int, default=1000, help="Peticiones por endpoint en la prueba de carga.")
+    parser.add_argument("--concurrencia", type=int, default=8, help="Clientes concurrentes (hilos en modo sync, corrutinas en async).")
+    parser.add_argument("--modo", choices=("sync", "async"), default="sync", help="Carga contra la app Flask (sync) o contra asgi_app (async).")
+    parser.add_argument("--latencia-ms", type=float, default=0, help="Latencia simulada por llamada a backend.")
+    parser.add_argument("--tasa-error", type=float, default=0, help="Fracción de llamadas a backend que fallan.")
+    parser.add_argument("--modificados", type=float, default=0.1, help="Fracción del corpus modificada antes de la sync incremental.")
+    parser.add_argument("--endpoints", default="kin,oraculo,analisis,rag_search", help="Endpoints a cargar, separados por comas.")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--directorio", default=None, help="Directorio de datos (por defecto, uno temporal).")
+    parser.add_argument("--salida", default=None, help="Fichero JSON del informe (por defecto, stdout).")
+    return parser.parse_args()
+
+
+def _configurar_entorno(args, directorio):
+    """El entorno se fija antes de importar app: Config lee os.environ al cargarse."""
+    os.environ.update({
+        "BACKENDS": "local",
+        "RENDER_DISK_PATH": directorio,
+        "RAG_SYNC_ON_STARTUP": "false",
+        "LOCAL_BACKEND_LATENCY_MS": str(args.latencia_ms),
+        "LOCAL_BACKEND_ERROR_RATE": str(args.tasa_error),
+        "LOCAL_BACKEND_SEED": str(args.semilla),
+        "LOCAL_CORPUS_FILES": str(args.archivos),
+        "LOCAL_CORPUS_FILE_KB": str(args.tamano_kb),
+        "LOCAL_GCS_DIR": os.path.join(directorio, "gcs"),
+    })
+    # Sin cuota real que respetar: el limitador de embeddings no debe dominar la medida.
+    os.environ.setdefault("EMBEDDING_RATE_INITIAL", "1000")
+    os.environ.setdefault("EMBEDDING_RATE_MAX", "1000")
+
+
+def _percentiles(tiempos):
+    if not tiempos:
+        return {}
+    orden = sorted(tiempos)
+
+    def p(q):
+        return round(orden[min(len(orden) - 1, int(q * len(orden)))] * 1000, 3)
+    return {
+        "media_ms": round(statistics.fmean(orden) * 1000, 3),
+        "p50_ms": p(0.50), "p90_ms": p(0.90), "p99_ms": p(0.99),
+        "max_ms": round(orden[-1] * 1000, 3),
+    }
+
+
+def _publicacion(app_module):
+    """Segundos acumulados publicando generaciones y bytes de la última, según las métricas del proceso."""
+    familias = app_module.metricas.familias
+    histograma = familias.get("oraculo_stage_duration_seconds", {}).get("series", {}).get((("stage", "index_publish"),))
+    escritos = familias.get("rag_index_generation_bytes", {}).get("series", {}).get((), 0)
+    return (histograma[-1] if histograma else 0.0), escritos
+
+
+def _medir_sync(app_module):
+    """
+    Duración de una sincronización, con la parte que lleva reescribir la generación del índice
+    (se publica entera en cada sync, ver `publicar_generacion`).
+    """
+    chunks_antes = len(app_module.doc_chunks)
+    publicacion_antes, _ = _publicacion(app_module)
+    inicio = time.perf_counter()
+    app_module.background_intelligent_sync()
+    segundos = time.perf_counter() - inicio
+    publicacion, escritos = _publicacion(app_module)
+    return segundos, len(app_module.doc_chunks), chunks_antes, {
+        "publicacion_segundos": round(publicacion - publicacion_antes, 3),
+        "publicacion_mb": round(escritos / 2**20, 2),
+    }
+
+
+_CODIGO_RESTAURACION = """
+import json, sys, time
+inicio = time.perf_counter()
+import app
+importado = time.perf_counter()
+restaurado = app.restaurar_snapshot()
+listo = time.perf_counter()
+respuesta = app.app.test_client().post("/rag/search", json={"query": "kin solar", "k": 3})
+fin = time.perf_counter()
+print(json.dumps({"restaurado": restaurado, "arranque_segundos": round(importado - inicio, 3),
+                  "restauracion_segundos": round(listo - importado, 3), "primera_busqueda_ms": round((fin - listo) * 1000, 3),
+                  "primera_busqueda_status": respuesta.status_code}))
+"""
+
+
+def _medir_restauracion(directorio):
+    """Instancia nueva (otro proceso y otro disco) que restaura el snapshot publicado en el bucket local."""
+    entorno = dict(os.environ, RENDER_DISK_PATH=os.path.join(directorio, "instancia_nueva"))
+    os.makedirs(entorno["RENDER_DISK_PATH"], exist_ok=True)
+    inicio = time.perf_counter()
+    proceso = subprocess.run([sys.executable, "-c", _CODIGO_RESTAURACION], env=entorno, capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    total = time.perf_counter() - inicio
+    try:
+        resultado = json.loads(proceso.stdout.strip().splitlines()[-1])
+    except (IndexError, json.JSONDecodeError):
+        return {"error": proceso.stderr[-2000:]}
+    resultado["proceso_segundos"] = round(total, 3)
+    return resultado
+
+
+_CODIGO_MEMORIA_WORKER = """
+import json, os, sys
+import numpy as np
+import app
+app.faiss.IndexFlatL2
+
+def memoria():
+    with open("/proc/self/status") as f:
+        campos = dict(l.split(":", 1) for l in f if l.startswith(("RssAnon", "RssFile")))
+    return {k: int(v.split()[0]) * 1024 for k, v in campos.items()}
+
+antes = memoria()
+app.refrescar_generacion(forzar=True)
+app.app.test_client().post("/rag/search", json={"query": "kin solar", "k": 3, "mode": "vector"})
+despues = memoria()
+ruta = app._ruta_en_generacion(app.indice_servido["generacion"], app.app.config["GCS_BLOB_NAME_FAISS"])
+print(json.dumps({"indice_mb": round(os.path.getsize(ruta) / 2**20, 2),
+                  "anonima_mb": round((despues["RssAnon"] - antes["RssAnon"]) / 2**20, 2),
+                  "mapeada_mb": round((despues["RssFile"] - antes["RssFile"]) / 2**20, 2)}))
+"""
+
+
+def _medir_memoria_worker(directorio):
+    """
+    Memoria que suma un worker nuevo al abrir la generación publicada y buscar: la anónima es propia
+    de cada worker; la mapeada son páginas del page cache compartidas entre todos.
+    """
+    if not os.path.exists("/proc/self/status"):
+        return {"error": "Solo disponible en Linux (/proc/self/status)."}
+    proceso = subprocess.run([sys.executable, "-c", _CODIGO_MEMORIA_WORKER], env=dict(os.environ, RENDER_DISK_PATH=directorio),
+                             capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return json.loads(proceso.stdout.strip().splitlines()[-1])
+    except (IndexError, json.JSONDecodeError):
+        return {"error": proceso.stderr[-2000:]}
+
+
+def _peticiones_de(endpoint, rng, n):
+    """Genera (método, ruta, cuerpo) deterministas para un endpoint."""
+    peticiones = []
+    for _ in range(n):
+        if endpoint == "kin":
+            fecha = f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(1950, 2030)}"
+            peticiones.append(("GET", f"/kin?fecha={fecha}", None))
+        elif endpoint == "oraculo":
+            peticiones.append(("GET", f"/oraculo?kin={rng.randint(1, 260)}", None))
+        elif endpoint == "analisis":
+            fecha = f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(1950, 2010)}"
+            peticiones.append(("POST", "/analisis", {"fecha_nacimiento": fecha}))
+        elif endpoint == "rag_search":
+            peticiones.append(("POST", "/rag/search", {"query": rng.choice(CONSULTAS_RAG), "k": 3}))
+        else:
+            raise ValueError(f"Endpoint desconocido: {endpoint}")
+    return peticiones
+
+
+def _carga(app_module, endpoint, peticiones, concurrencia):
+    local = threading.local()
+    tiempos, errores = [], []
+    lock = threading.Lock()
+
+    def ejecutar(peticion):
+        if not hasattr(local, "cliente"):
+            local.cliente = app_module.app.test_client()
+        metodo, ruta, cuerpo = peticion
+        inicio = time.perf_counter()
+        respuesta = local.cliente.open(ruta, method=metodo, json=cuerpo)
+        duracion = time.perf_counter() - inicio
+        with lock:
+            tiempos.append(duracion)
+            if respuesta.status_code >= 400:
+                errores.append(respuesta.status_code)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as executor:
+        list(executor.map(ejecutar, peticiones))
+    return _resumen_carga(peticiones, tiempos, errores, time.perf_counter() - inicio)
+
+
+def _carga_async(app_module, endpoint, peticiones, concurrencia):
+    """Misma carga contra asgi_app: `concurrencia` corrutinas cliente sobre un único bucle de eventos."""
+    import httpx
+
+    async def correr():
+        tiempos, errores = [], []
+        pendientes = iter(peticiones)
+        transporte = httpx.ASGITransport(app=app_module.asgi_app)
+        async with httpx.AsyncClient(transport=transporte, base_url="http://benchmark") as cliente:
+            async def trabajador():
+                for metodo, ruta, cuerpo in pendientes:
+                    inicio = time.perf_counter()
+                    respuesta = await cliente.request(metodo, ruta, json=cuerpo)
+                    tiempos.append(time.perf_counter() - inicio)
+                    if respuesta.status_code >= 400:
+                        errores.append(respuesta.status_code)
+
+            inicio = time.perf_counter()
+            await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+            return tiempos, errores, time.perf_counter() - inicio
+
+    return _resumen_carga(peticiones, *asyncio.run(correr()))
+
+
+def _resumen_carga(peticiones, tiempos, errores, total):
+    resultado = {
+        "peticiones": len(peticiones),
+        "errores": len(errores),
+        "codigos_error": {str(c): errores.count(c) for c in sorted(set(errores))},
+        "segundos": round(total, 3),
+        "peticiones_por_segundo": round(len(peticiones) / total, 1) if total else None,
+    }
+    resultado.update(_percentiles(tiempos))
+    return resultado
+
+
+def main():
+    args = _parsear_argumentos()
+    # Los logs de la app van a stderr: stdout queda solo para el informe JSON.
+    with contextlib.redirect_stdout(sys.stderr):
+        informe = _ejecutar(args)
+    texto = json.dumps(informe, ensure_ascii=False, indent=2)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+        print(f"Informe escrito en {args.salida}", file=sys.stderr)
+    else:
+        print(texto)
+
+
+def _ejecutar(args):
+    directorio = args.directorio or tempfile.mkdtemp(prefix="oraculo-bench-")
+    _configurar_entorno(args, directorio)
+
+    inicio = time.perf_counter()
+    import app as app_module
+    informe = {
+        "configuracion": {k: v for k, v in vars(args).items() if k != "salida"} | {"directorio": directorio},
+        "arranque_segundos": round(time.perf_counter() - inicio, 3),
+    }
+
+    segundos, chunks, _, publicacion = _medir_sync(app_module)
+    informe["sync_completa"] = {
+        "segundos": round(segundos, 3),
+        "archivos": args.archivos,
+        "chunks": chunks,
+        "archivos_por_segundo": round(args.archivos / segundos, 1) if segundos else None,
+        "chunks_por_segundo": round(chunks / segundos, 1) if segundos else None,
+        **publicacion,
+    }
+
+    ids = app_module.drive_local.ids_de_documentos()
+    modificados = random.Random(args.semilla).sample(ids, max(1, int(len(ids) * args.modificados))) if ids else []
+    app_module.drive_local.modificar(modificados)
+    segundos, chunks, _, publicacion = _medir_sync(app_module)
+    informe["sync_incremental"] = {
+        "segundos": round(segundos, 3),
+        "archivos_modificados": len(modificados),
+        "chunks": chunks,
+        **publicacion,
+    }
+
+    informe["restauracion_snapshot"] = _medir_restauracion(directorio)
+    informe["memoria_worker"] = _medir_memoria_worker(directorio)
+
+    rng = random.Random(args.semilla)
+    informe["carga"] = {}
+    for endpoint in [e.strip() for e in args.endpoints.split(",") if e.strip()]:
+        peticiones = _peticiones_de(endpoint, rng, args.peticiones)
+        carga = _carga_async if args.modo == "async" else _carga
+        informe["carga"][endpoint] = carga(app_module, endpoint, peticiones, args.concurrencia)
+
+    informe["backends"] = {
+        "airtable": app_module.airtable.simulador.estadisticas(),
+        "gemini": app_module.gemini.simulador.estadisticas(),
+        "drive": app_module.drive_local.simulador.estadisticas(),
+        "gcs": app_module.gcs_local.simulador.estadisticas(),
+    }
+    return informe
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Evaluación offline de recall@k y latencia de los tipos de índice FAISS.
+
+Lee los vectores de la generación en servicio desde el disco de datos (RENDER_DISK_PATH) sin
+levantar el servidor ni hablar con Drive, y los compara contra la búsqueda exacta con IVF-Flat,
+IVF-PQ y HNSW. Con --archivos se construye antes un índice sobre el corpus sintético de
+backends_locales.py, para probar configuraciones sin datos reales. Imprime un informe JSON.
+
+Uso:
+    RENDER_DISK_PATH=/var/data python evaluar_indice.py --k 10 --consultas 200
+    python evaluar_indice.py --archivos 500 --k 10
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+
+
+def _parsear_argumentos():
+    parser = argparse.ArgumentParser(description="Recall/latencia de los índices FAISS frente a la búsqueda exacta.")
+    parser.add_argument("--directorio", default=os.environ.get("RENDER_DISK_PATH"),
+                        help="Disco de datos con el índice publicado (por defecto, RENDER_DISK_PATH).")
+    parser.add_argument("--archivos", type=int, default=0,
+                        help="Sincroniza antes un corpus sintético local de este tamaño (en un directorio temporal si no hay --directorio).")
+    parser.add_argument("--k", type=int, default=10, help="Vecinos por consulta (recall@k).")
+    parser.add_argument("--consultas", type=int, default=100, help="Consultas muestreadas del propio corpus.")
+    parser.add_argument("--max-vectores", type=int, default=0, help="Muestra del corpus sobre la que se construyen los índices (0 = todo).")
+    parser.add_argument("--salida", default=None, help="Fichero JSON del informe (por defecto, stdout).")
+    args = parser.parse_args()
+    if args.k < 1 or args.consultas < 1:
+        parser.error("--k y --consultas deben ser al menos 1.")
+    if not args.directorio and not args.archivos:
+        parser.error("Indique --directorio (o RENDER_DISK_PATH) o --archivos.")
+    return args
+
+
+def _configurar_entorno(args):
+    """El entorno se fija antes de importar app: Config lee os.environ al cargarse."""
+    directorio = args.directorio or tempfile.mkdtemp(prefix="oraculo-evaluacion-")
+    # Solo se lee el disco: los backends locales evitan credenciales y cualquier llamada de red.
+    os.environ.update({"RENDER_DISK_PATH": directorio, "RAG_SYNC_ON_STARTUP": "false", "BACKENDS": "local"})
+    if args.archivos:
+        os.environ.update({
+            "LOCAL_CORPUS_FILES": str(args.archivos),
+            "LOCAL_GCS_DIR": os.path.join(directorio, "gcs"),
+        })
+        os.environ.setdefault("EMBEDDING_RATE_INITIAL", "1000")
+        os.environ.setdefault("EMBEDDING_RATE_MAX", "1000")
+
+
+def main():
+    args = _parsear_argumentos()
+    # Los logs de la app van a stderr: stdout queda solo para el informe JSON.
+    with contextlib.redirect_stdout(sys.stderr):
+        informe = _evaluar(args)
+    texto = json.dumps(informe, ensure_ascii=False, indent=2)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+        print(f"Informe escrito en {args.salida}", file=sys.stderr)
+    else:
+        print(texto)
+
+
+def _evaluar(args):
+    _configurar_entorno(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+
+    if args.archivos:
+        app_module.background_intelligent_sync()
+    vectores = app_module.vectores_de_generacion_servida()
+    if vectores is None or not len(vectores):
+        sys.exit("No hay una generación del índice con vectores en el directorio indicado.")
+    informe = app_module.evaluar_indice_ann(vectores, k=args.k, n_consultas=args.consultas, max_vectores=args.max_vectores or None)
+    informe["indice_activo"] = app_module.app.config["RAG_INDEX_TYPE"]
+    informe["generacion"] = app_module.indice_servido["generacion"]
+    return informe
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Extracción de texto y chunking de los documentos de Drive.
+
+Corre en los procesos del pool de extracción (ver `_chunks_en_pipeline` en app.py), por eso no
+depende de app.py ni tiene efectos al importarse: los procesos hijos, creados con forkserver,
+importan solo este módulo. pdfplumber y python-docx se cargan en el primer documento que los necesita.
+Un documento se extrae en lotes acotados (`extraer_lote`): cada llamada devuelve unos cientos de
+chunks y un estado pequeño para continuar, así ni el proceso hijo ni el pickle de vuelta crecen con
+el tamaño del documento.
+"""
+import re
+import zlib
+
+def segmentos_de_texto(ruta, parser_mime_type, desde=0):
+    """
+    Produce (siguiente, pagina, texto) sin cargar el documento entero como un solo string: PDF
+    página a página (liberando la caché de cada página), DOCX párrafo a párrafo y texto plano por
+    párrafos. `pagina` es None fuera de los PDF. `siguiente` es la posición desde la que retomar
+    tras ese segmento (índice de página o de párrafo, u offset en bytes del texto plano), y `desde`
+    una posición ya devuelta. Retomar un DOCX vuelve a abrirlo: python-docx lo carga entero.
+    """
+    if 'pdf' in parser_mime_type:
+        import pdfplumber
+        with pdfplumber.open(ruta) as pdf:
+            for numero, page in enumerate(pdf.pages[desde:], start=desde + 1):
+                texto = page.extract_text() or ""
+                page.close()
+                yield numero, numero, texto
+    elif 'wordprocessingml' in parser_mime_type:
+        import docx
+        for numero, para in enumerate(docx.Document(ruta).paragraphs[desde:], start=desde + 1):
+            yield numero, None, para.text
+    else:
+        with open(ruta, 'rb') as f:
+            f.seek(desde)
+            bloque = []
+            for linea in iter(f.readline, b""):
+                linea = linea.decode('utf-8', errors='ignore')
+                if linea.strip():
+                    bloque.append(linea)
+                if bloque and (not linea.strip() or len(bloque) >= 200):
+                    yield f.tell(), None, "".join(bloque)
+                    bloque = []
+            if bloque:
+                yield f.tell(), None, "".join(bloque)
+
+_FIN_DE_ORACION = re.compile(r'(?<=[.!?…:;])\s+')
+
+def _unidades(texto, tamano):
+    """Divide un segmento en párrafos y oraciones de como mucho `tamano` caracteres."""
+    for parrafo in re.split(r'\n\s*\n', texto):
+        parrafo = " ".join(parrafo.split())
+        if not parrafo:
+            continue
+        if len(parrafo) <= tamano:
+            yield parrafo, True
+            continue
+        oraciones = _FIN_DE_ORACION.split(parrafo)
+        for i, oracion in enumerate(oraciones):
+            # Una oración más larga que un chunk se corta en el último espacio antes del límite.
+            while len(oracion) > tamano:
+                corte = oracion.rfind(" ", 0, tamano)
+                corte = corte if corte > 0 else tamano
+                yield oracion[:corte], False
+                oracion = oracion[corte:].lstrip()
+            if oracion:
+                yield oracion, i == len(oraciones) - 1
+
+class Fragmentador:
+    """
+    Chunker incremental: recibe (pagina, texto) y produce (chunk, pagina) acumulando párrafos y
+    oraciones enteras hasta `tamano` caracteres. Pasada la mitad de `tamano`, también corta al
+    final de un párrafo o de una oración cuyo hash lo elija: así los cortes dependen del contenido
+    local y, tras editar un párrafo, los chunks siguientes vuelven a coincidir con los anteriores
+    (y la caché de embeddings los reconoce). Cada chunk nuevo arranca con las últimas oraciones del
+    anterior que quepan en `solape`. Solo retiene el chunk en curso, que es todo su `estado`.
+    """
+    def __init__(self, tamano, solape, estado=None):
+        self.tamano = tamano
+        self.solape = solape
+        self.actual, self.largo, self.nuevas = estado or ([], 0, 0)
+
+    @property
+    def estado(self):
+        return self.actual, self.largo, self.nuevas
+
+    def agregar(self, pagina, texto):
+        for unidad, fin_de_parrafo in _unidades(texto, self.tamano):
+            if self.nuevas and self.largo + len(unidad) > self.tamano:
+                yield self._cortar(min(self.solape, self.tamano - len(unidad) - 1))
+            self.actual.append((unidad, fin_de_parrafo, pagina))
+            self.largo += len(unidad) + 1
+            self.nuevas += 1
+            if self.largo >= self.tamano // 2 and (fin_de_parrafo or zlib.crc32(unidad.encode("utf-8")) % 8 == 0):
+                yield self._cortar(self.solape)
+
+    def cerrar(self):
+        if self.nuevas:
+            yield _unir(self.actual), self.actual[0][2]
+
+    def _cortar(self, solape):
+        chunk = (_unir(self.actual), self.actual[0][2])
+        self.actual = _arrastre(self.actual, solape)
+        self.largo, self.nuevas = sum(len(u) + 1 for u, _, _ in self.actual), 0
+        return chunk
+
+def fragmentar(segmentos, tamano, solape):
+    """`Fragmentador` sobre un iterable de (pagina, texto)."""
+    fragmentador = Fragmentador(tamano, solape)
+    for pagina, texto in segmentos:
+        yield from fragmentador.agregar(pagina, texto)
+    yield from fragmentador.cerrar()
+
+def _arrastre(unidades, limite):
+    """Últimas unidades que caben en `limite` caracteres (sin repetir el chunk entero): el solape."""
+    arrastre, largo = [], 0
+    for unidad in reversed(unidades[1:]):
+        largo += len(unidad[0]) + 1
+        if largo > limite:
+            break
+        arrastre.insert(0, unidad)
+    return arrastre
+
+def _unir(unidades):
+    partes = []
+    for unidad, fin_de_parrafo, _ in unidades:
+        partes.append(unidad)
+        partes.append("\n\n" if fin_de_parrafo else " ")
+    return "".join(partes[:-1])
+
+def extraer_lote(ruta, parser_mime_type, file_id, tamano, solape, max_chunks, estado=None):
+    """
+    Extrae y fragmenta un archivo ya descargado desde `estado` (None: el principio) hasta juntar
+    al menos `max_chunks` chunks, cortando al final de un segmento, o hasta terminar. Es CPU
+    intensivo para PDF/DOCX: corre en el pool de procesos. Devuelve ([(chunk, pagina), ...],
+    estado para el lote siguiente o None al terminar). Los lotes encadenados dan los mismos chunks
+    que un solo recorrido. Si el documento falla a medias, se devuelve lo extraído y se termina.
+    """
+    posicion, pendiente = estado or (0, None)
+    fragmentador = Fragmentador(tamano, solape, pendiente)
+    chunks = []
+    try:
+        for posicion, pagina, texto in segmentos_de_texto(ruta, parser_mime_type, posicion):
+            chunks.extend(fragmentador.agregar(pagina, texto))
+            if len(chunks) >= max_chunks:
+                return chunks, (posicion, fragmentador.estado)
+        chunks.extend(fragmentador.cerrar())
+    except Exception as e:
+        print(f"Error al parsear el contenido del archivo {file_id}: {e}")
+    return chunks, None
+
+def extraer_chunks(ruta, parser_mime_type, file_id, tamano, solape):
+    """Todos los chunks de un archivo en un solo recorrido, sin lotes. Devuelve [(chunk, pagina), ...]."""
+    try:
+        return list(fragmentar(((pagina, texto) for _, pagina, texto in segmentos_de_texto(ruta, parser_mime_type)), tamano, solape))
+    except Exception as e:
+        print(f"Error al parsear el contenido del archivo {file_id}: {e}")
+        return []
@@ -0,0 +1,44 @@
+"""
+La app lee su configuración al importarse, así que el entorno de prueba se fija antes del primer
+`import app`: backends locales deterministas (backends_locales.py), sin sincronización al arrancar
+y con el disco y el bucket en un directorio temporal.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_DISCO = tempfile.mkdtemp(prefix="oraculo-pruebas-")
+os.environ.update({
+    "BACKENDS": "local",
+    "RENDER_DISK_PATH": _DISCO,
+    "LOCAL_GCS_DIR": os.path.join(_DISCO, "gcs"),
+    "RAG_SYNC_ON_STARTUP": "false",
+    "LOCAL_BACKEND_LATENCY_MS": "0",
+    "LOCAL_BACKEND_ERROR_RATE": "0",
+    "LOCAL_CORPUS_FILES": "12",
+    "LOCAL_CORPUS_FILE_KB": "8",
+    "EMBEDDING_RATE_INITIAL": "1000",
+    "EMBEDDING_RATE_MAX": "1000",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as modulo_app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app_local():
+    return modulo_app
+
+
+@pytest.fixture
+def client(app_local):
+    return app_local.app.test_client()
+
+
+@pytest.fixture
+def indice_sincronizado(app_local):
+    """Índice al día con el Drive local (la primera vez se construye completo)."""
+    app_local.background_intelligent_sync()
+    return app_local
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from airtable_client import AirtableClient
+
+
+@pytest.fixture
+def airtable_con_429():
+    """Responde 429 (con Retry-After: 0) a la primera llamada y 200 a las siguientes."""
+    llamadas = []
+
+    class Manejador(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            llamadas.append(self.headers.get("Authorization"))
+            if "falla" in self.path:
+                self.send_response(503)
+                self.end_headers()
+                return
+            if len(llamadas) == 1:
+                self.send_response(429)
+                self.send_header("Retry-After", "0")
+                self.end_headers()
+                return
+            cuerpo = json.dumps({"records": [{"fields": {"Kin": 164}}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{servidor.server_port}", llamadas
+    servidor.shutdown()
+
+
+def test_reintenta_429_y_mide_cada_llamada(airtable_con_429):
+    url, llamadas = airtable_con_429
+    etapas = []
+
+    class Cronometro:
+        def __init__(self, etapa):
+            etapas.append(etapa)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    cliente = AirtableClient(url, "secreto", 50, 1, 5, 2, 2, cronometrar=Cronometro)
+    assert cliente.list_records("Fechas", {"f": 1}) == {"records": [{"fields": {"Kin": 164}}]}
+    assert llamadas == ["Bearer secreto", "Bearer secreto"]
+    assert etapas == ["airtable"]
+
+
+def test_errores_async_se_lanzan_como_requests(airtable_con_429):
+    url, _ = airtable_con_429
+    cliente = AirtableClient(url, "secreto", 50, 1, 5, 0, 2)
+
+    async def escenario():
+        try:
+            await cliente.list_records_async("falla", {})
+        finally:
+            await cliente.cerrar_async()
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        asyncio.run(escenario())
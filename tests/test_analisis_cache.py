@@ -0,0 +1,46 @@
+import os
+import time
+
+
+def _oraculos(texto="luz"):
+    return [{"Sello": "Dragón", "Luz": texto}, {"Sello": "Viento"}, {"Sello": "Noche"}, {"Sello": "Semilla"}]
+
+
+def test_clave_cambia_con_el_contenido_de_los_oraculos(app_local):
+    kins = [1, 2, 3, 4, 5]
+    base = app_local._clave_analisis("perfil", kins, _oraculos())
+    assert base == app_local._clave_analisis("perfil", kins, _oraculos())
+    assert base != app_local._clave_analisis("perfil", kins, _oraculos("luz editada en Airtable"))
+
+
+def _envejecer(ruta, segundos):
+    instante = time.time() - segundos
+    os.utime(ruta, (instante, instante))
+
+
+def test_entrada_vencida_en_disco_es_un_fallo(app_local, tmp_path):
+    cache = app_local.AnalisisCache(8, str(tmp_path), ttl=3600)
+    cache.set("ab" * 32, "texto")
+    _envejecer(cache._ruta("ab" * 32), 7200)
+
+    otra = app_local.AnalisisCache(8, str(tmp_path), ttl=3600)
+    assert otra.get("ab" * 32) is None
+
+
+def test_poda_borra_vencidos_y_respeta_el_tope(app_local, tmp_path):
+    cache = app_local.AnalisisCache(8, str(tmp_path), ttl=3600, max_bytes=3000)
+    cache._ultima_poda = time.monotonic()  # sin poda en segundo plano durante las escrituras
+    claves = [f"{i:02d}" * 32 for i in range(6)]
+    for i, clave in enumerate(claves):
+        cache.set(clave, "x" * 1000)
+        _envejecer(cache._ruta(clave), 600 - i)  # la primera clave es la más antigua
+    _envejecer(cache._ruta(claves[0]), 7200)
+
+    assert cache._poda_lock.acquire(blocking=False)
+    cache.podar()
+
+    quedan = [c for c in claves if os.path.exists(cache._ruta(c))]
+    assert claves[0] not in quedan
+    assert sum(os.path.getsize(cache._ruta(c)) for c in quedan) <= 3000
+    assert quedan == claves[-len(quedan):]
+    assert not cache._poda_lock.locked()
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+# Cuerpo que no se envía como JSON: bytes con su propio Content-Type.
+Crudo = namedtuple("Crudo", "datos tipo")
+
+PETICIONES = [
+    ("GET", "/kin?fecha=26/07/2013", None),
+    ("GET", "/kin", None),
+    ("GET", "/kin?fecha=no-es-fecha", None),
+    ("GET", "/oraculo?kin=5", None),
+    ("GET", "/oraculo?kin=999", None),
+    ("POST", "/analisis", {"fecha_nacimiento": "01/02/1990", "fecha_consulta": "05/05/2024"}),
+    ("POST", "/analisis", {}),
+    ("POST", "/analisis", Crudo(b"fecha_nacimiento=01/02/1990", "application/x-www-form-urlencoded")),
+    ("POST", "/analisis", Crudo(b'{"fecha_nacimiento": ', "application/json")),
+    ("POST", "/rag/search", {"query": "kin solar", "k": 2}),
+    ("POST", "/rag/search", {"query": "energía del guerrero cósmico", "k": 2, "mode": "vector"}),
+    ("POST", "/rag/search", {}),
+    ("POST", "/rag/search", {"query": "kin solar", "k": 2, "nprobe": "no-es-numero"}),
+]
+
+
+def _argumentos(cuerpo):
+    if isinstance(cuerpo, Crudo):
+        return {"content": cuerpo.datos, "headers": {"Content-Type": cuerpo.tipo}}
+    return {"json": cuerpo}
+
+
+def _por_asgi(app_local, peticiones, cabeceras=None):
+    async def ejecutar():
+        transporte = httpx.ASGITransport(app=app_local.asgi_app)
+        async with httpx.AsyncClient(transport=transporte, base_url="http://prueba") as cliente:
+            respuestas = []
+            for metodo, ruta, cuerpo in peticiones:
+                argumentos = _argumentos(cuerpo)
+                argumentos["headers"] = {**argumentos.get("headers", {}), **(cabeceras or {})}
+                respuestas.append(await cliente.request(metodo, ruta, **argumentos))
+            return respuestas
+    return asyncio.run(ejecutar())
+
+
+def _cabeceras_cors(cabeceras):
+    return {k.lower(): v for k, v in cabeceras.items() if k.lower().startswith("access-control") or k.lower() == "vary"}
+
+
+@pytest.mark.parametrize("metodo, ruta, cuerpo", PETICIONES)
+def test_misma_respuesta_que_flask(indice_sincronizado, client, metodo, ruta, cuerpo):
+    if isinstance(cuerpo, Crudo):
+        flask = client.open(ruta, method=metodo, data=cuerpo.datos, content_type=cuerpo.tipo)
+    else:
+        flask = client.open(ruta, method=metodo, json=cuerpo)
+    [asgi] = _por_asgi(indice_sincronizado, [(metodo, ruta, cuerpo)])
+    assert asgi.status_code == flask.status_code
+    assert asgi.content == flask.data
+    assert asgi.headers["content-type"] == flask.headers["Content-Type"]
+
+
+def test_error_no_controlado_igual_que_flask_sin_filtrar_el_mensaje(app_local, client, monkeypatch):
+    def falla(fechas, resultados, errores):
+        raise RuntimeError("detalle interno que no debe salir")
+    monkeypatch.setattr(app_local, "_calculo_del_analisis", falla)
+    cuerpo = {"fecha_nacimiento": "01/02/1990", "fecha_consulta": "05/05/2024"}
+
+    flask = client.post("/analisis", json=cuerpo)
+    [asgi] = _por_asgi(app_local, [("POST", "/analisis", cuerpo)])
+    assert asgi.status_code == flask.status_code == 500
+    assert asgi.content == flask.data
+    assert b"detalle interno" not in asgi.content
+    assert asgi.headers["content-type"] == flask.headers["Content-Type"]
+
+
+def test_fallo_antes_de_start_response_envia_el_inicio(app_local, monkeypatch):
+    def app_rota(entorno, start_response):
+        raise RuntimeError("sin respuesta")
+    monkeypatch.setattr(app_local, "app", app_rota, raising=True)
+    mensajes = []
+
+    async def enviar(mensaje):
+        mensajes.append(mensaje)
+
+    async def ejecutar():
+        scope = {"type": "http", "method": "GET", "path": "/calendario", "query_string": b"", "headers": []}
+        await app_local._servir_con_flask(scope, b"", enviar)
+    asyncio.run(ejecutar())
+    assert [m["type"] for m in mensajes] == ["http.response.start", "http.response.body"]
+    assert mensajes[0]["status"] == 500
+
+
+def test_analisis_json_trae_los_calculos_del_stream(app_local, client):
+    cuerpo = {"fecha_nacimiento": "01/02/1990", "fecha_consulta": "05/05/2024"}
+    datos = client.post("/analisis", json=cuerpo).get_json()["data"]
+    stream = client.post("/analisis?stream=1", json=cuerpo).get_data(as_text=True)
+    primero = stream.split("\n\n")[0]
+    assert primero.startswith("event: calculo\n")
+    calculo = json.loads(primero.split("data: ", 1)[1])
+    assert {k: datos[k] for k in calculo} == calculo
+    assert datos["analisis"]
+
+
+@pytest.mark.parametrize("cabeceras", [None, {"Origin": "https://app.ejemplo.com"}])
+def test_mismas_cabeceras_cors_que_flask(app_local, client, cabeceras):
+    flask = client.get("/kin?fecha=01/01/2000", headers=cabeceras)
+    [asgi] = _por_asgi(app_local, [("GET", "/kin?fecha=01/01/2000", None)], cabeceras)
+    assert asgi.content == flask.data
+    assert _cabeceras_cors(asgi.headers) == _cabeceras_cors(flask.headers)
+
+
+def test_rutas_sin_version_async_las_atiende_flask(app_local, client):
+    ruta = "/calendario?desde=01/01/2024&hasta=03/01/2024"
+    [asgi] = _por_asgi(app_local, [("GET", ruta, None)])
+    flask = client.get(ruta)
+    assert asgi.status_code == flask.status_code == 200
+    assert asgi.headers["content-type"] == flask.headers["Content-Type"]
+    assert asgi.content == flask.data
+
+
+@pytest.fixture
+def airtable_lento():
+    """Airtable falso que tarda en responder y cuenta las llamadas HTTP recibidas."""
+    llamadas = []
+
+    class Manejador(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            llamadas.append(self.path)
+            time.sleep(0.3)
+            cuerpo = json.dumps({"records": [{"fields": {"Kin": 7}}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{servidor.server_port}", llamadas
+    servidor.shutdown()
+
+
+def test_cancelar_la_peticion_duena_no_cancela_la_llamada_compartida(app_local, airtable_lento):
+    url, llamadas = airtable_lento
+    cliente = app_local.AirtableClient(url, "token", 50, 1, 5, 0, 4)
+
+    async def escenario():
+        duena = asyncio.ensure_future(cliente.list_records_async("Fechas", {"f": 1}))
+        await asyncio.sleep(0.05)
+        otras = [asyncio.ensure_future(cliente.list_records_async("Fechas", {"f": 1})) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        duena.cancel()
+        resultados = await asyncio.gather(*otras)
+        await cliente.cerrar_async()
+        return duena, resultados
+
+    duena, resultados = asyncio.run(escenario())
+    assert duena.cancelled()
+    assert all(r["records"][0]["fields"]["Kin"] == 7 for r in resultados)
+    assert len(llamadas) == 1
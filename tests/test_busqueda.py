@@ -0,0 +1,31 @@
+import pytest
+
+
+@pytest.fixture
+def sin_indice_vectorial(indice_sincronizado, monkeypatch):
+    """Generación servida con BM25 pero sin índice FAISS (p. ej. falló su lectura)."""
+    monkeypatch.setattr(indice_sincronizado, "faiss_index", None)
+    indice_sincronizado.search_result_cache.clear()
+
+    def sin_embeddings(*args, **kwargs):
+        raise AssertionError("sin índice vectorial no se piden embeddings")
+    monkeypatch.setattr(indice_sincronizado, "get_query_embedding", sin_embeddings)
+    monkeypatch.setattr(indice_sincronizado, "get_query_embeddings", sin_embeddings)
+    return indice_sincronizado
+
+
+@pytest.mark.parametrize("modo", ["vector", "hybrid"])
+def test_sin_indice_vectorial_se_busca_con_bm25(sin_indice_vectorial, client, modo):
+    respuesta = client.post("/rag/search", json={"query": "kin solar", "k": 3, "mode": modo})
+    assert respuesta.status_code == 200
+    datos = respuesta.get_json()["data"]
+    assert datos["mode"] == "lexical"
+    assert len(datos["matches"]) == 3
+    assert all(m["bm25"] is not None for m in datos["matches"])
+
+
+def test_lote_sin_indice_vectorial_se_busca_con_bm25(sin_indice_vectorial, client):
+    respuesta = client.post("/rag/search/batch", json={"queries": ["onda encantada"], "mode": "vector", "k": 2})
+    assert respuesta.status_code == 200
+    resultado = respuesta.get_json()["data"]["resultados"][0]
+    assert resultado["mode"] == "lexical" and len(resultado["matches"]) == 2
@@ -0,0 +1,41 @@
+import os
+import threading
+
+
+def _clave(app_local, texto):
+    return app_local.CacheEmbeddingsDocumento.clave(texto, "RETRIEVAL_DOCUMENT")
+
+
+def test_claves_repetidas_en_un_lote_ocupan_una_fila(app_local, tmp_path):
+    ruta = str(tmp_path / "cache.bin")
+    cache = app_local.CacheEmbeddingsDocumento(ruta, 100)
+    a, b = _clave(app_local, "uno"), _clave(app_local, "dos")
+    cache.agregar([(a, [1.0, 2.0]), (b, [3.0, 4.0]), (a, [1.0, 2.0])])
+
+    assert len(cache.filas) == 2
+    assert os.path.getsize(ruta) == cache.CABECERA + 2 * cache._tam_registro
+    assert cache.get(b) == [3.0, 4.0]
+
+
+def test_escritores_concurrentes_no_duplican_claves(app_local, tmp_path):
+    ruta = str(tmp_path / "cache.bin")
+    cache = app_local.CacheEmbeddingsDocumento(ruta, 1000)
+    pares = [(_clave(app_local, f"texto {i}"), [float(i), 0.5]) for i in range(200)]
+    hilos = [threading.Thread(target=cache.agregar, args=(pares,)) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    recargada = app_local.CacheEmbeddingsDocumento(ruta, 1000)
+    assert len(recargada.filas) == 200
+    assert all(recargada.get(c) == e for c, e in pares)
+
+
+def test_lecturas_ven_lo_anexado_despues_de_mapear(app_local, tmp_path):
+    cache = app_local.CacheEmbeddingsDocumento(str(tmp_path / "cache.bin"), 1000)
+    primera, segunda = _clave(app_local, "antes"), _clave(app_local, "después")
+    cache.agregar([(primera, [1.0, 1.0])])
+    assert cache.get(primera) == [1.0, 1.0]
+    cache.agregar([(segunda, [2.0, 2.0])])
+    assert cache.get(segunda) == [2.0, 2.0]
@@ -0,0 +1,63 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import docx
+
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+def test_pool_de_extraccion_con_hilos_y_locks_tomados(app_local, tmp_path):
+    ruta = tmp_path / "largo.docx"
+    documento = docx.Document()
+    for i in range(30):
+        documento.add_paragraph(f"Párrafo {i}. " + "kin solar onda encantada " * 25)
+    documento.save(ruta)
+    argumentos = (str(ruta), DOCX, "doc-1", 1500, 200, 10_000)
+
+    # Un lock tomado por otro hilo es lo que dejaba colgado al hijo de un fork.
+    tomado = threading.Lock()
+    tomado.acquire()
+    liberar = threading.Event()
+    hilo = threading.Thread(target=liberar.wait, daemon=True)
+    hilo.start()
+    try:
+        with ProcessPoolExecutor(max_workers=2, mp_context=app_local._contexto_de_extraccion()) as pool:
+            resultados = [f.result(timeout=60) for f in
+                          [pool.submit(app_local.extraccion.extraer_lote, *argumentos) for _ in range(3)]]
+    finally:
+        liberar.set()
+        tomado.release()
+
+    esperado = app_local.extraccion.extraer_lote(*argumentos)
+    assert len(esperado[0]) > 1 and esperado[1] is None
+    assert all(resultado == esperado for resultado in resultados)
+
+
+def _por_lotes(extraccion, ruta, mime, max_chunks):
+    lotes, estado = [], None
+    while True:
+        chunks, estado = extraccion.extraer_lote(ruta, mime, "doc-1", 300, 80, max_chunks, estado)
+        lotes.append(chunks)
+        if estado is None:
+            return lotes
+
+
+def test_lotes_encadenados_dan_los_mismos_chunks(app_local, tmp_path):
+    extraccion = app_local.extraccion
+    ruta_docx = tmp_path / "largo.docx"
+    documento = docx.Document()
+    ruta_txt = tmp_path / "largo.txt"
+    with open(ruta_txt, "w", encoding="utf-8") as f:
+        for i in range(60):
+            parrafo = f"Párrafo {i}, día {i % 20}. " + "El kin solar avanza por la onda encantada. " * (1 + i % 7)
+            documento.add_paragraph(parrafo)
+            f.write(parrafo + "\n\n")
+    documento.save(ruta_docx)
+
+    for ruta, mime in ((ruta_docx, DOCX), (ruta_txt, "text/plain")):
+        esperado = extraccion.extraer_chunks(str(ruta), mime, "doc-1", 300, 80)
+        lotes = _por_lotes(extraccion, str(ruta), mime, 5)
+        assert len(lotes) > 3
+        # Cada lote corta al final de un segmento, así que puede pasarse de max_chunks por poco.
+        assert all(len(lote) < 5 + 10 for lote in lotes)
+        assert [chunk for lote in lotes for chunk in lote] == esperado
@@ -0,0 +1,67 @@
+import threading
+import time
+
+
+def _republicar(app_local):
+    """Publica otra generación con el mismo contenido que la servida (solo mueve CURRENT)."""
+    store = app_local.get_chunk_store()
+    ruta = app_local._ruta_en_generacion(app_local.indice_servido["generacion"], app_local.app.config["GCS_BLOB_NAME_FAISS"])
+    time.sleep(0.002)  # el nombre de la generación lleva milisegundos
+    return app_local.publicar_generacion(
+        app_local.faiss.read_index(ruta), [store.get(i) for i in range(len(store))], store.ids,
+        list(app_local.chunk_to_file_id), app_local.indice_servido["nombres"],
+    )
+
+
+def test_peticiones_concurrentes_abren_la_generacion_una_vez(indice_sincronizado, monkeypatch):
+    app_local = indice_sincronizado
+    anterior = app_local.get_chunk_store()
+    generacion = _republicar(app_local)
+    aperturas = []
+    abrir = app_local._abrir_generacion
+
+    def abrir_contando(gen):
+        aperturas.append(gen)
+        time.sleep(0.05)
+        return abrir(gen)
+    monkeypatch.setattr(app_local, "_abrir_generacion", abrir_contando)
+    app_local.indice_servido["revisado"] = 0.0
+
+    hilos = [threading.Thread(target=app_local.refrescar_generacion) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert aperturas == [generacion]
+    assert app_local.indice_servido["generacion"] == generacion
+    assert anterior._idx_file.closed and anterior._blob_file.closed
+
+
+def test_la_generacion_anterior_se_cierra_al_soltarla_la_ultima_busqueda(indice_sincronizado):
+    app_local = indice_sincronizado
+    index, store, servido = app_local._indice_para_busqueda()
+    bm25 = servido["bm25"]
+    _republicar(app_local)
+    app_local.refrescar_generacion(forzar=True)
+
+    assert app_local.get_chunk_store() is not store
+    # La búsqueda en curso sigue leyendo la generación anterior.
+    assert not store._idx_file.closed
+    assert store.get_por_id(int(store.ids[0]))
+    assert bm25.buscar(["kin"], 3)
+
+    store.liberar()
+    assert store._idx_file.closed
+    assert bm25.docs is None
+
+
+def test_publicar_generacion_informa_su_costo(indice_sincronizado):
+    app_local = indice_sincronizado
+    generacion = _republicar(app_local)
+
+    directorio = app_local._ruta_en_generacion(generacion, "")
+    escritos = sum(e.stat().st_size for e in app_local.os.scandir(directorio))
+    metricas = app_local.app.test_client().get("/metrics").get_data(as_text=True)
+    assert f"rag_index_generation_bytes {escritos}" in metricas
+    assert 'oraculo_stage_duration_seconds_count{stage="index_publish"}' in metricas
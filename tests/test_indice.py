@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pytest
+
+
+def _embedding_documento(app_local, texto):
+    resultado = app_local.gemini.embed_content(
+        model=app_local.app.config["EMBEDDING_MODEL"], content=texto, task_type="RETRIEVAL_DOCUMENT"
+    )
+    return np.asarray(resultado["embedding"], dtype=np.float32)
+
+
+def _assert_textos_corresponden_a_ids(app_local):
+    """Cada vector del índice servido es el embedding del texto guardado con su mismo ID."""
+    store = app_local.get_chunk_store()
+    indice = app_local.faiss_index
+    assert indice.ntotal == len(store)
+    for chunk_id in store.ids:
+        vector = indice.reconstruct(int(chunk_id))
+        esperado = _embedding_documento(app_local, store.get_por_id(int(chunk_id)))
+        assert np.allclose(vector, esperado, atol=1e-3), f"el chunk {chunk_id} no corresponde a su texto"
+
+
+def test_reconstruccion_no_reutiliza_ids(indice_sincronizado, client):
+    app_local = indice_sincronizado
+    ids_antes = set(int(i) for i in app_local.get_chunk_store().ids)
+
+    app_local.force_rebuild_index()
+
+    store = app_local.get_chunk_store()
+    assert len(store) > 0
+    assert min(int(i) for i in store.ids) > max(ids_antes)
+    assert app_local.rag_state["next_id"] > max(int(i) for i in store.ids)
+    _assert_textos_corresponden_a_ids(app_local)
+    assert client.get("/rag/status").get_json()["data"]["drive_files_found"] == len(app_local.rag_state["files"])
+
+
+def test_estado_perdido_sin_bucket_no_mezcla_generaciones(indice_sincronizado, monkeypatch):
+    app_local = indice_sincronizado
+    ids_antes = set(int(i) for i in app_local.get_chunk_store().ids)
+    monkeypatch.setitem(app_local.app.config, "GCS_BUCKET_NAME", None)
+    # Estado y token de Drive perdidos mientras se sirve la generación: se reprocesa todo el árbol.
+    os.remove(app_local._ruta_manifiesto())
+    os.remove(app_local._ruta_estado_drive())
+
+    app_local.background_intelligent_sync()
+
+    store = app_local.get_chunk_store()
+    assert min(int(i) for i in store.ids) > max(ids_antes)
+    _assert_textos_corresponden_a_ids(app_local)
+
+
+def _ids_servidos(app_local):
+    return set(int(i) for i in app_local.get_chunk_store().ids)
+
+
+def _ids_por_archivo(app_local):
+    por_archivo = {}
+    for chunk_id, file_id in zip(app_local.get_chunk_store().ids, app_local.chunk_to_file_id):
+        por_archivo.setdefault(file_id, set()).add(int(chunk_id))
+    return por_archivo
+
+
+@pytest.fixture
+def sin_reconstruccion(app_local, monkeypatch):
+    """Falla si la sincronización reconstruye el índice en vez de actualizarlo en su lugar."""
+    def reconstruir(*args, **kwargs):
+        raise AssertionError("se reconstruyó el índice completo")
+    monkeypatch.setattr(app_local, "_construir_indice_faiss", reconstruir)
+
+
+def test_alta_incremental_conserva_los_ids_existentes(indice_sincronizado, sin_reconstruccion):
+    app_local = indice_sincronizado
+    antes = _ids_servidos(app_local)
+
+    nuevos = app_local.drive_local.agregar(2)
+    app_local.background_intelligent_sync()
+
+    por_archivo = _ids_por_archivo(app_local)
+    assert all(file_id in por_archivo for file_id in nuevos)
+    agregados = set().union(*(por_archivo[f] for f in nuevos))
+    assert _ids_servidos(app_local) == antes | agregados
+    assert min(agregados) > max(antes)
+    _assert_textos_corresponden_a_ids(app_local)
+
+
+def test_baja_y_modificacion_incrementales(indice_sincronizado, sin_reconstruccion):
+    app_local = indice_sincronizado
+    borrado, modificado = app_local.drive_local.ids_de_documentos()[:2]
+    antes = _ids_por_archivo(app_local)
+
+    app_local.drive_local.eliminar([borrado])
+    app_local.drive_local.modificar([modificado])
+    app_local.background_intelligent_sync()
+
+    despues = _ids_por_archivo(app_local)
+    assert borrado not in despues and borrado not in app_local.rag_state["files"]
+    assert despues[modificado].isdisjoint(antes[modificado])
+    intactos = set(antes) - {borrado, modificado}
+    assert all(despues[f] == antes[f] for f in intactos)
+    _assert_textos_corresponden_a_ids(app_local)
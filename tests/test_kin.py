@@ -0,0 +1,38 @@
+import datetime
+
+import pytest
+
+
+@pytest.mark.parametrize("fecha, kin", [
+    ("26/07/2013", 164),
+    ("21/12/2012", 207),
+])
+def test_anclas_del_sincronario(client, fecha, kin):
+    respuesta = client.get(f"/kin?fecha={fecha}")
+    assert respuesta.status_code == 200
+    assert respuesta.get_json()["data"] == {"fecha": fecha, "kin": kin}
+
+
+@pytest.mark.parametrize("anio", [1960, 2000, 2012, 2024])
+def test_29_de_febrero_comparte_kin_con_el_28(app_local, anio):
+    kin_28 = app_local.calcular_kin_dreamspell(datetime.date(anio, 2, 28))
+    assert app_local.calcular_kin_dreamspell(datetime.date(anio, 2, 29)) == kin_28
+    assert app_local.calcular_kin_dreamspell(datetime.date(anio, 3, 1)) == kin_28 % 260 + 1
+    assert app_local.kin_local(datetime.date(anio, 2, 29)) == kin_28
+
+
+def test_tabla_precalculada_coincide_con_la_formula(app_local):
+    fecha = datetime.date(2011, 1, 1)
+    while fecha <= datetime.date(2014, 12, 31):
+        assert app_local.kin_local(fecha) == app_local.calcular_kin_dreamspell(fecha), fecha
+        fecha += datetime.timedelta(days=1)
+
+
+def test_fuera_de_la_tabla_se_usa_la_formula(app_local):
+    # 260 años de 365 días después del ancla la cuenta vuelve al mismo Kin.
+    assert app_local.kin_local(datetime.date(2273, 7, 26)) == 164
+
+
+@pytest.mark.parametrize("fecha", ["31/02/2020", "no es fecha"])
+def test_fecha_invalida(client, fecha):
+    assert client.get(f"/kin?fecha={fecha}").status_code == 400
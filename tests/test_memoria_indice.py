@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+# Worker nuevo sobre el mismo disco: abre la generación publicada, busca y mide su memoria anónima
+# (la propia del proceso; las páginas del archivo mapeado se comparten por el page cache).
+_WORKER = """
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import numpy as np
+import app
+app.faiss.IndexFlatL2  # carga la librería antes de medir
+
+def rss_anon():
+    with open("/proc/self/status") as f:
+        return next(int(l.split()[1]) * 1024 for l in f if l.startswith("RssAnon"))
+
+antes = rss_anon()
+app.refrescar_generacion(forzar=True)
+app.faiss_index.search(np.random.default_rng(0).random((4, app.faiss_index.d), dtype=np.float32), 10)
+print(json.dumps({"generacion": app.indice_servido["generacion"], "anon_bytes": rss_anon() - antes}))
+"""
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="RssAnon solo se lee en Linux")
+@pytest.mark.parametrize("tipo", ["flat", "hnsw"])
+def test_abrir_la_generacion_no_copia_los_vectores(app_local, monkeypatch, tmp_path, tipo):
+    monkeypatch.setitem(app_local.app.config, "RAG_INDEX_DIR", str(tmp_path / "rag_index"))
+    n, dimension = 12000, 512
+    vectores = np.random.default_rng(1).random((n, dimension), dtype=np.float32)
+    indice = app_local._construir_indice_faiss(vectores, tipo=tipo, ids=np.arange(n) * 2)
+    generacion = app_local.publicar_generacion(indice, ["texto"] * n, np.arange(n) * 2, ["archivo"] * n)
+    tamano = os.path.getsize(app_local._ruta_en_generacion(generacion, app_local.app.config["GCS_BLOB_NAME_FAISS"]))
+
+    raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proceso = subprocess.run([sys.executable, "-c", _WORKER, raiz], env=dict(os.environ, RENDER_DISK_PATH=str(tmp_path)),
+                             capture_output=True, text=True, cwd=str(tmp_path), timeout=120)
+    assert proceso.returncode == 0, proceso.stderr[-2000:]
+    medida = json.loads(proceso.stdout.strip().splitlines()[-1])
+
+    assert medida["generacion"] == generacion
+    # Con la copia completa crecía más que el archivo (24 MB); mapeado quedan IDs y mapa inverso.
+    assert medida["anon_bytes"] < tamano / 4, medida
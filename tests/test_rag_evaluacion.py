@@ -0,0 +1,30 @@
+import pytest
+
+
+@pytest.fixture
+def evaluacion_habilitada(app_local, monkeypatch):
+    monkeypatch.setitem(app_local.app.config, "RAG_EVAL_ENDPOINT_ENABLED", True)
+
+
+def test_deshabilitada_por_defecto(client):
+    respuesta = client.get("/rag/evaluacion")
+    assert respuesta.status_code == 403
+
+
+@pytest.mark.parametrize("query", ["k=0", "k=-3", "k=101", "k=abc", "consultas=0", "consultas=100000"])
+def test_parametros_fuera_de_rango(client, evaluacion_habilitada, query):
+    respuesta = client.get(f"/rag/evaluacion?{query}")
+    assert respuesta.status_code == 400
+    assert respuesta.get_json()["status"] == "error"
+
+
+def test_evalua_la_generacion_servida_sin_estado_en_memoria(indice_sincronizado, client, evaluacion_habilitada, monkeypatch):
+    app_local = indice_sincronizado
+    # Un worker que no es el líder no tiene el estado en memoria: los vectores salen del disco.
+    monkeypatch.setattr(app_local, "rag_state", app_local._estado_rag_vacio())
+    respuesta = client.get("/rag/evaluacion?k=5&consultas=10")
+    assert respuesta.status_code == 200
+    data = respuesta.get_json()["data"]
+    assert data["generacion"] == app_local.indice_servido["generacion"]
+    assert data["vectores"] == len(app_local.get_chunk_store())
+    assert data["k"] == 5 and data["consultas"] == 10
@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+CONSULTA = {"query": "kin solar y la onda encantada", "k": 3}
+
+# Instancia nueva: otro proceso y otro disco, con el mismo bucket local.
+_RESTAURAR_Y_BUSCAR = """
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import app
+restaurado = app.restaurar_snapshot()
+respuesta = app.app.test_client().post("/rag/search", json=json.loads(sys.argv[2]))
+print(json.dumps({"restaurado": restaurado, "generacion": app.indice_servido["generacion"],
+                  "next_id": app._load_rag_state()["next_id"], "status": respuesta.status_code,
+                  "data": respuesta.get_json()["data"]}))
+"""
+
+
+def _instancia_nueva(tmp_path):
+    raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    entorno = dict(os.environ, RENDER_DISK_PATH=str(tmp_path))
+    proceso = subprocess.run([sys.executable, "-c", _RESTAURAR_Y_BUSCAR, raiz, json.dumps(CONSULTA)],
+                             env=entorno, capture_output=True, text=True, cwd=str(tmp_path), timeout=120)
+    assert proceso.returncode == 0, proceso.stderr[-2000:]
+    return json.loads(proceso.stdout.strip().splitlines()[-1])
+
+
+def test_publicar_restaurar_y_buscar(indice_sincronizado, client, tmp_path):
+    app_local = indice_sincronizado
+    app_local.drive_local.modificar(app_local.drive_local.ids_de_documentos()[:1])
+    app_local.background_intelligent_sync()
+    generacion = app_local.indice_servido["generacion"]
+    assert app_local.publicar_snapshot() in (generacion, None)
+    esperado = client.post("/rag/search", json=CONSULTA).get_json()["data"]
+
+    restaurada = _instancia_nueva(tmp_path)
+
+    assert restaurada["restaurado"]
+    assert restaurada["generacion"] == generacion
+    assert restaurada["next_id"] == app_local.rag_state["next_id"]
+    assert restaurada["status"] == 200
+    assert restaurada["data"]["results"] == esperado["results"]
+    assert [m["chunk_id"] for m in restaurada["data"]["matches"]] == [m["chunk_id"] for m in esperado["matches"]]
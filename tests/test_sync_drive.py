@@ -0,0 +1,118 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+
+def _error(status):
+    return HttpError(httplib2.Response({"status": str(status)}), b"error de prueba")
+
+
+class _PeticionQueFalla:
+    def __init__(self, errores, respuesta):
+        self.errores = errores
+        self.respuesta = respuesta
+
+    def execute(self, num_retries=0):
+        if self.errores:
+            raise self.errores.pop(0)
+        return self.respuesta
+
+
+@pytest.fixture
+def sin_esperas(app_local, monkeypatch):
+    monkeypatch.setattr(app_local.time, "sleep", lambda segundos: None)
+
+
+def _runs(app_local, resultado):
+    series = app_local.metricas.familias.get("rag_sync_runs_total", {}).get("series", {})
+    return series.get((("result", resultado),), 0)
+
+
+def test_reintenta_errores_transitorios(app_local, sin_esperas):
+    errores = [_error(503), _error(500)]
+    respuesta = app_local._ejecutar_drive(lambda: _PeticionQueFalla(errores, {"startPageToken": "7"}))
+    assert respuesta == {"startPageToken": "7"}
+    assert errores == []
+
+
+def test_no_reintenta_errores_permanentes(app_local, sin_esperas):
+    errores = [_error(404), _error(503)]
+    with pytest.raises(HttpError):
+        app_local._ejecutar_drive(lambda: _PeticionQueFalla(errores, {}))
+    assert len(errores) == 1
+
+
+def test_token_inicial_caido_no_tumba_el_escaneo(app_local, sin_esperas, monkeypatch):
+    servicio = app_local._get_drive_service()
+    monkeypatch.setattr(type(servicio.changes()), "getStartPageToken",
+                        lambda self, **kwargs: _PeticionQueFalla([_error(503)] * 10, {}))
+    estado_drive = {}
+    archivos, eliminados = app_local._detectar_cambios_por_escaneo(servicio, estado_drive, {})
+    assert archivos and not eliminados
+    assert estado_drive["page_token"] is None
+
+
+def test_error_en_la_sincronizacion_queda_registrado(app_local, monkeypatch):
+    def falla(reconstruir=False):
+        raise _error(503)
+    monkeypatch.setattr(app_local, "_sincronizar_como_lider", falla)
+    errores_antes = _runs(app_local, "error")
+
+    app_local.background_intelligent_sync()
+
+    assert _runs(app_local, "error") == errores_antes + 1
+    assert not app_local._sync_en_curso.locked()
+
+
+@pytest.fixture
+def checkpoint_temporal(app_local, monkeypatch, tmp_path):
+    monkeypatch.setitem(app_local.app.config, "RAG_CHECKPOINT_FILE", str(tmp_path / "checkpoint.jsonl"))
+    monkeypatch.setitem(app_local.app.config, "RAG_CHECKPOINT_VECTORS_FILE", str(tmp_path / "checkpoint.f32"))
+    return tmp_path
+
+
+def test_checkpoint_guarda_vectores_en_binario(app_local, checkpoint_temporal):
+    app_local._anotar_checkpoint("a", "t1", 0, ["uno", "dos"], [1, 1], [[0.5, 1.5], None])
+    app_local._anotar_checkpoint("b", "t2", 0, ["cuatro"], [None], [[4.0, 5.0]])
+    app_local._anotar_checkpoint("a", "t1", 1, ["tres"], [2], [[2.5, 3.5]])
+    app_local._cerrar_checkpoint("a", "t1", 2)
+    app_local._cerrar_checkpoint("b", "t2", 1)
+
+    with open(checkpoint_temporal / "checkpoint.jsonl") as f:
+        assert "embeddings" not in f.read()
+    assert (checkpoint_temporal / "checkpoint.f32").stat().st_size == 3 * 2 * 4
+    registros = app_local._leer_checkpoint()
+    assert registros["a"]["chunks"] == ["uno", "dos", "tres"]
+    assert registros["a"]["embeddings"] == [[0.5, 1.5], None, [2.5, 3.5]]
+    assert registros["a"]["pages"] == [1, 1, 2]
+    assert registros["b"]["embeddings"] == [[4.0, 5.0]]
+
+    app_local._borrar_checkpoint()
+    assert app_local._leer_checkpoint() == {}
+
+
+def test_checkpoint_solo_reanuda_archivos_completos(app_local, checkpoint_temporal):
+    # "a" quedó a medias; "b" perdió un lote; "c" se reintentó desde el lote 0 y terminó.
+    app_local._anotar_checkpoint("a", "t1", 0, ["uno"], [None], [[1.0, 2.0]])
+    app_local._anotar_checkpoint("b", "t2", 0, ["dos"], [None], [[3.0, 4.0]])
+    app_local._anotar_checkpoint("b", "t2", 2, ["tres"], [None], [[5.0, 6.0]])
+    app_local._cerrar_checkpoint("b", "t2", 2)
+    app_local._anotar_checkpoint("c", "t3", 0, ["viejo"], [None], [[7.0, 8.0]])
+    app_local._anotar_checkpoint("c", "t3", 0, ["nuevo"], [None], [[9.0, 10.0]])
+    app_local._cerrar_checkpoint("c", "t3", 1)
+
+    registros = app_local._leer_checkpoint()
+    assert set(registros) == {"c"}
+    assert registros["c"]["chunks"] == ["nuevo"]
+    assert registros["c"]["embeddings"] == [[9.0, 10.0]]
+
+
+def test_checkpoint_con_vectores_truncados_se_descarta(app_local, checkpoint_temporal):
+    app_local._anotar_checkpoint("a", "t1", 0, ["uno"], [None], [[1.0, 2.0]])
+    app_local._cerrar_checkpoint("a", "t1", 1)
+    app_local._anotar_checkpoint("b", "t2", 0, ["dos"], [None], [[3.0, 4.0]])
+    app_local._cerrar_checkpoint("b", "t2", 1)
+    with open(checkpoint_temporal / "checkpoint.f32", "r+b") as f:
+        f.truncate(12)
+
+    assert set(app_local._leer_checkpoint()) == {"a"}